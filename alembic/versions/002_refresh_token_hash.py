@@ -0,0 +1,31 @@
+"""Refresh token hash index
+
+Revision ID: 002_refresh_token_hash
+Revises: 001_initial
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '002_refresh_token_hash'
+down_revision = '001_initial'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Сессия ищется по SHA-256 refresh токена вместо сравнения полного токена
+    op.add_column('sessions', sa.Column('refresh_token_hash', sa.String(length=64), nullable=True))
+    op.execute(
+        "UPDATE sessions SET refresh_token_hash = encode(sha256(convert_to(refresh_token, 'UTF8')), 'hex') "
+        "WHERE refresh_token IS NOT NULL"
+    )
+    # Индекс не уникальный: прежние версии могли выдать одинаковые токены двум сессиям
+    op.create_index(op.f('ix_sessions_refresh_token_hash'), 'sessions', ['refresh_token_hash'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_sessions_refresh_token_hash'), table_name='sessions')
+    op.drop_column('sessions', 'refresh_token_hash')
@@ -0,0 +1,99 @@
+"""Range-partition sessions by expires_at (optional)
+
+Revision ID: 003_partition_sessions
+Revises: 002_refresh_token_hash
+Create Date: 2026-10-18 12:00:00.000000
+
+Выполняется только по запросу:
+
+    alembic -x partition_sessions=true upgrade head
+
+Без флага ревизия ничего не меняет; чтобы секционировать таблицу позже,
+откатитесь на 002_refresh_token_hash и повторите upgrade с флагом.
+Первичный ключ и уникальность session_id включают expires_at (требование
+PostgreSQL для секционированных таблиц). Будущие секции создает и
+истекшие удаляет app/services/session_reaper.py.
+"""
+from datetime import datetime, timezone
+
+from alembic import context, op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '003_partition_sessions'
+down_revision = '002_refresh_token_hash'
+branch_labels = None
+depends_on = None
+
+# Индексы sessions после 001_initial и 002_refresh_token_hash
+INDEXES = (
+    ('ix_sessions_id', ['id']),
+    ('ix_sessions_user_id', ['user_id']),
+    ('ix_sessions_refresh_token_hash', ['refresh_token_hash']),
+    ('idx_user_expires', ['user_id', 'expires_at']),
+)
+
+
+def _enabled() -> bool:
+    return context.get_x_argument(as_dictionary=True).get('partition_sessions', '').lower() in ('1', 'true', 'yes')
+
+
+def _is_partitioned() -> bool:
+    return bool(op.get_bind().scalar(sa.text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'sessions'::regclass)"
+    )))
+
+
+def _next_month(value: datetime) -> datetime:
+    return value.replace(year=value.year + value.month // 12, month=value.month % 12 + 1)
+
+
+def _replace_table(partitioned: bool):
+    """Пересоздать sessions (секционированной или обычной) с переносом данных"""
+    op.execute("ALTER TABLE sessions RENAME TO sessions_old")
+    partition_clause = " PARTITION BY RANGE (expires_at)" if partitioned else ""
+    op.execute(f"CREATE TABLE sessions (LIKE sessions_old INCLUDING DEFAULTS){partition_clause}")
+
+    if partitioned:
+        # Месячные секции от самой ранней сессии до месяца, в котором истечет новая сессия
+        bounds = op.get_bind().execute(sa.text(
+            "SELECT LEAST(MIN(expires_at), now()), GREATEST(MAX(expires_at), now() + interval '1 month') "
+            "FROM sessions_old"
+        )).one()
+        month = bounds[0].astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        while month <= bounds[1]:
+            op.execute(
+                f"CREATE TABLE sessions_p{month:%Y%m} PARTITION OF sessions "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+            )
+            month = _next_month(month)
+        # Страховка, если новые секции не были созданы вовремя
+        op.execute("CREATE TABLE sessions_default PARTITION OF sessions DEFAULT")
+
+    op.execute("INSERT INTO sessions SELECT * FROM sessions_old")
+    op.execute("ALTER SEQUENCE sessions_id_seq OWNED BY sessions.id")
+    op.execute("DROP TABLE sessions_old")
+
+    if partitioned:
+        op.create_primary_key('sessions_pkey', 'sessions', ['id', 'expires_at'])
+        op.create_index('ix_sessions_session_id', 'sessions', ['session_id', 'expires_at'], unique=True)
+    else:
+        op.create_primary_key('sessions_pkey', 'sessions', ['id'])
+        op.create_index('ix_sessions_session_id', 'sessions', ['session_id'], unique=True)
+    op.create_foreign_key(
+        'sessions_user_id_fkey', 'sessions', 'users', ['user_id'], ['id'], ondelete='CASCADE'
+    )
+    for name, columns in INDEXES:
+        op.create_index(name, 'sessions', columns, unique=False)
+
+
+def upgrade() -> None:
+    if not _enabled() or _is_partitioned():
+        return
+    _replace_table(partitioned=True)
+
+
+def downgrade() -> None:
+    if not _is_partitioned():
+        return
+    _replace_table(partitioned=False)
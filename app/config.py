@@ -9,6 +9,19 @@ import yaml
 from pathlib import Path
 
 
+def load_config_from_yaml() -> dict:
+    """Загружает конфигурацию из config.yaml"""
+    config_path = Path(__file__).parent.parent / "config.yaml"
+    if config_path.exists():
+        with open(config_path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)
+    return {}
+
+
+# Значения по умолчанию из config.yaml
+_yaml_config = load_config_from_yaml() or {}
+
+
 class Settings(BaseSettings):
     """Настройки приложения из переменных окружения и config.yaml"""
     
@@ -25,6 +38,9 @@ class Settings(BaseSettings):
     # Redis
     redis_url: str = Field(env="REDIS_URL")
     redis_decode_responses: bool = Field(default=True, env="REDIS_DECODE_RESPONSES")
+    # Пул соединений воркера: размер и ожидание свободного соединения (с)
+    redis_max_connections: int = Field(default=50, env="REDIS_MAX_CONNECTIONS")
+    redis_pool_timeout: float = Field(default=5.0, env="REDIS_POOL_TIMEOUT")
     
     # JWT
     jwt_secret_key: str = Field(env="JWT_SECRET_KEY")
@@ -32,15 +48,113 @@ class Settings(BaseSettings):
     access_token_expire_minutes: int = Field(default=30, env="ACCESS_TOKEN_EXPIRE_MINUTES")
     refresh_token_expire_days: int = Field(default=30, env="REFRESH_TOKEN_EXPIRE_DAYS")
     
+    # Кэш аутентифицированных пользователей воркера (0 - выключен)
+    auth_principal_cache_ttl: float = Field(default=30.0, env="AUTH_PRINCIPAL_CACHE_TTL")
+    auth_principal_cache_size: int = Field(default=10000, env="AUTH_PRINCIPAL_CACHE_SIZE")
+    
     # Security
     password_min_length: int = Field(default=8, env="PASSWORD_MIN_LENGTH")
     rate_limit_per_minute: int = Field(default=60, env="RATE_LIMIT_PER_MINUTE")
+    # Лимит прокси-запросов пользователя в минуту (0 - без ограничения)
+    proxy_rate_limit_per_minute: int = Field(default=600, env="PROXY_RATE_LIMIT_PER_MINUTE")
+    # Доля лимита, которую воркер берет из Redis за одно обращение
+    rate_limit_local_share: float = Field(default=0.05, env="RATE_LIMIT_LOCAL_SHARE")
+    # Прокси, которым доверяются X-Real-IP и X-Forwarded-For (адреса и подсети)
+    trusted_proxies: List[str] = Field(default=["127.0.0.1", "::1", "172.16.0.0/12"], env="TRUSTED_PROXIES")
     max_request_size_mb: int = Field(default=10, env="MAX_REQUEST_SIZE_MB")
+    # Процессы для bcrypt и очередь ожидания (при переполнении ответ 503)
+    password_hash_workers: int = Field(default=2, env="PASSWORD_HASH_WORKERS")
+    password_hash_queue_size: int = Field(default=64, env="PASSWORD_HASH_QUEUE_SIZE")
     
     # Proxy
     proxy_connect_timeout: int = Field(default=10, env="PROXY_CONNECT_TIMEOUT")
     proxy_read_timeout: int = Field(default=30, env="PROXY_READ_TIMEOUT")
     proxy_max_connections_per_user: int = Field(default=100, env="PROXY_MAX_CONNECTIONS_PER_USER")
+    # Очередь запросов сверх лимита соединений пользователя (в каждом воркере)
+    proxy_user_queue_size: int = Field(default=50, env="PROXY_USER_QUEUE_SIZE")
+    proxy_user_queue_timeout: float = Field(default=10.0, env="PROXY_USER_QUEUE_TIMEOUT")
+    # Срок аренды слота в Redis; продлевается, пока соединение открыто
+    proxy_user_slot_ttl: float = Field(default=60.0, env="PROXY_USER_SLOT_TTL")
+    
+    # Ограничение скорости пользователей (байт/с, 0 - без ограничения).
+    # Тарифы и индивидуальные лимиты задаются через /api/admin/bandwidth
+    bandwidth_default_plan: str = Field(default="default", env="BANDWIDTH_DEFAULT_PLAN")
+    bandwidth_default_rate: int = Field(default=0, env="BANDWIDTH_DEFAULT_RATE")
+    bandwidth_default_burst: int = Field(default=0, env="BANDWIDTH_DEFAULT_BURST")
+    bandwidth_config_ttl: float = Field(default=5.0, env="BANDWIDTH_CONFIG_TTL")
+    
+    # Отложенная запись last_login и last_activity в БД
+    write_behind_interval: float = Field(default=5.0, env="WRITE_BEHIND_INTERVAL")
+    write_behind_max_pending: int = Field(default=5000, env="WRITE_BEHIND_MAX_PENDING")
+    
+    # Удаление истекших сессий (интервал в секундах, 0 - отключено)
+    session_reaper_interval: int = Field(default=300, env="SESSION_REAPER_INTERVAL")
+    session_reaper_batch_size: int = Field(default=500, env="SESSION_REAPER_BATCH_SIZE")
+    
+    # Запись статистики трафика в Redis пакетами
+    stats_flush_interval: float = Field(default=1.0, env="STATS_FLUSH_INTERVAL")
+    stats_flush_max_users: int = Field(default=1000, env="STATS_FLUSH_MAX_USERS")
+    
+    # Контроль задержки event loop (интервал 0 - выключен, порог 0 - без поиска блокирующих вызовов)
+    event_loop_monitor_interval: float = Field(default=0.1, env="EVENT_LOOP_MONITOR_INTERVAL")
+    event_loop_lag_threshold_ms: float = Field(default=200, env="EVENT_LOOP_LAG_THRESHOLD_MS")
+    event_loop_stack_log_interval: float = Field(default=60, env="EVENT_LOOP_STACK_LOG_INTERVAL")
+    
+    # Отказ в /proxy запросах при перегрузке воркера (0 - проверка выключена)
+    admission_max_in_flight: int = Field(default=1000, env="ADMISSION_MAX_IN_FLIGHT")
+    admission_max_loop_lag_ms: float = Field(default=500, env="ADMISSION_MAX_LOOP_LAG_MS")
+    admission_max_pool_queue: int = Field(default=500, env="ADMISSION_MAX_POOL_QUEUE")
+    admission_retry_after: int = Field(default=1, env="ADMISSION_RETRY_AFTER")
+    
+    # Разбивка времени /proxy запросов: заголовок Server-Timing и журнал медленных запросов (0 - выключен)
+    server_timing_enabled: bool = Field(default=False, env="SERVER_TIMING_ENABLED")
+    slow_request_threshold_ms: float = Field(default=0, env="SLOW_REQUEST_THRESHOLD_MS")
+    slow_request_sample_rate: float = Field(default=1.0, env="SLOW_REQUEST_SAMPLE_RATE")
+    
+    # Пул соединений к upstream
+    proxy_pool_max_connections: int = Field(default=200, env="PROXY_POOL_MAX_CONNECTIONS")
+    proxy_pool_max_keepalive_connections: int = Field(default=50, env="PROXY_POOL_MAX_KEEPALIVE_CONNECTIONS")
+    proxy_pool_keepalive_expiry: float = Field(default=30.0, env="PROXY_POOL_KEEPALIVE_EXPIRY")
+    proxy_pool_max_connections_per_origin: int = Field(default=20, env="PROXY_POOL_MAX_CONNECTIONS_PER_ORIGIN")
+    proxy_pool_timeout: float = Field(default=10.0, env="PROXY_POOL_TIMEOUT")
+    proxy_http2_enabled: bool = Field(default=False, env="PROXY_HTTP2_ENABLED")
+    proxy_http2_max_concurrent_streams: int = Field(default=100, env="PROXY_HTTP2_MAX_CONCURRENT_STREAMS")
+    # Передавать сжатое тело ответа без распаковки, если клиент принимает его кодирование
+    proxy_enable_compression: bool = Field(
+        default=_yaml_config.get("proxy", {}).get("enable_compression", True),
+        env="PROXY_ENABLE_COMPRESSION"
+    )
+    proxy_stream_chunk_size: int = Field(default=65536, env="PROXY_STREAM_CHUNK_SIZE")
+    
+    # HTTP-кэш ответов upstream
+    proxy_cache_enabled: bool = Field(default=True, env="PROXY_CACHE_ENABLED")
+    proxy_cache_max_bytes: int = Field(default=64 * 1024 * 1024, env="PROXY_CACHE_MAX_BYTES")
+    proxy_cache_max_object_bytes: int = Field(default=1024 * 1024, env="PROXY_CACHE_MAX_OBJECT_BYTES")
+    proxy_cache_redis_enabled: bool = Field(default=False, env="PROXY_CACHE_REDIS_ENABLED")
+    proxy_cache_stale_retention: int = Field(default=3600, env="PROXY_CACHE_STALE_RETENTION")
+    
+    # Объединение одинаковых одновременных запросов
+    proxy_coalesce_enabled: bool = Field(default=True, env="PROXY_COALESCE_ENABLED")
+    proxy_coalesce_window_bytes: int = Field(default=1024 * 1024, env="PROXY_COALESCE_WINDOW_BYTES")
+    
+    # DNS-кэш для соединений к upstream
+    dns_cache_enabled: bool = Field(default=True, env="DNS_CACHE_ENABLED")
+    dns_cache_max_entries: int = Field(default=10000, env="DNS_CACHE_MAX_ENTRIES")
+    dns_cache_default_ttl: int = Field(default=60, env="DNS_CACHE_DEFAULT_TTL")
+    dns_cache_min_ttl: int = Field(default=5, env="DNS_CACHE_MIN_TTL")
+    dns_cache_max_ttl: int = Field(default=3600, env="DNS_CACHE_MAX_TTL")
+    dns_cache_negative_ttl: int = Field(default=30, env="DNS_CACHE_NEGATIVE_TTL")
+    dns_cache_refresh_min_hits: int = Field(default=10, env="DNS_CACHE_REFRESH_MIN_HITS")
+    dns_cache_refresh_ratio: float = Field(default=0.1, env="DNS_CACHE_REFRESH_RATIO")
+    dns_happy_eyeballs_delay: float = Field(default=0.25, env="DNS_HAPPY_EYEBALLS_DELAY")
+    
+    # Forward proxy (CONNECT и absolute-form)
+    forward_proxy_enabled: bool = Field(default=False, env="FORWARD_PROXY_ENABLED")
+    forward_proxy_host: str = Field(default="0.0.0.0", env="FORWARD_PROXY_HOST")
+    forward_proxy_port: int = Field(default=3128, env="FORWARD_PROXY_PORT")
+    forward_proxy_connect_ports: List[int] = Field(default=[443], env="FORWARD_PROXY_CONNECT_PORTS")
+    forward_proxy_buffer_size: int = Field(default=256 * 1024, env="FORWARD_PROXY_BUFFER_SIZE")
+    forward_proxy_handshake_timeout: float = Field(default=30.0, env="FORWARD_PROXY_HANDSHAKE_TIMEOUT")
     
     # iOS
     ios_user_agent: str = Field(default="iOS/26.1", env="IOS_USER_AGENT")
@@ -73,15 +187,6 @@ class Settings(BaseSettings):
         case_sensitive = False
 
 
-def load_config_from_yaml() -> dict:
-    """Загружает конфигурацию из config.yaml"""
-    config_path = Path(__file__).parent.parent / "config.yaml"
-    if config_path.exists():
-        with open(config_path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f)
-    return {}
-
-
 # Загружаем настройки
 # Переменные окружения имеют приоритет над config.yaml
 settings = Settings()
@@ -1,33 +1,42 @@
 """
 Подключение к базе данных PostgreSQL
+
+Запросы выполняются через асинхронный engine (asyncpg) и не блокируют
+event loop. DATABASE_URL указывается в обычном виде (postgresql://...),
+драйвер подставляется автоматически; миграции Alembic используют тот же
+URL с синхронным драйвером.
 """
-from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import QueuePool
 from app.config import settings
 
+
+def get_async_database_url(url: str) -> str:
+    """URL базы данных с асинхронным драйвером"""
+    parsed = make_url(url)
+    if parsed.drivername in ("postgresql", "postgres", "postgresql+psycopg2"):
+        parsed = parsed.set(drivername="postgresql+asyncpg")
+    return parsed.render_as_string(hide_password=False)
+
+
 # Создаем engine с пулом соединений
-engine = create_engine(
-    settings.database_url,
-    poolclass=QueuePool,
+engine = create_async_engine(
+    get_async_database_url(settings.database_url),
     pool_size=settings.database_pool_size,
     max_overflow=settings.database_max_overflow,
     pool_pre_ping=True,  # Проверка соединений перед использованием
     echo=False
 )
 
-# Создаем фабрику сессий
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Создаем фабрику сессий; объекты остаются доступными после commit без повторного запроса
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 # Базовый класс для моделей
 Base = declarative_base()
 
 
-def get_db():
+async def get_db():
     """Dependency для получения сессии БД"""
-    db = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,262 @@
+"""
+Асинхронный DNS-кэш воркера и сетевой backend для соединений к upstream
+"""
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import httpcore
+
+from app.config import settings
+from app.metrics import DNS_LOOKUPS, DNS_RESOLUTION_SECONDS, DNS_CACHE_ENTRIES
+from app.utils.request_timing import observe_stage
+
+try:
+    import aiodns
+except ImportError:  # pragma: no cover
+    aiodns = None
+
+logger = logging.getLogger(__name__)
+
+
+class _DnsRecord:
+    """Результат разрешения имени"""
+
+    __slots__ = ("addresses", "expires_at", "ttl", "error", "hits", "refreshing")
+
+    def __init__(self, addresses: list, ttl: float, error: Optional[str] = None):
+        # Список пар (семейство адресов, IP)
+        self.addresses = addresses
+        self.ttl = ttl
+        self.expires_at = time.monotonic() + ttl
+        self.error = error
+        self.hits = 0
+        self.refreshing = False
+
+
+class DnsCache:
+    """
+    Кэш DNS с учетом TTL записей.
+
+    Запоминает и отрицательные ответы, популярные имена обновляет в фоне
+    до истечения TTL. При наличии aiodns TTL берется из ответа DNS,
+    иначе используется getaddrinfo и dns_cache_default_ttl.
+    """
+
+    def __init__(self):
+        self._records: OrderedDict[str, _DnsRecord] = OrderedDict()
+        self._pending: dict[str, asyncio.Future] = {}
+        self._resolver = None
+
+    def _get_resolver(self):
+        if self._resolver is None and aiodns is not None:
+            self._resolver = aiodns.DNSResolver()
+        return self._resolver
+
+    async def resolve(self, host: str) -> list:
+        """Получить адреса хоста, [(family, ip), ...]"""
+        try:
+            ip = ipaddress.ip_address(host)
+            family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+            return [(family, host)]
+        except ValueError:
+            pass
+
+        record = self._records.get(host)
+        now = time.monotonic()
+        if record is not None and record.expires_at > now:
+            self._records.move_to_end(host)
+            record.hits += 1
+            if record.error:
+                DNS_LOOKUPS.labels(result="negative_hit").inc()
+                raise socket.gaierror(socket.EAI_NONAME, record.error)
+            DNS_LOOKUPS.labels(result="hit").inc()
+            self._maybe_refresh(host, record, now)
+            return record.addresses
+
+        DNS_LOOKUPS.labels(result="miss").inc()
+        record = await self._resolve_shared(host)
+        if record.error:
+            raise socket.gaierror(socket.EAI_NONAME, record.error)
+        return record.addresses
+
+    def _maybe_refresh(self, host: str, record: _DnsRecord, now: float):
+        """Обновить популярное имя в фоне, пока запись еще действительна"""
+        if record.refreshing or record.hits < settings.dns_cache_refresh_min_hits:
+            return
+        if record.expires_at - now > record.ttl * settings.dns_cache_refresh_ratio:
+            return
+        record.refreshing = True
+        task = asyncio.create_task(self._resolve_shared(host))
+        task.add_done_callback(lambda t: t.exception() if not t.cancelled() else None)
+
+    async def _resolve_shared(self, host: str) -> _DnsRecord:
+        """Одно разрешение имени на все одновременные запросы"""
+        future = self._pending.get(host)
+        if future is None:
+            future = asyncio.ensure_future(self._resolve(host))
+            self._pending[host] = future
+            future.add_done_callback(lambda _: self._pending.pop(host, None))
+        return await asyncio.shield(future)
+
+    async def _resolve(self, host: str) -> _DnsRecord:
+        started = time.perf_counter()
+        try:
+            addresses, ttl = await self._query(host)
+            if addresses:
+                ttl = min(max(ttl, settings.dns_cache_min_ttl), settings.dns_cache_max_ttl)
+                record = _DnsRecord(addresses, ttl)
+            else:
+                record = _DnsRecord([], settings.dns_cache_negative_ttl, f"No addresses for {host}")
+        except (OSError, asyncio.TimeoutError) as e:
+            record = _DnsRecord([], settings.dns_cache_negative_ttl, f"Cannot resolve {host}: {e}")
+        DNS_RESOLUTION_SECONDS.observe(time.perf_counter() - started)
+
+        current = self._records.get(host)
+        if record.error and current is not None and not current.error and current.expires_at > time.monotonic():
+            # Неудачное фоновое обновление не заменяет действующую запись
+            current.refreshing = False
+            return current
+
+        self._records[host] = record
+        self._records.move_to_end(host)
+        while len(self._records) > settings.dns_cache_max_entries:
+            self._records.popitem(last=False)
+        DNS_CACHE_ENTRIES.set(len(self._records))
+        return record
+
+    async def _query(self, host: str) -> tuple[list, float]:
+        """Запросить A и AAAA записи, вернуть адреса и минимальный TTL"""
+        resolver = self._get_resolver()
+        if resolver is not None:
+            results = await asyncio.gather(
+                resolver.query(host, "AAAA"),
+                resolver.query(host, "A"),
+                return_exceptions=True
+            )
+            addresses, ttls = [], []
+            for family, result in zip((socket.AF_INET6, socket.AF_INET), results):
+                if isinstance(result, aiodns.error.DNSError):
+                    continue
+                if isinstance(result, BaseException):
+                    raise result
+                for answer in result:
+                    addresses.append((family, answer.host))
+                    ttls.append(answer.ttl)
+            if addresses:
+                return addresses, min(ttls)
+            # Имена из /etc/hosts и локальных зон разрешает только системный резолвер
+
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            address = (family, sockaddr[0])
+            if address not in addresses:
+                addresses.append(address)
+        return addresses, settings.dns_cache_default_ttl
+
+
+def interleave_addresses(addresses: list) -> list:
+    """Чередовать семейства адресов, начиная с IPv6 (RFC 8305, 4)"""
+    ipv6 = [a for a in addresses if a[0] == socket.AF_INET6]
+    ipv4 = [a for a in addresses if a[0] != socket.AF_INET6]
+    result = []
+    for pair in zip(ipv6, ipv4):
+        result.extend(pair)
+    longer = ipv6 if len(ipv6) > len(ipv4) else ipv4
+    result.extend(longer[min(len(ipv6), len(ipv4)):])
+    return result
+
+
+async def _aclose(stream):
+    await stream.aclose()
+
+
+async def happy_eyeballs(addresses: list, connect, delay: float, close=_aclose):
+    """
+    Подключиться к первому ответившему адресу (RFC 8305).
+
+    Попытки запускаются по очереди с задержкой delay; неудачная попытка
+    сразу запускает следующую. Остальные попытки отменяются после успеха,
+    лишние установленные соединения закрываются через close.
+    """
+    remaining = iter(interleave_addresses(addresses))
+    next_address = next(remaining, None)
+    attempts: set[asyncio.Task] = set()
+    errors: list[BaseException] = []
+    winner = None
+    try:
+        while next_address is not None or attempts:
+            if next_address is not None:
+                attempts.add(asyncio.create_task(connect(next_address[1])))
+                next_address = next(remaining, None)
+            done, _ = await asyncio.wait(
+                attempts,
+                timeout=delay if next_address is not None else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                attempts.discard(task)
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    await close(task.result())
+            if winner is not None:
+                return winner
+        if errors:
+            raise errors[-1]
+        raise OSError("No addresses to connect")
+    finally:
+        for task in attempts:
+            task.cancel()
+        for task in attempts:
+            try:
+                stream = await task
+            except BaseException:
+                continue
+            await close(stream)
+
+
+class CachingNetworkBackend(httpcore.AnyIOBackend):
+    """Сетевой backend httpcore с DNS-кэшем и Happy Eyeballs"""
+
+    def __init__(self, dns: DnsCache):
+        self._dns = dns
+
+    async def connect_tcp(
+        self,
+        host: str,
+        port: int,
+        timeout: Optional[float] = None,
+        local_address: Optional[str] = None,
+        socket_options=None,
+    ) -> httpcore.AsyncNetworkStream:
+        async def connect(ip: str):
+            return await httpcore.AnyIOBackend.connect_tcp(
+                self, ip, port, timeout, local_address, socket_options
+            )
+
+        try:
+            async with asyncio.timeout(timeout):
+                started = time.perf_counter()
+                addresses = await self._dns.resolve(host)
+                resolved = time.perf_counter()
+                observe_stage("dns", resolved - started)
+                stream = await happy_eyeballs(addresses, connect, settings.dns_happy_eyeballs_delay)
+                observe_stage("connect", time.perf_counter() - resolved)
+                return stream
+        except TimeoutError as e:
+            raise httpcore.ConnectTimeout(str(e)) from e
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+
+
+# DNS-кэш воркера
+dns_cache = DnsCache()
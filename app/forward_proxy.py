@@ -0,0 +1,494 @@
+"""
+Forward-прокси: CONNECT-туннели и запросы в absolute-form
+
+Отдельный listener для клиентов, использующих сервер как системный
+HTTP(S) прокси. Туннели передают байты без разбора, на Linux через
+splice без копирования в память процесса. Запросы в absolute-form
+выполняются через ProxyService, как запросы к /proxy.
+"""
+import asyncio
+import base64
+import binascii
+import logging
+import os
+import socket
+import sys
+from http import HTTPStatus
+from typing import Optional
+from urllib.parse import urlsplit
+
+import h11
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from app.config import settings
+from app.database import SessionLocal
+from app.dns_cache import dns_cache, happy_eyeballs
+from app.metrics import ADMISSION_REJECTED, FORWARD_PROXY_REQUESTS, FORWARD_PROXY_TUNNELS
+from app.middleware.auth_middleware import authenticate_principal
+from app.services.admission import admission_controller
+from app.services.bandwidth import UPLOAD, DOWNLOAD, bandwidth_shaper
+from app.services.connection_slots import ConnectionLimitExceeded, connection_slots
+from app.services.proxy_service import ProxyService
+from app.services.stats_aggregator import stats_aggregator
+from app.utils.rate_limit import limiter
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер строки запроса и заголовков
+_MAX_HEAD_BYTES = 64 * 1024
+
+_USE_SPLICE = sys.platform.startswith("linux") and hasattr(os, "splice")
+if _USE_SPLICE:
+    import fcntl
+    _SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+
+class _ProxyError(Exception):
+    """Ошибка, на которую клиенту отправляется ответ с кодом status_code"""
+
+    def __init__(self, status_code: int, message: str, headers: Optional[list] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.headers = headers or []
+
+
+def _proxy_token(header: Optional[bytes]) -> str:
+    """JWT из Proxy-Authorization: Bearer <token> или Basic с токеном в качестве пароля"""
+    if not header:
+        raise _ProxyError(407, "Proxy authentication required")
+    scheme, _, credentials = header.decode("latin-1").strip().partition(" ")
+    credentials = credentials.strip()
+    if scheme.lower() == "bearer" and credentials:
+        return credentials
+    if scheme.lower() == "basic":
+        try:
+            decoded = base64.b64decode(credentials, validate=True).decode("utf-8")
+        except (binascii.Error, UnicodeDecodeError):
+            raise _ProxyError(407, "Invalid proxy credentials")
+        _, _, token = decoded.partition(":")
+        if token:
+            return token
+    raise _ProxyError(407, "Invalid proxy credentials")
+
+
+async def _authenticate(token: str) -> int:
+    """Проверка токена теми же правилами, что и get_current_user"""
+    try:
+        async with SessionLocal() as db:
+            return (await authenticate_principal(token, db)).id
+    except HTTPException as e:
+        raise _ProxyError(407 if e.status_code == 401 else e.status_code, str(e.detail))
+
+
+async def _check_rate_limit(user_id: int):
+    """Лимит proxy_rate_limit_per_minute со счетчиком, общим с /proxy"""
+    limit = settings.proxy_rate_limit_per_minute
+    if limit <= 0:
+        return
+    try:
+        await limiter.hit(f"proxy:user:{user_id}", limit)
+    except HTTPException as e:
+        raise _ProxyError(429, str(e.detail), [(b"retry-after", e.headers["Retry-After"].encode())])
+
+
+def _check_admission():
+    """Отказ при перегрузке воркера, как у /proxy (AdmissionMiddleware)"""
+    reason = admission_controller.rejection_reason()
+    if reason is not None:
+        ADMISSION_REJECTED.labels(reason=reason).inc()
+        raise _ProxyError(
+            503, "Сервер перегружен, повторите попытку позже",
+            [(b"retry-after", str(settings.admission_retry_after).encode())]
+        )
+
+
+def _reason(status_code: int) -> bytes:
+    try:
+        return HTTPStatus(status_code).phrase.encode("ascii")
+    except ValueError:
+        return b""
+
+
+def _split_authority(authority: str) -> tuple[str, int]:
+    """host:port из цели CONNECT (RFC 9110, 9.3.6)"""
+    host, sep, port = authority.rpartition(":")
+    if not sep or not port.isdigit():
+        raise _ProxyError(400, "CONNECT target must be host:port")
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    if not host:
+        raise _ProxyError(400, "CONNECT target must be host:port")
+    return host, int(port)
+
+
+async def _wait_fd(sock: socket.socket, writable: bool):
+    """Дождаться готовности сокета к чтению или записи"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    fd = sock.fileno()
+    add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+    add(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        remove(fd)
+
+
+async def _pump(src: socket.socket, dst: socket.socket, counters: list, index: int, throttle):
+    """Передать данные из src в dst до конца потока; throttle(n) ждет разрешения лимита скорости"""
+    loop = asyncio.get_running_loop()
+    size = settings.forward_proxy_buffer_size
+    if not _USE_SPLICE:
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        while True:
+            n = await loop.sock_recv_into(src, buffer)
+            if not n:
+                return
+            await throttle(n)
+            await loop.sock_sendall(dst, view[:n])
+            counters[index] += n
+
+    # Данные идут сокет -> pipe -> сокет внутри ядра
+    read_fd, write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            pass  # Размер больше /proc/sys/fs/pipe-max-size
+        while True:
+            try:
+                n = os.splice(src.fileno(), write_fd, size, flags=_SPLICE_FLAGS)
+            except BlockingIOError:
+                await _wait_fd(src, writable=False)
+                continue
+            if not n:
+                return
+            await throttle(n)
+            pending = n
+            while pending:
+                try:
+                    pending -= os.splice(read_fd, dst.fileno(), pending, flags=_SPLICE_FLAGS)
+                except BlockingIOError:
+                    await _wait_fd(dst, writable=True)
+            counters[index] += n
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+class _ProxyConnection:
+    """Одно клиентское соединение с forward-прокси"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.conn = h11.Connection(h11.SERVER, max_incomplete_event_size=_MAX_HEAD_BYTES)
+
+    async def _next_event(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = self.conn.next_event()
+            if event is not h11.NEED_DATA:
+                return event
+            data = await loop.sock_recv(self.sock, settings.forward_proxy_buffer_size)
+            self.conn.receive_data(data)
+
+    async def _send(self, *events):
+        data = b"".join(self.conn.send(event) or b"" for event in events)
+        if data:
+            await asyncio.get_running_loop().sock_sendall(self.sock, data)
+
+    async def _send_error(self, error: _ProxyError):
+        if self.conn.our_state not in (h11.IDLE, h11.SEND_RESPONSE):
+            return
+        body = error.message.encode("utf-8")
+        headers = [
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"content-length", str(len(body)).encode()),
+            (b"connection", b"close"),
+        ] + error.headers
+        await self._send(
+            h11.Response(status_code=error.status_code, headers=headers, reason=_reason(error.status_code)),
+            h11.Data(data=body),
+            h11.EndOfMessage()
+        )
+
+    async def _user_for(self, request: h11.Request) -> int:
+        # Токен проверяется в каждом запросе, как у /proxy: выход, истечение и
+        # деактивация пользователя действуют и в открытом keep-alive соединении
+        try:
+            return await _authenticate(_proxy_token(dict(request.headers).get(b"proxy-authorization")))
+        except _ProxyError as e:
+            if e.status_code == 407:
+                e.headers = [(b"proxy-authenticate", b'Basic realm="proxy", Bearer')]
+            raise
+
+    async def run(self):
+        try:
+            while True:
+                async with asyncio.timeout(settings.forward_proxy_handshake_timeout):
+                    event = await self._next_event()
+                if not isinstance(event, h11.Request):
+                    return
+                try:
+                    _check_admission()
+                    user_id = await self._user_for(event)
+                    admission_controller.in_flight += 1
+                    try:
+                        if event.method == b"CONNECT":
+                            await self._connect(event, user_id)
+                            return
+                        await self._forward(event, user_id)
+                    finally:
+                        admission_controller.in_flight -= 1
+                except _ProxyError as e:
+                    FORWARD_PROXY_REQUESTS.labels(
+                        kind="connect" if event.method == b"CONNECT" else "http", result=str(e.status_code)
+                    ).inc()
+                    await self._send_error(e)
+                    return
+                if self.conn.our_state is not h11.DONE:
+                    return
+                # Дочитываем тело, которое upstream не понадобилось (но не после 413)
+                drained = 0
+                while self.conn.their_state is h11.SEND_BODY:
+                    event = await self._next_event()
+                    if isinstance(event, h11.ConnectionClosed):
+                        return
+                    if isinstance(event, h11.Data):
+                        drained += len(event.data)
+                        if drained > settings.forward_proxy_buffer_size:
+                            return
+                if self.conn.their_state is not h11.DONE:
+                    return
+                self.conn.start_next_cycle()
+        except h11.RemoteProtocolError as e:
+            await self._send_error(_ProxyError(e.error_status_hint, "Bad request"))
+        except (TimeoutError, OSError, h11.LocalProtocolError):
+            pass
+        finally:
+            self.sock.close()
+
+    async def _open_upstream(self, host: str, port: int) -> socket.socket:
+        loop = asyncio.get_running_loop()
+
+        async def connect(ip: str) -> socket.socket:
+            sock = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, (ip, port))
+            except BaseException:
+                sock.close()
+                raise
+            return sock
+
+        async def close(sock: socket.socket):
+            sock.close()
+
+        try:
+            async with asyncio.timeout(settings.proxy_connect_timeout):
+                addresses = await dns_cache.resolve(host)
+                sock = await happy_eyeballs(addresses, connect, settings.dns_happy_eyeballs_delay, close)
+        except TimeoutError:
+            raise _ProxyError(504, "Upstream connect timeout")
+        except OSError as e:
+            raise _ProxyError(502, f"Cannot connect to {host}:{port}: {e}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    async def _connect(self, request: h11.Request, user_id: int):
+        """Туннель CONNECT: после ответа 200 байты передаются без разбора"""
+        host, port = _split_authority(request.target.decode("latin-1"))
+        if port not in settings.forward_proxy_connect_ports:
+            raise _ProxyError(403, f"CONNECT to port {port} is not allowed")
+
+        # h11 переходит в режим туннеля только после конца запроса
+        while not isinstance(await self._next_event(), (h11.EndOfMessage, h11.ConnectionClosed)):
+            pass
+        try:
+            slot = await connection_slots.acquire(user_id)
+        except ConnectionLimitExceeded as e:
+            raise _ProxyError(429, str(e), [(b"retry-after", str(e.retry_after).encode())])
+        try:
+            upstream = await self._open_upstream(host, port)
+            try:
+                await self._send(h11.Response(status_code=200, headers=[], reason=b"Connection established"))
+                FORWARD_PROXY_REQUESTS.labels(kind="connect", result="200").inc()
+                # Данные, которые клиент отправил вслед за CONNECT (например, TLS ClientHello)
+                initial, _ = self.conn.trailing_data
+                await self._tunnel(upstream, user_id, bytes(initial))
+            finally:
+                upstream.close()
+        finally:
+            await slot.release()
+
+    async def _tunnel(self, upstream: socket.socket, user_id: int, initial: bytes):
+        # [отправлено клиентом, получено клиентом]
+        counters = [0, 0]
+        loop = asyncio.get_running_loop()
+
+        async def relay(src: socket.socket, dst: socket.socket, index: int):
+            direction = UPLOAD if index == 0 else DOWNLOAD
+
+            async def throttle(size: int):
+                await bandwidth_shaper.consume(user_id, direction, size)
+
+            try:
+                await _pump(src, dst, counters, index, throttle)
+            finally:
+                try:
+                    dst.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+
+        FORWARD_PROXY_TUNNELS.inc()
+        tasks = []
+        try:
+            if initial:
+                await loop.sock_sendall(upstream, initial)
+                counters[0] += len(initial)
+            tasks = [
+                asyncio.create_task(relay(self.sock, upstream, 0)),
+                asyncio.create_task(relay(upstream, self.sock, 1)),
+            ]
+            # Туннель живет, пока открыта хотя бы одна сторона; ошибка закрывает обе
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            FORWARD_PROXY_TUNNELS.dec()
+            stats_aggregator.record(user_id, counters[0], counters[1])
+
+    async def _forward(self, request: h11.Request, user_id: int):
+        """Запрос в absolute-form выполняется через ProxyService"""
+        target_url = request.target.decode("latin-1")
+        parts = urlsplit(target_url)
+        if parts.scheme not in ("http", "https") or not parts.netloc:
+            raise _ProxyError(400, "Forward proxy requests must use an absolute http(s) URI")
+        await _check_rate_limit(user_id)
+
+        headers = [(name, value) for name, value in request.headers]
+        content_length = dict(headers).get(b"content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) > settings.max_request_size_mb * 1024 * 1024:
+                raise _ProxyError(413, f"Размер запроса превышает {settings.max_request_size_mb}MB")
+
+        peer = self.sock.getpeername()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": request.http_version.decode("ascii"),
+            "method": request.method.decode("ascii"),
+            "scheme": parts.scheme,
+            "path": parts.path or "/",
+            "raw_path": (parts.path or "/").encode("latin-1"),
+            # Query остается в target_url
+            "query_string": b"",
+            "root_path": "",
+            "headers": headers,
+            "client": (peer[0], peer[1]),
+            "server": None,
+        }
+        response_complete = asyncio.Event()
+        body_complete = False
+
+        async def receive() -> dict:
+            nonlocal body_complete
+            if not body_complete:
+                event = await self._next_event()
+                if isinstance(event, h11.Data):
+                    return {"type": "http.request", "body": bytes(event.data), "more_body": True}
+                if isinstance(event, h11.EndOfMessage):
+                    body_complete = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+            await response_complete.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict):
+            if message["type"] == "http.response.start":
+                FORWARD_PROXY_REQUESTS.labels(kind="http", result=str(message["status"])).inc()
+                await self._send(h11.Response(
+                    status_code=message["status"],
+                    headers=message.get("headers", []),
+                    reason=_reason(message["status"])
+                ))
+            elif message["type"] == "http.response.body":
+                events = []
+                if message.get("body"):
+                    events.append(h11.Data(data=message["body"]))
+                if not message.get("more_body", False):
+                    events.append(h11.EndOfMessage())
+                    response_complete.set()
+                await self._send(*events)
+
+        response = await ProxyService.proxy_request(Request(scope, receive), target_url, user_id)
+        try:
+            await response(scope, receive, send)
+        finally:
+            if not response_complete.is_set() and response.background is not None:
+                # Клиент отключился: закрываем upstream и учитываем переданные байты
+                await response.background()
+
+
+class ForwardProxyServer:
+    """Listener forward-прокси; каждый воркер слушает тот же порт через SO_REUSEPORT"""
+
+    def __init__(self):
+        self._sock: Optional[socket.socket] = None
+        self._accept_task: Optional[asyncio.Task] = None
+        self._connections: set[asyncio.Task] = set()
+
+    async def start(self):
+        host, port = settings.forward_proxy_host, settings.forward_proxy_port
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(1024)
+        sock.setblocking(False)
+        self._sock = sock
+        self._accept_task = asyncio.create_task(self._accept_loop())
+        logger.info(f"Forward proxy listening on {host}:{port}")
+
+    async def _accept_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client, _ = await loop.sock_accept(self._sock)
+            except OSError as e:
+                logger.warning(f"Forward proxy accept error: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            task = asyncio.create_task(self._handle(client))
+            self._connections.add(task)
+            task.add_done_callback(self._connections.discard)
+
+    @staticmethod
+    async def _handle(client: socket.socket):
+        try:
+            await _ProxyConnection(client).run()
+        except Exception as e:
+            logger.error(f"Forward proxy connection error: {e}", exc_info=True)
+
+    async def stop(self):
+        if self._accept_task is not None:
+            self._accept_task.cancel()
+            await asyncio.gather(self._accept_task, return_exceptions=True)
+            self._accept_task = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+
+# Listener воркера, запускается в lifespan
+forward_proxy = ForwardProxyServer()
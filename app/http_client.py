@@ -0,0 +1,458 @@
+"""
+HTTP клиент с общим пулом соединений к upstream-серверам
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+import httpcore
+import httpx
+
+from app.config import settings
+from app.dns_cache import CachingNetworkBackend, dns_cache
+from app.metrics import (
+    UPSTREAM_POOL_REQUESTS, UPSTREAM_POOL_QUEUE_WAITS,
+    UPSTREAM_POOL_WAIT_SECONDS, UPSTREAM_POOL_WAITING,
+    UPSTREAM_PROTOCOL_REQUESTS, UPSTREAM_HTTP2_FALLBACKS, UPSTREAM_RESPONSES
+)
+from app.utils.request_timing import observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Общий клиент воркера и его транспорт, создаются в lifespan
+http_client: Optional[httpx.AsyncClient] = None
+upstream_transport: Optional["UpstreamTransport"] = None
+
+# События httpcore, означающие, что запросу выдано соединение
+_CONNECT_EVENT = "connection.connect_tcp.started"
+_REUSE_EVENTS = (
+    "http11.send_request_headers.started",
+    "http2.send_request_headers.started",
+)
+# Этапы запроса по парам событий httpcore "<этап>.started" / "<этап>.complete"
+_STAGE_EVENTS = {
+    "connection.connect_tcp": "connect",
+    "connection.start_tls": "tls",
+}
+_TTFB_STARTED = _REUSE_EVENTS
+_TTFB_COMPLETE = (
+    "http11.receive_response_headers.complete",
+    "http2.receive_response_headers.complete",
+)
+
+# Через сколько секунд origin, перешедший на HTTP/1.1, снова пробует HTTP/2
+_HTTP2_RETRY_AFTER = 600
+# Сколько origin помнить для учета протокола
+_MAX_TRACKED_ORIGINS = 10000
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Поток тела ответа, освобождающий слот origin при закрытии"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+
+class _PoolLease:
+    """Учет одного запроса в пуле: ожидание, получение соединения, освобождение"""
+
+    def __init__(self, transport: "UpstreamTransport", origin: tuple):
+        self._transport = transport
+        self._origin = origin
+        self._queued = False
+        self._started = time.perf_counter()
+        self._acquired = False
+        self._released = False
+        self._holds_slot = False
+        self._holds_connection = False
+        # Начало текущего этапа запроса
+        self._stage_started: dict[str, float] = {}
+        transport._waiting += 1
+        UPSTREAM_POOL_WAITING.inc()
+
+    async def trace(self, event_name: str, info: dict) -> None:
+        """Обработчик trace-событий httpcore"""
+        if event_name == _CONNECT_EVENT:
+            self._mark_acquired(new_connection=True)
+        elif event_name in _REUSE_EVENTS:
+            self._mark_acquired(new_connection=False)
+        self._observe_stage(event_name)
+
+    def _observe_stage(self, event_name: str) -> None:
+        if event_name in _TTFB_STARTED:
+            self._stage_started["ttfb"] = time.perf_counter()
+            return
+        if event_name in _TTFB_COMPLETE:
+            stage = "ttfb"
+        else:
+            prefix, _, phase = event_name.rpartition(".")
+            stage = _STAGE_EVENTS.get(prefix)
+            if stage is None:
+                return
+            # С DNS-кэшем соединение измеряет network backend отдельно от разрешения имени
+            if stage == "connect" and self._transport._measures_connect:
+                return
+            if phase == "started":
+                self._stage_started[stage] = time.perf_counter()
+                return
+            if phase != "complete":
+                return
+        started = self._stage_started.pop(stage, None)
+        if started is not None:
+            observe_stage(stage, time.perf_counter() - started)
+
+    def _mark_acquired(self, new_connection: bool) -> None:
+        if self._acquired:
+            return
+        self._acquired = True
+        transport = self._transport
+        transport._waiting -= 1
+        transport._active += 1
+        UPSTREAM_POOL_WAITING.dec()
+
+        wait = time.perf_counter() - self._started
+        UPSTREAM_POOL_WAIT_SECONDS.observe(wait)
+        if self._queued:
+            transport.stats["queue_waits"] += 1
+            UPSTREAM_POOL_QUEUE_WAITS.inc()
+        if new_connection:
+            transport.stats["connects"] += 1
+            UPSTREAM_POOL_REQUESTS.labels(result="connect").inc()
+        else:
+            transport.stats["hits"] += 1
+            UPSTREAM_POOL_REQUESTS.labels(result="hit").inc()
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        transport = self._transport
+        if self._acquired:
+            transport._active -= 1
+        else:
+            transport._waiting -= 1
+            UPSTREAM_POOL_WAITING.dec()
+        transport._release_origin_slot(self._origin, self._holds_slot, self._holds_connection)
+
+
+class _OriginSlot:
+    """
+    Ограничение числа одновременных запросов к одному origin.
+
+    В отличие от asyncio.Semaphore лимит можно изменить на лету: после
+    согласования HTTP/2 origin получает лимит потоков вместо лимита соединений.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        # Число держателей и ожидающих; слот удаляется, когда их не осталось
+        self.refs = 0
+        self.multiplexed = False
+        self._waiters: deque[asyncio.Future] = deque()
+
+    def locked(self) -> bool:
+        return self.in_use >= self.limit or bool(self._waiters)
+
+    async def acquire(self) -> None:
+        if not self.locked():
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Слот выдан одновременно с отменой ожидания
+                self.release()
+            else:
+                self._waiters.remove(future)
+            raise
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self._wake()
+
+    def set_limit(self, limit: int, multiplexed: bool) -> None:
+        self.limit = limit
+        self.multiplexed = multiplexed
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_use < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                self.in_use += 1
+
+
+def _create_pool(
+    limits: httpx.Limits,
+    verify: bool,
+    http2: bool,
+    network_backend: Optional[httpcore.AsyncNetworkBackend]
+) -> httpcore.AsyncConnectionPool:
+    """Пул httpcore; httpx не принимает network backend, поэтому пул создается напрямую"""
+    return httpcore.AsyncConnectionPool(
+        # При http2 контекст объявляет h2 и http/1.1 в ALPN
+        ssl_context=httpx.create_ssl_context(verify=verify, http2=http2),
+        max_connections=limits.max_connections,
+        max_keepalive_connections=limits.max_keepalive_connections,
+        keepalive_expiry=limits.keepalive_expiry,
+        http1=True,
+        http2=http2,
+        network_backend=network_backend,
+    )
+
+
+class UpstreamTransport(httpx.AsyncHTTPTransport):
+    """
+    Транспорт httpx поверх общего пула соединений.
+
+    Дополнительно к глобальным лимитам пула ограничивает число одновременных
+    запросов к одному origin и собирает статистику использования пула.
+
+    В режиме HTTP/2 протокол согласуется через ALPN. Для origin с HTTP/2
+    лимит origin означает число одновременных потоков, а не соединений.
+    Origin, на котором HTTP/2 завершился ошибкой протокола, на время
+    переводится на отдельный пул только с HTTP/1.1.
+    """
+
+    def __init__(
+        self,
+        max_connections_per_origin: int,
+        limits: httpx.Limits,
+        verify: bool = True,
+        network_backend: Optional[httpcore.AsyncNetworkBackend] = None,
+        http2: bool = False,
+        http2_max_concurrent_streams: int = 100
+    ):
+        super().__init__(limits=limits, verify=verify, http2=http2)
+        if network_backend is not None:
+            self._pool = _create_pool(limits, verify, http2, network_backend)
+        self._http2 = http2
+        # Network backend сам учитывает время DNS и соединения
+        self._measures_connect = isinstance(network_backend, CachingNetworkBackend)
+        self._http1_transport: Optional[httpx.AsyncHTTPTransport] = None
+        if http2:
+            self._http1_transport = httpx.AsyncHTTPTransport(limits=limits, verify=verify)
+            if network_backend is not None:
+                self._http1_transport._pool = _create_pool(limits, verify, False, network_backend)
+        self._max_connections = limits.max_connections
+        self._max_per_origin = max_connections_per_origin
+        self._max_streams = http2_max_concurrent_streams
+        self._origin_slots: dict[tuple, _OriginSlot] = {}
+        # origin -> согласованный протокол и origin -> время перехода на HTTP/1.1
+        self._origin_protocols: OrderedDict[tuple, str] = OrderedDict()
+        self._http1_fallbacks: dict[tuple, float] = {}
+        self._waiting = 0
+        self._active = 0
+        # Запросы к origin без HTTP/2, получившие слот и ожидающие или занимающие соединение
+        self._holding = 0
+        self.stats = {"hits": 0, "connects": 0, "queue_waits": 0, "http2_fallbacks": 0}
+
+    def _release_origin_slot(self, origin: tuple, holds_slot: bool, holds_connection: bool) -> None:
+        slot = self._origin_slots.get(origin)
+        if slot is None:
+            return
+        if holds_slot:
+            slot.release()
+        if holds_connection:
+            self._holding -= 1
+        slot.refs -= 1
+        if slot.refs <= 0:
+            del self._origin_slots[origin]
+
+    def _use_http1(self, origin: tuple) -> bool:
+        """Отправлять ли запрос к origin через пул только с HTTP/1.1"""
+        if not self._http2:
+            return False
+        since = self._http1_fallbacks.get(origin)
+        if since is None:
+            return False
+        if time.monotonic() - since > _HTTP2_RETRY_AFTER:
+            # Через некоторое время origin снова пробует HTTP/2
+            del self._http1_fallbacks[origin]
+            return False
+        return True
+
+    def _remember_protocol(self, origin: tuple, http_version: str) -> None:
+        self._origin_protocols[origin] = http_version
+        self._origin_protocols.move_to_end(origin)
+        while len(self._origin_protocols) > _MAX_TRACKED_ORIGINS:
+            self._origin_protocols.popitem(last=False)
+        UPSTREAM_PROTOCOL_REQUESTS.labels(protocol=http_version).inc()
+
+        slot = self._origin_slots.get(origin)
+        multiplexed = http_version == "HTTP/2"
+        if slot is not None and slot.multiplexed != multiplexed:
+            slot.set_limit(self._max_streams if multiplexed else self._max_per_origin, multiplexed)
+
+    def _fall_back_to_http1(self, origin: tuple) -> None:
+        if origin in self._http1_fallbacks:
+            return
+        logger.warning(f"HTTP/2 protocol error, origin {origin[1]}:{origin[2]} falls back to HTTP/1.1")
+        self._http1_fallbacks[origin] = time.monotonic()
+        while len(self._http1_fallbacks) > _MAX_TRACKED_ORIGINS:
+            del self._http1_fallbacks[next(iter(self._http1_fallbacks))]
+        self._origin_protocols.pop(origin, None)
+        self.stats["http2_fallbacks"] += 1
+        UPSTREAM_HTTP2_FALLBACKS.inc()
+        slot = self._origin_slots.get(origin)
+        if slot is not None and slot.multiplexed:
+            slot.set_limit(self._max_per_origin, False)
+
+    async def _send(self, request: httpx.Request, origin: tuple) -> httpx.Response:
+        if not self._use_http1(origin):
+            try:
+                return await super().handle_async_request(request)
+            except (httpx.RemoteProtocolError, httpx.LocalProtocolError):
+                # Ошибка протокола на origin, согласовавшем HTTP/2 через ALPN
+                if self._http2 and self._origin_protocols.get(origin) == "HTTP/2":
+                    self._fall_back_to_http1(origin)
+                raise
+
+        return await self._http1_transport.handle_async_request(request)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        origin = (request.url.scheme, request.url.host, request.url.port)
+        slot = self._origin_slots.get(origin)
+        if slot is None:
+            slot = self._origin_slots[origin] = _OriginSlot(self._max_per_origin)
+            if self._origin_protocols.get(origin) == "HTTP/2" and not self._use_http1(origin):
+                slot.set_limit(self._max_streams, True)
+        slot.refs += 1
+
+        lease = _PoolLease(self, origin)
+
+        try:
+            # Запрос стоит в очереди, если заняты все слоты origin или весь пул
+            if slot.locked():
+                lease._queued = True
+                pool_timeout = request.extensions.get("timeout", {}).get("pool")
+                try:
+                    await asyncio.wait_for(slot.acquire(), timeout=pool_timeout)
+                except asyncio.TimeoutError:
+                    raise httpx.PoolTimeout(
+                        "Превышено время ожидания соединения к origin", request=request
+                    )
+            else:
+                await slot.acquire()
+            lease._holds_slot = True
+            if not slot.multiplexed:
+                # Запросы HTTP/2 делят соединения и не занимают пул целиком
+                lease._holds_connection = True
+                self._holding += 1
+                if self._holding > self._max_connections:
+                    lease._queued = True
+
+            request.extensions["trace"] = lease.trace
+            response = await self._send(request, origin)
+        except BaseException as e:
+            if isinstance(e, httpx.TransportError):
+                UPSTREAM_RESPONSES.labels(code="error").inc()
+            lease.release()
+            raise
+
+        UPSTREAM_RESPONSES.labels(code=str(response.status_code)).inc()
+        http_version = response.extensions.get("http_version", b"HTTP/1.1").decode("ascii")
+        self._remember_protocol(origin, http_version)
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, lease.release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await super().aclose()
+        if self._http1_transport is not None:
+            await self._http1_transport.aclose()
+
+    @property
+    def waiting(self) -> int:
+        """Запросы, ожидающие соединения"""
+        return self._waiting
+
+    def get_stats(self) -> dict:
+        """Текущая статистика пула"""
+        connections = list(self._pool.connections)
+        if self._http1_transport is not None:
+            connections += self._http1_transport._pool.connections
+        protocols = list(self._origin_protocols.values())
+        return {
+            **self.stats,
+            "waiting": self._waiting,
+            "active": self._active,
+            "connections": len(connections),
+            "idle_connections": sum(1 for c in connections if c.is_idle()),
+            "origins": len(self._origin_slots),
+            "http2_enabled": self._http2,
+            "http2_origins": protocols.count("HTTP/2"),
+            "http1_fallback_origins": len(self._http1_fallbacks),
+        }
+
+
+def init_http_client() -> httpx.AsyncClient:
+    """Создать общий HTTP клиент воркера"""
+    global http_client, upstream_transport
+    if http_client is None:
+        upstream_transport = UpstreamTransport(
+            max_connections_per_origin=settings.proxy_pool_max_connections_per_origin,
+            limits=httpx.Limits(
+                max_connections=settings.proxy_pool_max_connections,
+                max_keepalive_connections=settings.proxy_pool_max_keepalive_connections,
+                keepalive_expiry=settings.proxy_pool_keepalive_expiry,
+            ),
+            verify=False,  # Для HTTPS проксирования
+            network_backend=CachingNetworkBackend(dns_cache) if settings.dns_cache_enabled else None,
+            http2=settings.proxy_http2_enabled,
+            http2_max_concurrent_streams=settings.proxy_http2_max_concurrent_streams
+        )
+        http_client = httpx.AsyncClient(
+            transport=upstream_transport,
+            timeout=httpx.Timeout(
+                connect=settings.proxy_connect_timeout,
+                read=settings.proxy_read_timeout,
+                write=settings.proxy_read_timeout,
+                pool=settings.proxy_pool_timeout
+            ),
+            follow_redirects=True
+        )
+    return http_client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Получить общий HTTP клиент"""
+    return init_http_client()
+
+
+async def close_http_client():
+    """Закрыть HTTP клиент и все соединения пула"""
+    global http_client, upstream_transport
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+        upstream_transport = None
+
+
+def get_pool_stats() -> dict:
+    """Получить статистику пула соединений"""
+    if upstream_transport is None:
+        return {}
+    return upstream_transport.get_stats()
@@ -4,17 +4,26 @@
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
 import logging
 import sys
 from contextlib import asynccontextmanager
 
 from app.config import settings
 from app.database import engine, Base
+from app.http_client import init_http_client, close_http_client
+from app.redis_client import close_redis
+from app.forward_proxy import forward_proxy
+from app.services.connection_slots import connection_slots
+from app.services.stats_aggregator import stats_aggregator
+from app.services.principal_cache import principal_cache
+from app.services.password_hasher import password_hasher
+from app.services.write_behind import write_behind
+from app.services.session_reaper import session_reaper
+from app.services.loop_monitor import loop_monitor
 from app.routers import auth, profile, admin, proxy, stats, health
-from app.utils.rate_limit import limiter
+from app.middleware.metrics_middleware import InFlightMiddleware, RequestTimingMiddleware
+from app.middleware.admission_middleware import AdmissionMiddleware
+from app.metrics import mark_worker_dead
 
 # Настройка логирования
 logging.basicConfig(
@@ -37,15 +46,55 @@ async def lifespan(app: FastAPI):
     
     # Создаем таблицы (в продакшене лучше использовать миграции)
     try:
-        Base.metadata.create_all(bind=engine)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
         logger.info("Database tables created/verified")
     except Exception as e:
         logger.error(f"Error creating database tables: {e}")
     
+    # Общий пул соединений к upstream
+    init_http_client()
+    
+    # Продление аренды слотов соединений пользователей
+    connection_slots.start()
+    
+    # Пакетная запись статистики трафика в Redis
+    stats_aggregator.start()
+    
+    # Подписка на сброс кэша аутентифицированных пользователей
+    principal_cache.start()
+    
+    # Отложенная запись отметок времени сессий
+    write_behind.start()
+    
+    # Удаление истекших сессий
+    session_reaper.start()
+    
+    # Контроль задержки event loop
+    loop_monitor.start()
+    
+    # Listener для клиентов, использующих сервер как системный прокси
+    if settings.forward_proxy_enabled:
+        await forward_proxy.start()
+    
     yield
     
     # Shutdown
     logger.info("Shutting down proxy server...")
+    if settings.forward_proxy_enabled:
+        await forward_proxy.stop()
+    await connection_slots.stop()
+    await principal_cache.stop()
+    await session_reaper.stop()
+    await loop_monitor.stop()
+    password_hasher.stop()
+    await close_http_client()
+    # Записываем статистику после завершения всех соединений
+    await stats_aggregator.stop()
+    await close_redis()
+    await write_behind.stop()
+    await engine.dispose()
+    mark_worker_dead()
 
 
 # Создаем FastAPI приложение
@@ -56,10 +105,6 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# Настраиваем rate limiting
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
 # Настраиваем CORS
 app.add_middleware(
     CORSMiddleware,
@@ -69,6 +114,13 @@ app.add_middleware(
     allow_headers=settings.cors_allow_headers,
 )
 
+# Разбивка времени прокси-запросов и запросы в обработке по маршрутам
+app.add_middleware(RequestTimingMiddleware)
+app.add_middleware(InFlightMiddleware)
+
+# Отказ в прокси-запросах при перегрузке (первым, до остальной обработки)
+app.add_middleware(AdmissionMiddleware)
+
 
 # Обработчик ошибок
 @app.exception_handler(Exception)
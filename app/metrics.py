@@ -0,0 +1,257 @@
+"""
+Prometheus метрики приложения
+
+Uvicorn запускает несколько воркеров, поэтому при заданной переменной
+окружения PROMETHEUS_MULTIPROC_DIR метрики всех процессов пишутся в файлы
+этого каталога и объединяются при выдаче /metrics. Gauge суммируются по
+живым воркерам (livesum).
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    """Метрики в формате Prometheus (всех воркеров в multiprocess-режиме) и их Content-Type"""
+    if not MULTIPROCESS:
+        return generate_latest(), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead():
+    """Убрать gauge завершающегося воркера из суммы по живым процессам"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+# Пул соединений к upstream-серверам
+UPSTREAM_POOL_REQUESTS = Counter(
+    "proxy_upstream_pool_requests_total",
+    "Запросы к upstream по способу получения соединения (hit - из пула, connect - новое)",
+    ["result"]
+)
+UPSTREAM_POOL_QUEUE_WAITS = Counter(
+    "proxy_upstream_pool_queue_waits_total",
+    "Запросы, ожидавшие свободного соединения в пуле"
+)
+UPSTREAM_POOL_WAIT_SECONDS = Histogram(
+    "proxy_upstream_pool_wait_seconds",
+    "Время ожидания соединения из пула",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+UPSTREAM_POOL_WAITING = Gauge(
+    "proxy_upstream_pool_waiting",
+    "Запросы, ожидающие соединения в данный момент",
+    multiprocess_mode="livesum"
+)
+UPSTREAM_PROTOCOL_REQUESTS = Counter(
+    "proxy_upstream_requests_by_protocol_total",
+    "Ответы upstream по согласованному протоколу (HTTP/1.1, HTTP/2)",
+    ["protocol"]
+)
+UPSTREAM_HTTP2_FALLBACKS = Counter(
+    "proxy_upstream_http2_fallbacks_total",
+    "Переходы origin с HTTP/2 на HTTP/1.1 после ошибки протокола"
+)
+
+# HTTP-кэш
+CACHE_REQUESTS = Counter(
+    "proxy_cache_requests_total",
+    "Запросы к HTTP-кэшу (hit, stale, revalidated, miss)",
+    ["result"]
+)
+CACHE_REVALIDATIONS = Counter(
+    "proxy_cache_revalidations_total",
+    "Условные запросы к upstream для перепроверки записей кэша",
+    ["result"]
+)
+CACHE_MEMORY_BYTES = Gauge(
+    "proxy_cache_memory_bytes",
+    "Объем записей HTTP-кэша в памяти воркера",
+    multiprocess_mode="livesum"
+)
+
+# Объединение одинаковых запросов
+COALESCED_REQUESTS = Counter(
+    "proxy_coalesced_requests_total",
+    "Запросы через single-flight (leader - выполнил запрос, follower - получил чужой ответ, fallback - ответ нельзя разделить)",
+    ["role"]
+)
+
+# DNS-кэш
+DNS_LOOKUPS = Counter(
+    "proxy_dns_lookups_total",
+    "Обращения к DNS-кэшу (hit, negative_hit, miss)",
+    ["result"]
+)
+DNS_RESOLUTION_SECONDS = Histogram(
+    "proxy_dns_resolution_seconds",
+    "Время разрешения имени при промахе кэша",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+DNS_CACHE_ENTRIES = Gauge(
+    "proxy_dns_cache_entries",
+    "Число имен в DNS-кэше воркера",
+    multiprocess_mode="livesum"
+)
+
+# Forward-прокси
+FORWARD_PROXY_REQUESTS = Counter(
+    "proxy_forward_requests_total",
+    "Запросы к forward-прокси по типу (connect, http) и коду ответа",
+    ["kind", "result"]
+)
+FORWARD_PROXY_TUNNELS = Gauge(
+    "proxy_forward_tunnels",
+    "Открытые CONNECT-туннели",
+    multiprocess_mode="livesum"
+)
+
+# Слоты соединений пользователей
+USER_SLOT_REQUESTS = Counter(
+    "proxy_user_slot_requests_total",
+    "Запросы слота соединения пользователя (acquired, queued, rejected, timeout)",
+    ["result"]
+)
+USER_SLOT_WAIT_SECONDS = Histogram(
+    "proxy_user_slot_wait_seconds",
+    "Время ожидания слота в очереди пользователя",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+USER_SLOTS_HELD = Gauge(
+    "proxy_user_slots_held",
+    "Слоты соединений, занятые запросами воркера",
+    multiprocess_mode="livesum"
+)
+USER_SLOTS_QUEUED = Gauge(
+    "proxy_user_slots_queued",
+    "Запросы воркера, ожидающие слота соединения",
+    multiprocess_mode="livesum"
+)
+
+# Ограничение скорости пользователей
+BANDWIDTH_THROTTLE_SECONDS = Counter(
+    "proxy_bandwidth_throttle_seconds_total",
+    "Суммарное время задержки передачи из-за лимита скорости (upload, download)",
+    ["direction"]
+)
+
+STATS_FLUSHES = Counter(
+    "proxy_stats_flushes_total",
+    "Пакетные записи статистики трафика в Redis (ok, error)",
+    ["result"]
+)
+
+STATS_PENDING_USERS = Gauge(
+    "proxy_stats_pending_users",
+    "Пользователи воркера с незаписанной статистикой трафика",
+    multiprocess_mode="livesum"
+)
+
+WRITE_BEHIND_FLUSHES = Counter(
+    "proxy_write_behind_flushes_total",
+    "Пакетные записи last_login и last_activity в БД (ok, error)",
+    ["result"]
+)
+
+WRITE_BEHIND_PENDING = Gauge(
+    "proxy_write_behind_pending",
+    "Отметки времени воркера, ожидающие записи в БД",
+    multiprocess_mode="livesum"
+)
+
+SESSIONS_REAPED = Counter(
+    "proxy_sessions_reaped_total",
+    "Истекшие сессии, удаленные из БД"
+)
+
+RATE_LIMIT_REQUESTS = Counter(
+    "proxy_rate_limit_requests_total",
+    "Проверки лимита запросов (local, redis, fallback, rejected)",
+    ["result"]
+)
+
+PRINCIPAL_CACHE_REQUESTS = Counter(
+    "proxy_principal_cache_requests_total",
+    "Проверки токена через кэш пользователей воркера (hit, miss)",
+    ["result"]
+)
+
+# Хэширование паролей в пуле процессов
+PASSWORD_HASH_SECONDS = Histogram(
+    "proxy_password_hash_seconds",
+    "Время хэширования и проверки пароля, включая ожидание в очереди (hash, verify)",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+PASSWORD_HASH_QUEUE = Gauge(
+    "proxy_password_hash_queue",
+    "Операции с паролями, ожидающие или выполняющиеся в пуле процессов",
+    multiprocess_mode="livesum"
+)
+PASSWORD_HASH_REJECTED = Counter(
+    "proxy_password_hash_rejected_total",
+    "Операции с паролями, отклоненные из-за переполнения очереди"
+)
+
+# Event loop воркера
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "proxy_event_loop_lag_seconds",
+    "Задержка пробуждения задачи в event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+EVENT_LOOP_LAG = Gauge(
+    "proxy_event_loop_lag",
+    "Последняя измеренная задержка event loop (максимум по воркерам), с",
+    multiprocess_mode="livemax"
+)
+EVENT_LOOP_BLOCKS = Counter(
+    "proxy_event_loop_blocks_total",
+    "Остановки event loop дольше порога"
+)
+
+ADMISSION_REJECTED = Counter(
+    "proxy_admission_rejected_total",
+    "Прокси-запросы, отклоненные при перегрузке воркера (in_flight, loop_lag, pool_queue)",
+    ["reason"]
+)
+
+# Этапы прокси-запроса
+PROXY_STAGE_SECONDS = Histogram(
+    "proxy_stage_seconds",
+    "Длительность этапов прокси-запроса (auth, dns, connect, tls, ttfb, transfer)",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+UPSTREAM_RESPONSES = Counter(
+    "proxy_upstream_responses_total",
+    "Ответы upstream по коду статуса (error - ошибка соединения или протокола)",
+    ["code"]
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "proxy_http_requests_in_flight",
+    "Запросы, обрабатываемые в данный момент, по маршруту",
+    ["route"],
+    multiprocess_mode="livesum"
+)
+
+# WebSocket-прокси
+WEBSOCKET_SESSIONS = Counter(
+    "proxy_websocket_sessions_total",
+    "Открытые WebSocket-сессии прокси"
+)
+WEBSOCKET_SESSIONS_ACTIVE = Gauge(
+    "proxy_websocket_sessions_active",
+    "Активные WebSocket-сессии прокси",
+    multiprocess_mode="livesum"
+)
+WEBSOCKET_BYTES = Counter(
+    "proxy_websocket_bytes_total",
+    "Байты, переданные через WebSocket-прокси (upload, download)",
+    ["direction"]
+)
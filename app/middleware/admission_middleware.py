@@ -0,0 +1,54 @@
+"""
+Отказ в прокси-запросах при перегрузке воркера (503 с Retry-After)
+"""
+import json
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.config import settings
+from app.metrics import ADMISSION_REJECTED
+from app.services.admission import admission_controller
+
+
+class AdmissionMiddleware:
+    """ASGI middleware: отказ в /proxy запросах при перегрузке воркера"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] not in ("http", "websocket") or not scope["path"].startswith("/proxy"):
+            await self.app(scope, receive, send)
+            return
+
+        reason = admission_controller.rejection_reason()
+        if reason is not None:
+            ADMISSION_REJECTED.labels(reason=reason).inc()
+            await self._reject(scope, send)
+            return
+
+        admission_controller.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_controller.in_flight -= 1
+
+    @staticmethod
+    async def _reject(scope: Scope, send: Send):
+        if scope["type"] == "websocket":
+            # 1013 - Try Again Later
+            await send({"type": "websocket.close", "code": 1013, "reason": "Server overloaded"})
+            return
+        body = json.dumps(
+            {"detail": "Сервер перегружен, повторите попытку позже"}, ensure_ascii=False
+        ).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"retry-after", str(settings.admission_retry_after).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,28 +1,26 @@
 """
 Middleware для аутентификации
 """
+import time
 from typing import Optional
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
 from app.models.user import User
-from app.utils.security import decode_token
-from app.redis_client import get_user_from_token
+from app.utils.security import decode_token, token_digest
+from app.redis_client import get_user_from_token, is_token_revoked
 from app.services.auth_service import AuthService
+from app.services.principal_cache import Principal, principal_cache
+from app.utils.request_timing import observe_stage
 
 security = HTTPBearer()
 
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    """Получить текущего пользователя из JWT токена"""
-    token = credentials.credentials
-    
+async def authenticate_token(token: str, db: AsyncSession) -> User:
+    """Проверить access токен и получить активного пользователя"""
     # Проверяем токен в Redis
-    user_id = get_user_from_token(token)
+    user_id = await get_user_from_token(token)
     if not user_id:
         # Если нет в Redis, декодируем токен
         payload = decode_token(token)
@@ -32,10 +30,17 @@ async def get_current_user(
                 detail="Неверный токен",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        # Токен, удаленный из Redis при выходе, остается действительным JWT до истечения срока
+        if await is_token_revoked(token_digest(token)):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Токен отозван",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
         user_id = int(payload.get("sub"))
     
     # Получаем пользователя из БД
-    user = AuthService.get_user_by_id(db, user_id)
+    user = await AuthService.get_user_by_id(db, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -52,9 +57,48 @@ async def get_current_user(
     return user
 
 
-async def get_current_admin_user(
-    current_user: User = Depends(get_current_user)
+async def authenticate_principal(token: str, db: AsyncSession) -> Principal:
+    """Проверить access токен; в обычном случае без обращения к Redis и БД"""
+    started = time.perf_counter()
+    try:
+        digest = token_digest(token)
+        principal = principal_cache.get(digest)
+        if principal is not None:
+            return principal
+        
+        generation = principal_cache.generation
+        principal = Principal.from_user(await authenticate_token(token, db))
+        payload = decode_token(token)
+        if payload and payload.get("exp"):
+            principal_cache.put(digest, principal, payload["exp"], generation)
+        return principal
+    finally:
+        observe_stage("auth", time.perf_counter() - started)
+
+
+async def get_current_principal(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
+) -> Principal:
+    """Получить id и флаги текущего пользователя (без загрузки модели из БД)"""
+    principal = await authenticate_principal(credentials.credentials, db)
+    # Для rate limiting по пользователю
+    add_user_to_request(request, principal)
+    return principal
+
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
 ) -> User:
+    """Получить текущего пользователя из JWT токена"""
+    return await authenticate_token(credentials.credentials, db)
+
+
+async def get_current_admin_user(
+    current_user: Principal = Depends(get_current_principal)
+) -> Principal:
     """Получить текущего администратора"""
     if not current_user.is_admin:
         raise HTTPException(
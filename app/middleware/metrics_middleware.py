@@ -0,0 +1,95 @@
+"""
+Учет запросов, обрабатываемых в данный момент, по маршрутам и разбивка
+времени прокси-запросов (Server-Timing, журнал медленных запросов)
+"""
+import logging
+import random
+
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import settings
+from app.metrics import HTTP_REQUESTS_IN_FLIGHT
+from app.utils.request_timing import RequestTimings, start_request_timing
+
+logger = logging.getLogger(__name__)
+
+
+def route_template(scope: Scope) -> str:
+    """Шаблон пути маршрута (например, /proxy/{path:path}) вместо конкретного URL"""
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "other")
+    return "other"
+
+
+class InFlightMiddleware:
+    """ASGI middleware: gauge запросов в обработке (включая передачу потокового ответа)"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        gauge = HTTP_REQUESTS_IN_FLIGHT.labels(route=route_template(scope))
+        gauge.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gauge.dec()
+
+
+class RequestTimingMiddleware:
+    """
+    ASGI middleware: разбивка времени /proxy запросов по этапам.
+
+    При server_timing_enabled ответ получает заголовок Server-Timing с
+    этапами до начала ответа. Запросы дольше slow_request_threshold_ms
+    (с вероятностью slow_request_sample_rate) пишутся в журнал вместе с
+    передачей тела. Если обе возможности выключены, запрос проходит без изменений.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or not scope["path"].startswith("/proxy")
+            or not (settings.server_timing_enabled or settings.slow_request_threshold_ms > 0)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        timings = start_request_timing()
+        status_code = 0
+
+        async def send_with_timing(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if settings.server_timing_enabled:
+                    MutableHeaders(scope=message).append("Server-Timing", timings.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            self._log_if_slow(scope, timings, status_code)
+
+    @staticmethod
+    def _log_if_slow(scope: Scope, timings: RequestTimings, status_code: int):
+        threshold = settings.slow_request_threshold_ms
+        elapsed_ms = timings.elapsed() * 1000
+        if threshold <= 0 or elapsed_ms < threshold or random.random() >= settings.slow_request_sample_rate:
+            return
+        stages = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.stages.items())
+        user_id = scope.get("state", {}).get("user_id")
+        logger.warning(
+            f"Slow request {scope['method']} upstream={timings.upstream} status={status_code} "
+            f"user={user_id} total={elapsed_ms:.1f}ms {stages}"
+        )
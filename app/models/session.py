@@ -14,7 +14,8 @@ class Session(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     session_id = Column(String(255), unique=True, index=True, nullable=False)
-    refresh_token = Column(Text, nullable=True)
+    refresh_token = Column(Text, nullable=True)  # Не заполняется: хранится только хэш
+    refresh_token_hash = Column(String(64), index=True, nullable=True)  # SHA-256 refresh токена
     ip_address = Column(String(45), nullable=True)  # IPv6 support
     user_agent = Column(String(500), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
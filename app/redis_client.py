@@ -1,11 +1,13 @@
 """
 Redis клиент для кэширования и хранения сессий
+
+Клиент асинхронный: команды не блокируют event loop. Соединения берутся
+из общего пула воркера размером redis_max_connections.
 """
-import redis
+import redis.asyncio as redis
 from typing import Optional
 from app.config import settings
 import json
-from datetime import timedelta
 
 # Создаем Redis клиент
 redis_client: Optional[redis.Redis] = None
@@ -15,90 +17,408 @@ def get_redis() -> redis.Redis:
     """Получить Redis клиент"""
     global redis_client
     if redis_client is None:
-        redis_client = redis.from_url(
+        # При исчерпании пула команда ждет свободного соединения, а не падает сразу
+        pool = redis.BlockingConnectionPool.from_url(
             settings.redis_url,
+            max_connections=settings.redis_max_connections,
+            timeout=settings.redis_pool_timeout,
             decode_responses=settings.redis_decode_responses,
             socket_connect_timeout=5,
             socket_timeout=5,
             retry_on_timeout=True
         )
+        redis_client = redis.Redis.from_pool(pool)
     return redis_client
 
 
-def cache_token(token: str, user_id: int, expire_minutes: int = 30):
+async def close_redis():
+    """Закрыть клиент и соединения пула"""
+    global redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+
+
+async def cache_token(token: str, user_id: int, expire_minutes: int = 30):
     """Кэшировать токен"""
     r = get_redis()
     key = f"token:{token}"
-    r.setex(key, expire_minutes * 60, user_id)
+    await r.setex(key, expire_minutes * 60, user_id)
 
 
-def get_user_from_token(token: str) -> Optional[int]:
+async def get_user_from_token(token: str) -> Optional[int]:
     """Получить user_id из токена"""
     r = get_redis()
     key = f"token:{token}"
-    user_id = r.get(key)
+    user_id = await r.get(key)
     return int(user_id) if user_id else None
 
 
-def invalidate_token(token: str):
+async def invalidate_token(token: str):
     """Удалить токен из кэша"""
     r = get_redis()
     key = f"token:{token}"
-    r.delete(key)
+    await r.delete(key)
 
 
-def cache_session(session_id: str, user_id: int, data: dict, expire_days: int = 30):
-    """Кэшировать сессию"""
-    r = get_redis()
+async def revoke_token(token: str, digest: str, expire_seconds: int):
+    """Отозвать access токен до истечения его срока"""
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.delete(f"token:{token}")
+    pipe.setex(f"revoked_token:{digest}", max(1, expire_seconds), 1)
+    await pipe.execute()
+
+
+async def is_token_revoked(digest: str) -> bool:
+    """Отозван ли access токен"""
+    return bool(await get_redis().exists(f"revoked_token:{digest}"))
+
+
+# Канал, через который воркеры сбрасывают кэш аутентифицированных пользователей
+AUTH_INVALIDATION_CHANNEL = "auth:invalidate"
+
+
+async def publish_auth_invalidation(message: dict):
+    """Сообщить всем воркерам о сбросе кэша пользователя или токена"""
+    await get_redis().publish(AUTH_INVALIDATION_CHANNEL, json.dumps(message))
+
+
+async def cache_session(
+    session_id: str, user_id: int, data: dict, expire_seconds: int,
+    refresh_digest: Optional[str] = None, only_if_missing: bool = False
+):
+    """Кэшировать сессию (и индекс хэша refresh токена -> сессия)"""
+    if expire_seconds <= 0:
+        return
+    pipe = get_redis().pipeline(transaction=False)
     key = f"session:{session_id}"
-    r.setex(key, expire_days * 24 * 60 * 60, json.dumps(data))
+    pipe.set(key, json.dumps(data), ex=expire_seconds, nx=only_if_missing)
+    if refresh_digest:
+        pipe.setex(f"refresh_session:{refresh_digest}", expire_seconds, session_id)
     # Также добавляем в список сессий пользователя
     user_sessions_key = f"user_sessions:{user_id}"
-    r.sadd(user_sessions_key, session_id)
-    r.expire(user_sessions_key, expire_days * 24 * 60 * 60)
+    pipe.sadd(user_sessions_key, session_id)
+    # Список живет не меньше самой долгой сессии
+    pipe.expire(user_sessions_key, expire_seconds, gt=True)
+    pipe.expire(user_sessions_key, expire_seconds, nx=True)
+    await pipe.execute()
+
+
+async def update_cached_session(session_id: str, data: dict):
+    """Обновить данные закэшированной сессии, сохранив срок"""
+    await get_redis().set(f"session:{session_id}", json.dumps(data), keepttl=True, xx=True)
+
+
+async def get_session_by_refresh_digest(digest: str) -> Optional[dict]:
+    """Получить сессию по хэшу refresh токена"""
+    r = get_redis()
+    session_id = await r.get(f"refresh_session:{digest}")
+    if not session_id:
+        return None
+    return await get_session(session_id)
 
 
-def get_session(session_id: str) -> Optional[dict]:
+async def get_session(session_id: str) -> Optional[dict]:
     """Получить сессию"""
     r = get_redis()
     key = f"session:{session_id}"
-    data = r.get(key)
+    data = await r.get(key)
     return json.loads(data) if data else None
 
 
-def delete_session(session_id: str, user_id: int):
+async def delete_session(session_id: str, user_id: int, refresh_digest: Optional[str] = None):
     """Удалить сессию"""
+    await delete_sessions([(session_id, user_id, refresh_digest)])
+
+
+async def delete_sessions(sessions: list):
+    """Удалить сессии одним pipeline: [(session_id, user_id, refresh_digest), ...]"""
+    if not sessions:
+        return
+    pipe = get_redis().pipeline(transaction=False)
+    for session_id, user_id, refresh_digest in sessions:
+        pipe.delete(f"session:{session_id}")
+        if refresh_digest:
+            pipe.delete(f"refresh_session:{refresh_digest}")
+        pipe.srem(f"user_sessions:{user_id}", session_id)
+    await pipe.execute()
+
+
+async def acquire_lease(name: str, expire_seconds: int) -> bool:
+    """Занять периодическую задачу на expire_seconds (не более одного воркера)"""
+    return bool(await get_redis().set(f"lease:{name}", "1", ex=expire_seconds, nx=True))
+
+
+async def get_user_sessions(user_id: int) -> list:
+    """Получить все сессии пользователя"""
     r = get_redis()
-    key = f"session:{session_id}"
-    r.delete(key)
     user_sessions_key = f"user_sessions:{user_id}"
-    r.srem(user_sessions_key, session_id)
+    return list(await r.smembers(user_sessions_key))
 
 
-def get_user_sessions(user_id: int) -> list:
-    """Получить все сессии пользователя"""
+async def mark_user_sessions_cached(user_id: int, expire_seconds: int):
+    """Отметить, что в Redis закэшированы все сессии пользователя"""
+    await get_redis().setex(f"user_sessions_complete:{user_id}", expire_seconds, 1)
+
+
+async def get_cached_user_sessions(user_id: int) -> Optional[list]:
+    """Данные всех сессий пользователя из Redis; None, если кэш может быть неполным"""
     r = get_redis()
     user_sessions_key = f"user_sessions:{user_id}"
-    return list(r.smembers(user_sessions_key))
+    pipe = r.pipeline(transaction=False)
+    pipe.exists(f"user_sessions_complete:{user_id}")
+    pipe.smembers(user_sessions_key)
+    complete, session_ids = await pipe.execute()
+    if not complete:
+        return None
+    session_ids = list(session_ids)
+    if not session_ids:
+        return []
+    values = await r.mget([f"session:{session_id}" for session_id in session_ids])
+    expired = [session_id for session_id, data in zip(session_ids, values) if data is None]
+    if expired:
+        await r.srem(user_sessions_key, *expired)
+    return [json.loads(data) for data in values if data is not None]
 
 
-def increment_user_stats(user_id: int, bytes_sent: int, bytes_received: int):
+async def increment_user_stats(user_id: int, bytes_sent: int, bytes_received: int, requests: int = 1):
     """Увеличить статистику пользователя"""
-    r = get_redis()
-    stats_key = f"stats:{user_id}"
-    r.hincrby(stats_key, "bytes_sent", bytes_sent)
-    r.hincrby(stats_key, "bytes_received", bytes_received)
-    r.hincrby(stats_key, "requests", 1)
-    r.expire(stats_key, 86400 * 7)  # Храним 7 дней
+    await increment_user_stats_batch({user_id: (bytes_sent, bytes_received, requests)})
 
 
-def get_user_stats(user_id: int) -> dict:
-    """Получить статистику пользователя"""
-    r = get_redis()
-    stats_key = f"stats:{user_id}"
-    stats = r.hgetall(stats_key)
+async def increment_user_stats_batch(deltas: dict):
+    """Увеличить статистику нескольких пользователей одним pipeline: {user_id: (sent, received, requests)}"""
+    pipe = get_redis().pipeline(transaction=False)
+    for user_id, (bytes_sent, bytes_received, requests) in deltas.items():
+        stats_key = f"stats:{user_id}"
+        pipe.hincrby(stats_key, "bytes_sent", bytes_sent)
+        pipe.hincrby(stats_key, "bytes_received", bytes_received)
+        pipe.hincrby(stats_key, "requests", requests)
+        pipe.expire(stats_key, 86400 * 7)  # Храним 7 дней
+    await pipe.execute()
+
+
+def _stats_from_hash(stats: dict) -> dict:
     return {
         "bytes_sent": int(stats.get("bytes_sent", 0)),
         "bytes_received": int(stats.get("bytes_received", 0)),
         "requests": int(stats.get("requests", 0))
     }
+
+
+async def get_user_stats(user_id: int) -> dict:
+    """Получить статистику пользователя"""
+    r = get_redis()
+    stats_key = f"stats:{user_id}"
+    return _stats_from_hash(await r.hgetall(stats_key))
+
+
+async def get_users_stats(user_ids: list) -> dict:
+    """Получить статистику нескольких пользователей одним pipeline"""
+    pipe = get_redis().pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hgetall(f"stats:{user_id}")
+    results = await pipe.execute()
+    return {user_id: _stats_from_hash(stats) for user_id, stats in zip(user_ids, results)}
+
+
+async def get_cached_http_vary(url_key: str) -> Optional[list]:
+    """Получить список заголовков Vary для закэшированного URL"""
+    r = get_redis()
+    data = await r.get(f"httpcache:vary:{url_key}")
+    return json.loads(data) if data else None
+
+
+async def get_cached_http_entry(variant_key: str) -> Optional[str]:
+    """Получить закэшированный HTTP-ответ"""
+    r = get_redis()
+    return await r.get(f"httpcache:entry:{variant_key}")
+
+
+async def cache_http_entry(url_key: str, variant_key: str, vary_names: list, data: str, expire_seconds: int):
+    """Кэшировать HTTP-ответ вместе со списком заголовков Vary для URL"""
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.setex(f"httpcache:vary:{url_key}", expire_seconds, json.dumps(vary_names))
+    pipe.setex(f"httpcache:entry:{variant_key}", expire_seconds, data)
+    # Индекс вариантов ответа для инвалидации URL целиком
+    variants_key = f"httpcache:variants:{url_key}"
+    pipe.sadd(variants_key, variant_key)
+    pipe.expire(variants_key, expire_seconds)
+    await pipe.execute()
+
+
+async def invalidate_http_entries(url_key: str):
+    """Удалить все закэшированные варианты ответа для URL"""
+    r = get_redis()
+    variants_key = f"httpcache:variants:{url_key}"
+    keys = [f"httpcache:entry:{variant}" for variant in await r.smembers(variants_key)]
+    await r.delete(f"httpcache:vary:{url_key}", variants_key, *keys)
+
+
+# Слоты соединений пользователя: ZSET аренд, score - время истечения аренды (по часам Redis)
+_ACQUIRE_SLOT_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3])))
+return 1
+"""
+
+_REFRESH_SLOT_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[2]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])))
+return 1
+"""
+
+_COUNT_SLOTS_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+return redis.call('ZCOUNT', KEYS[1], '(' .. now, '+inf')
+"""
+
+_scripts: dict = {}
+
+
+def _script(source: str):
+    """Lua-скрипт (EVALSHA с автоматической загрузкой)"""
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = get_redis().register_script(source)
+    return script
+
+
+async def acquire_connection_slot(user_id: int, lease_id: str, limit: int, ttl_seconds: float) -> bool:
+    """Занять слот соединения пользователя, если их меньше limit"""
+    key = f"conn_slots:{user_id}"
+    return bool(await _script(_ACQUIRE_SLOT_SCRIPT)(keys=[key], args=[lease_id, limit, ttl_seconds], client=get_redis()))
+
+
+async def refresh_connection_slots(leases: list, ttl_seconds: float):
+    """Продлить аренды слотов [(user_id, lease_id), ...] одним pipeline"""
+    script = _script(_REFRESH_SLOT_SCRIPT)
+    pipe = get_redis().pipeline(transaction=False)
+    for user_id, lease_id in leases:
+        await script(keys=[f"conn_slots:{user_id}"], args=[lease_id, ttl_seconds], client=pipe)
+    await pipe.execute()
+
+
+async def release_connection_slot(user_id: int, lease_id: str):
+    """Освободить слот соединения пользователя"""
+    await get_redis().zrem(f"conn_slots:{user_id}", lease_id)
+
+
+async def count_connection_slots(user_id: int) -> int:
+    """Число занятых слотов пользователя во всех воркерах"""
+    return int(await _script(_COUNT_SLOTS_SCRIPT)(keys=[f"conn_slots:{user_id}"], client=get_redis()))
+
+
+# Ограничение скорости: token bucket пользователя в Redis, общий для всех воркеров
+_TAKE_TOKENS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+local wait_ms = 0
+if granted < requested then
+    wait_ms = math.ceil((requested - granted - tokens) / rate * 1000)
+end
+return {granted, wait_ms}
+"""
+
+
+async def take_bandwidth_tokens(user_id: int, direction: str, rate: int, burst: int, requested: int) -> tuple[int, float]:
+    """Взять до requested байт из bucket пользователя; вернуть (выдано, сколько ждать до остатка, с)"""
+    key = f"bandwidth:bucket:{user_id}:{direction}"
+    granted, wait_ms = await _script(_TAKE_TOKENS_SCRIPT)(keys=[key], args=[rate, burst, requested], client=get_redis())
+    return int(granted), int(wait_ms) / 1000
+
+
+# Ограничение частоты запросов: скользящее окно по счетчикам текущего и предыдущего окна
+# (HASH id окна -> число запросов), часы Redis общие для всех воркеров
+_SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local current_id = math.floor(now / window)
+local elapsed = now - current_id * window
+local counts = redis.call('HMGET', KEYS[1], tostring(current_id), tostring(current_id - 1))
+local current = tonumber(counts[1]) or 0
+local previous = tonumber(counts[2]) or 0
+local available = math.floor(limit - previous * (1 - elapsed / window) - current)
+if available < 1 then
+    -- Через сколько вклад предыдущего окна уменьшится настолько, что освободится один запрос
+    local wait = window - elapsed
+    if previous > 0 and current + 1 <= limit then
+        wait = math.max(0, wait - (limit - current - 1) * window / previous)
+    end
+    return {0, math.ceil(wait * 1000)}
+end
+local granted = math.min(requested, available)
+redis.call('HINCRBY', KEYS[1], tostring(current_id), granted)
+redis.call('HDEL', KEYS[1], tostring(current_id - 2))
+redis.call('EXPIRE', KEYS[1], window * 2)
+return {granted, math.ceil((window - elapsed) * 1000)}
+"""
+
+
+async def take_rate_limit(key: str, limit: int, window: int, requested: int) -> tuple[int, float]:
+    """Взять до requested запросов из окна; вернуть (выдано, с до конца окна или до повтора)"""
+    granted, ms = await _script(_SLIDING_WINDOW_SCRIPT)(
+        keys=[f"rate:{key}"], args=[limit, window, requested], client=get_redis()
+    )
+    return int(granted), int(ms) / 1000
+
+
+async def get_bandwidth_config(user_id: int) -> tuple[Optional[dict], dict]:
+    """Настройки скорости пользователя и все тарифы"""
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hget("bandwidth:users", user_id)
+    pipe.hgetall("bandwidth:plans")
+    user_data, plans = await pipe.execute()
+    return (
+        json.loads(user_data) if user_data else None,
+        {name: json.loads(data) for name, data in plans.items()}
+    )
+
+
+async def set_bandwidth_plan(plan: str, data: dict):
+    """Создать или изменить тариф"""
+    await get_redis().hset("bandwidth:plans", plan, json.dumps(data))
+
+
+async def delete_bandwidth_plan(plan: str) -> bool:
+    """Удалить тариф"""
+    return bool(await get_redis().hdel("bandwidth:plans", plan))
+
+
+async def set_user_bandwidth(user_id: int, data: dict):
+    """Назначить пользователю тариф или собственный лимит"""
+    await get_redis().hset("bandwidth:users", user_id, json.dumps(data))
+
+
+async def delete_user_bandwidth(user_id: int) -> bool:
+    """Вернуть пользователю тариф по умолчанию"""
+    return bool(await get_redis().hdel("bandwidth:users", user_id))
+
+
+async def get_bandwidth_plans() -> dict:
+    """Все тарифы ограничения скорости"""
+    plans = await get_redis().hgetall("bandwidth:plans")
+    return {name: json.loads(data) for name, data in plans.items()}
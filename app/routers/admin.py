@@ -3,13 +3,25 @@
 """
 from typing import List
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
-from app.schemas.user import UserResponse, UserUpdate
+from app.schemas.user import UserResponse, AdminUserUpdate
 from app.middleware.auth_middleware import get_current_admin_user
 from app.models.user import User
-from app.redis_client import get_user_stats
-from app.schemas.stats import StatsResponse
+from app.redis_client import (
+    get_users_stats, get_bandwidth_config, get_bandwidth_plans, set_bandwidth_plan,
+    delete_bandwidth_plan, set_user_bandwidth, delete_user_bandwidth
+)
+from app.schemas.bandwidth import (
+    BandwidthLimitSchema, BandwidthPlansResponse, UserBandwidthUpdate, UserBandwidthResponse
+)
+from app.services.bandwidth import bandwidth_shaper, resolve_limit
+from app.config import settings
+from app.schemas.stats import StatsResponse, ConnectionSlotsResponse
+from app.services.connection_slots import connection_slots
+from app.services.principal_cache import Principal, principal_cache
+from app.http_client import get_pool_stats
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
 
@@ -18,22 +30,22 @@ router = APIRouter(prefix="/api/admin", tags=["admin"])
 async def get_all_users(
     skip: int = 0,
     limit: int = 100,
-    current_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить список всех пользователей (только для администраторов)"""
-    users = db.query(User).offset(skip).limit(limit).all()
-    return users
+    users = await db.scalars(select(User).offset(skip).limit(limit))
+    return list(users)
 
 
 @router.get("/users/{user_id}", response_model=UserResponse)
 async def get_user(
     user_id: int,
-    current_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить данные пользователя по ID"""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -45,12 +57,12 @@ async def get_user(
 @router.put("/users/{user_id}", response_model=UserResponse)
 async def update_user(
     user_id: int,
-    user_data: UserUpdate,
-    current_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    user_data: AdminUserUpdate,
+    current_user: Principal = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Обновить данные пользователя"""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -58,7 +70,7 @@ async def update_user(
         )
     
     if user_data.email and user_data.email != user.email:
-        existing_user = db.query(User).filter(User.email == user_data.email).first()
+        existing_user = await db.scalar(select(User).where(User.email == user_data.email))
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -67,7 +79,7 @@ async def update_user(
         user.email = user_data.email
     
     if user_data.username and user_data.username != user.username:
-        existing_user = db.query(User).filter(User.username == user_data.username).first()
+        existing_user = await db.scalar(select(User).where(User.username == user_data.username))
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -75,8 +87,20 @@ async def update_user(
             )
         user.username = user_data.username
     
-    db.commit()
-    db.refresh(user)
+    deactivated = user_data.is_active is False and user.is_active
+    if user_data.is_active is not None and user_data.is_active != user.is_active:
+        if user_id == current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Нельзя заблокировать самого себя"
+            )
+        user.is_active = user_data.is_active
+    
+    await db.commit()
+    await db.refresh(user)
+    
+    if deactivated:
+        await principal_cache.invalidate_user(user_id)
     
     return user
 
@@ -84,8 +108,8 @@ async def update_user(
 @router.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_user(
     user_id: int,
-    current_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Удалить пользователя"""
     if user_id == current_user.id:
@@ -94,30 +118,32 @@ async def delete_user(
             detail="Нельзя удалить самого себя"
         )
     
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Пользователь не найден"
         )
     
-    db.delete(user)
-    db.commit()
+    await db.delete(user)
+    await db.commit()
+    await principal_cache.invalidate_user(user_id)
     
     return None
 
 
 @router.get("/stats", response_model=dict)
 async def get_all_stats(
-    current_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить статистику всех пользователей (только для администраторов)"""
-    users = db.query(User).all()
+    users = (await db.scalars(select(User))).all()
     stats = {}
+    users_stats = await get_users_stats([user.id for user in users])
     
     for user in users:
-        user_stats = get_user_stats(user.id)
+        user_stats = users_stats[user.id]
         stats[user.id] = {
             "user_id": user.id,
             "email": user.email,
@@ -126,3 +152,115 @@ async def get_all_stats(
         }
     
     return {"users": stats, "total_users": len(users)}
+
+
+@router.get("/pool", response_model=dict)
+async def get_upstream_pool_stats(
+    current_user: Principal = Depends(get_current_admin_user)
+):
+    """Получить статистику пула соединений к upstream текущего воркера"""
+    return get_pool_stats()
+
+
+@router.get("/users/{user_id}/connections", response_model=ConnectionSlotsResponse)
+async def get_user_connection_slots(
+    user_id: int,
+    current_user: Principal = Depends(get_current_admin_user)
+):
+    """Получить число открытых соединений пользователя"""
+    return await connection_slots.occupancy(user_id)
+
+
+@router.get("/bandwidth/plans", response_model=BandwidthPlansResponse)
+async def get_bandwidth_plan_list(
+    current_user: Principal = Depends(get_current_admin_user)
+):
+    """Получить тарифы ограничения скорости"""
+    return {"default_plan": settings.bandwidth_default_plan, "plans": await get_bandwidth_plans()}
+
+
+@router.put("/bandwidth/plans/{plan}", response_model=BandwidthLimitSchema)
+async def update_bandwidth_plan(
+    plan: str,
+    limit: BandwidthLimitSchema,
+    current_user: Principal = Depends(get_current_admin_user)
+):
+    """Создать или изменить тариф (применяется во всех воркерах в течение BANDWIDTH_CONFIG_TTL)"""
+    await set_bandwidth_plan(plan, limit.model_dump())
+    bandwidth_shaper.invalidate()
+    return limit
+
+
+@router.delete("/bandwidth/plans/{plan}", status_code=status.HTTP_204_NO_CONTENT)
+async def remove_bandwidth_plan(
+    plan: str,
+    current_user: Principal = Depends(get_current_admin_user)
+):
+    """Удалить тариф"""
+    if not await delete_bandwidth_plan(plan):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Тариф не найден"
+        )
+    bandwidth_shaper.invalidate()
+    return None
+
+
+async def _user_bandwidth(user_id: int) -> dict:
+    user_data, plans = await get_bandwidth_config(user_id)
+    user_data = user_data or {}
+    limit = resolve_limit(user_data, plans)
+    return {
+        "user_id": user_id,
+        "plan": user_data.get("plan") or settings.bandwidth_default_plan,
+        "rate": user_data.get("rate"),
+        "burst": user_data.get("burst"),
+        "effective": limit.to_dict() if limit else None,
+    }
+
+
+@router.get("/users/{user_id}/bandwidth", response_model=UserBandwidthResponse)
+async def get_user_bandwidth(
+    user_id: int,
+    current_user: Principal = Depends(get_current_admin_user)
+):
+    """Получить лимит скорости пользователя"""
+    return await _user_bandwidth(user_id)
+
+
+@router.put("/users/{user_id}/bandwidth", response_model=UserBandwidthResponse)
+async def update_user_bandwidth(
+    user_id: int,
+    bandwidth: UserBandwidthUpdate,
+    current_user: Principal = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Назначить пользователю тариф или индивидуальный лимит (rate важнее тарифа)"""
+    user = await db.get(User, user_id)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пользователь не найден"
+        )
+    
+    if bandwidth.plan is not None and bandwidth.plan not in await get_bandwidth_plans() \
+            and bandwidth.plan != settings.bandwidth_default_plan:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Тариф не найден"
+        )
+    
+    await set_user_bandwidth(user_id, bandwidth.model_dump(exclude_none=True))
+    bandwidth_shaper.invalidate(user_id)
+    return await _user_bandwidth(user_id)
+
+
+@router.delete("/users/{user_id}/bandwidth", status_code=status.HTTP_204_NO_CONTENT)
+async def reset_user_bandwidth(
+    user_id: int,
+    current_user: Principal = Depends(get_current_admin_user)
+):
+    """Вернуть пользователю тариф по умолчанию"""
+    await delete_user_bandwidth(user_id)
+    bandwidth_shaper.invalidate(user_id)
+    return None
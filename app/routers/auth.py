@@ -2,29 +2,29 @@
 Роутер для авторизации
 """
 from fastapi import APIRouter, Depends, HTTPException, status, Request
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from sqlalchemy.orm import Session
+from fastapi.security import HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
 from app.schemas.user import UserCreate, UserLogin
 from app.schemas.auth import Token, TokenRefresh, SessionResponse
 from app.services.auth_service import AuthService
-from app.middleware.auth_middleware import get_current_user
-from app.utils.rate_limit import limiter
+from app.middleware.auth_middleware import get_current_principal, security
+from app.utils.rate_limit import RateLimit, get_client_ip
 from app.config import settings
 
 router = APIRouter(prefix="/api", tags=["auth"])
 
 
-@router.post("/register", response_model=dict, status_code=status.HTTP_201_CREATED)
-@limiter.limit(f"{settings.rate_limit_per_minute}/minute")
+@router.post(
+    "/register", response_model=dict, status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(RateLimit("register", "rate_limit_per_minute"))]
+)
 async def register(
-    request: Request,
     user_data: UserCreate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Регистрация нового пользователя"""
-    user = AuthService.register_user(db, user_data)
+    user = await AuthService.register_user(db, user_data)
     return {
         "message": "Пользователь успешно зарегистрирован",
         "user_id": user.id,
@@ -32,18 +32,17 @@ async def register(
     }
 
 
-@router.post("/login", response_model=Token)
-@limiter.limit(f"{settings.rate_limit_per_minute}/minute")
+@router.post("/login", response_model=Token, dependencies=[Depends(RateLimit("login", "rate_limit_per_minute"))])
 async def login(
     request: Request,
     user_data: UserLogin,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Вход в систему"""
-    ip_address = get_remote_address(request)
+    ip_address = get_client_ip(request)
     user_agent = request.headers.get("user-agent")
     
-    user, access_token, refresh_token = AuthService.authenticate_user(
+    user, access_token, refresh_token = await AuthService.authenticate_user(
         db, user_data, ip_address, user_agent
     )
     
@@ -58,10 +57,10 @@ async def login(
 @router.post("/refresh", response_model=Token)
 async def refresh_token(
     token_data: TokenRefresh,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Обновление access токена"""
-    new_access_token, refresh_token = AuthService.refresh_access_token(
+    new_access_token, refresh_token = await AuthService.refresh_access_token(
         db, token_data.refresh_token
     )
     
@@ -73,24 +72,33 @@ async def refresh_token(
     )
 
 
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user = Depends(get_current_principal)
+):
+    """Выход из системы: текущий access токен перестает действовать"""
+    await AuthService.logout(credentials.credentials)
+
+
 @router.get("/sessions", response_model=list[SessionResponse])
 async def get_sessions(
-    current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить список активных сессий пользователя"""
-    sessions = AuthService.get_user_sessions(db, current_user.id)
+    sessions = await AuthService.get_user_sessions(db, current_user.id)
     return sessions
 
 
 @router.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_session(
     session_id: str,
-    current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_db)
 ):
     """Завершить конкретную сессию"""
-    success = AuthService.delete_session(db, session_id, current_user.id)
+    success = await AuthService.delete_session(db, session_id, current_user.id)
     if not success:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -2,18 +2,18 @@
 Роутер для мониторинга здоровья сервиса
 """
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from app.database import get_db, engine
+from app.database import get_db
 from app.redis_client import get_redis
-from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from app.metrics import generate_metrics
 from fastapi.responses import Response
 
 router = APIRouter(tags=["monitoring"])
 
 
 @router.get("/health")
-async def health_check(db: Session = Depends(get_db)):
+async def health_check(db: AsyncSession = Depends(get_db)):
     """Проверка здоровья сервиса"""
     status = {
         "status": "healthy",
@@ -23,7 +23,7 @@ async def health_check(db: Session = Depends(get_db)):
     
     # Проверка базы данных
     try:
-        db.execute(text("SELECT 1"))
+        await db.execute(text("SELECT 1"))
         status["database"] = "connected"
     except Exception as e:
         status["database"] = f"error: {str(e)}"
@@ -32,7 +32,7 @@ async def health_check(db: Session = Depends(get_db)):
     # Проверка Redis
     try:
         redis = get_redis()
-        redis.ping()
+        await redis.ping()
         status["redis"] = "connected"
     except Exception as e:
         status["redis"] = f"error: {str(e)}"
@@ -43,8 +43,9 @@ async def health_check(db: Session = Depends(get_db)):
 
 @router.get("/metrics")
 async def metrics():
-    """Prometheus метрики"""
+    """Prometheus метрики (всех воркеров в multiprocess-режиме)"""
+    content, content_type = generate_metrics()
     return Response(
-        content=generate_latest(),
-        media_type=CONTENT_TYPE_LATEST
+        content=content,
+        media_type=content_type
     )
@@ -2,12 +2,14 @@
 Роутер для управления профилем пользователя
 """
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
 from app.schemas.user import UserResponse, UserUpdate, PasswordChange
 from app.middleware.auth_middleware import get_current_user
 from app.models.user import User
-from app.utils.security import verify_password, get_password_hash
+from app.services.password_hasher import password_hasher
+from app.services.principal_cache import principal_cache
 
 router = APIRouter(prefix="/api", tags=["profile"])
 
@@ -15,7 +17,7 @@ router = APIRouter(prefix="/api", tags=["profile"])
 @router.get("/profile", response_model=UserResponse)
 async def get_profile(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить данные профиля"""
     return current_user
@@ -25,12 +27,12 @@ async def get_profile(
 async def update_profile(
     user_data: UserUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Обновить профиль"""
     # Проверяем уникальность email, если он изменяется
     if user_data.email and user_data.email != current_user.email:
-        existing_user = db.query(User).filter(User.email == user_data.email).first()
+        existing_user = await db.scalar(select(User).where(User.email == user_data.email))
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -40,7 +42,7 @@ async def update_profile(
     
     # Проверяем уникальность username, если он изменяется
     if user_data.username and user_data.username != current_user.username:
-        existing_user = db.query(User).filter(User.username == user_data.username).first()
+        existing_user = await db.scalar(select(User).where(User.username == user_data.username))
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -48,8 +50,8 @@ async def update_profile(
             )
         current_user.username = user_data.username
     
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    await db.refresh(current_user)
     
     return current_user
 
@@ -58,18 +60,19 @@ async def update_profile(
 async def change_password(
     password_data: PasswordChange,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Сменить пароль"""
     # Проверяем текущий пароль
-    if not verify_password(password_data.current_password, current_user.hashed_password):
+    if not await password_hasher.verify(password_data.current_password, current_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Неверный текущий пароль"
         )
     
     # Устанавливаем новый пароль
-    current_user.hashed_password = get_password_hash(password_data.new_password)
-    db.commit()
+    current_user.hashed_password = await password_hasher.hash(password_data.new_password)
+    await db.commit()
+    await principal_cache.invalidate_user(current_user.id)
     
     return None
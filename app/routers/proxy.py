@@ -3,9 +3,11 @@
 """
 from fastapi import APIRouter, Request, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
 from fastapi.responses import Response
-from app.middleware.auth_middleware import get_current_user
-from app.models.user import User
+from app.middleware.auth_middleware import authenticate_principal, get_current_principal
+from app.services.principal_cache import Principal
 from app.services.proxy_service import ProxyService
+from app.services.connection_slots import ConnectionLimitExceeded, connection_slots
+from app.utils.rate_limit import RateLimit
 from urllib.parse import urlparse
 import re
 
@@ -26,7 +28,8 @@ def validate_url(url: str) -> bool:
 async def proxy_request(
     path: str,
     request: Request,
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_principal),
+    _rate_limit: None = Depends(RateLimit("proxy", "proxy_rate_limit_per_minute"))
 ):
     """
     Прокси-эндпоинт для всех HTTP методов
@@ -61,7 +64,8 @@ async def proxy_request(
             detail="Некорректный URL. Разрешены только HTTP и HTTPS протоколы"
         )
     
-    # Проверка размера запроса
+    # Проверка размера запроса по заголовку до чтения тела (и до "100 Continue").
+    # Для chunked-запросов лимит проверяется при потоковой передаче в ProxyService
     content_length = request.headers.get("content-length")
     if content_length:
         try:
@@ -99,25 +103,16 @@ async def proxy_websocket(
         await websocket.close(code=1008, reason="Token required")
         return
     
-    # Декодируем токен и получаем пользователя
-    from app.utils.security import decode_token
+    # Проверяем токен теми же правилами, что и для HTTP-запросов
     from app.database import SessionLocal
-    from app.services.auth_service import AuthService
     
-    payload = decode_token(token)
-    if not payload or payload.get("type") != "access":
-        await websocket.close(code=1008, reason="Invalid token")
-        return
-    
-    user_id = int(payload.get("sub"))
-    db = SessionLocal()
     try:
-        user = AuthService.get_user_by_id(db, user_id)
-        if not user or not user.is_active:
-            await websocket.close(code=1008, reason="User not found or inactive")
-            return
-    finally:
-        db.close()
+        async with SessionLocal() as db:
+            user_id = (await authenticate_principal(token, db)).id
+    except HTTPException as e:
+        reason = "Invalid token" if e.status_code == status.HTTP_401_UNAUTHORIZED else "User inactive"
+        await websocket.close(code=1008, reason=reason)
+        return
     
     # Формируем целевой URL
     if path.startswith("ws://") or path.startswith("wss://"):
@@ -125,6 +120,13 @@ async def proxy_websocket(
     else:
         target_url = f"wss://{path}"
     
+    # Слот соединения пользователя занят все время работы WebSocket
+    try:
+        slot = await connection_slots.acquire(user_id)
+    except ConnectionLimitExceeded:
+        await websocket.close(code=1013, reason="Too many connections")
+        return
+    
     # Проксируем WebSocket
     try:
         await ProxyService.proxy_websocket(websocket, target_url, user_id)
@@ -132,3 +134,5 @@ async def proxy_websocket(
         pass
     except Exception as e:
         await websocket.close(code=1011, reason=f"Proxy error: {str(e)}")
+    finally:
+        await slot.release()
@@ -2,18 +2,27 @@
 Роутер для статистики
 """
 from fastapi import APIRouter, Depends
-from app.middleware.auth_middleware import get_current_user
-from app.models.user import User
+from app.middleware.auth_middleware import get_current_principal
+from app.services.principal_cache import Principal
 from app.redis_client import get_user_stats
-from app.schemas.stats import StatsResponse
+from app.schemas.stats import StatsResponse, ConnectionSlotsResponse
+from app.services.connection_slots import connection_slots
 
 router = APIRouter(prefix="/api", tags=["stats"])
 
 
 @router.get("/stats", response_model=StatsResponse)
 async def get_stats(
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_principal)
 ):
     """Получить статистику текущего пользователя"""
-    stats = get_user_stats(current_user.id)
+    stats = await get_user_stats(current_user.id)
     return StatsResponse.from_dict(stats)
+
+
+@router.get("/stats/connections", response_model=ConnectionSlotsResponse)
+async def get_connection_slots(
+    current_user: Principal = Depends(get_current_principal)
+):
+    """Получить число открытых соединений текущего пользователя"""
+    return await connection_slots.occupancy(current_user.id)
@@ -0,0 +1,34 @@
+"""
+Pydantic схемы для ограничения скорости
+"""
+from pydantic import BaseModel, Field
+from typing import Dict, Optional
+
+
+class BandwidthLimitSchema(BaseModel):
+    """Лимит скорости: байт/с (0 - без ограничения) и допустимый всплеск в байтах"""
+    rate: int = Field(..., ge=0)
+    burst: int = Field(0, ge=0)
+
+
+class BandwidthPlansResponse(BaseModel):
+    """Схема ответа со списком тарифов"""
+    default_plan: str
+    plans: Dict[str, BandwidthLimitSchema]
+
+
+class UserBandwidthUpdate(BaseModel):
+    """Схема для назначения тарифа или индивидуального лимита"""
+    plan: Optional[str] = None
+    rate: Optional[int] = Field(None, ge=0)
+    burst: Optional[int] = Field(None, ge=0)
+
+
+class UserBandwidthResponse(BaseModel):
+    """Схема ответа с лимитом скорости пользователя"""
+    user_id: int
+    plan: str
+    rate: Optional[int] = None
+    burst: Optional[int] = None
+    # Действующий лимит; None - без ограничения
+    effective: Optional[BandwidthLimitSchema] = None
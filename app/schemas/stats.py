@@ -22,3 +22,12 @@ class StatsResponse(BaseModel):
             requests=data.get("requests", 0),
             total_bytes=total
         )
+
+
+class ConnectionSlotsResponse(BaseModel):
+    """Схема ответа с занятыми слотами соединений пользователя"""
+    user_id: int
+    limit: int
+    active: Optional[int]
+    worker_active: int
+    worker_queued: int
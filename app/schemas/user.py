@@ -36,6 +36,11 @@ class UserUpdate(BaseModel):
     username: Optional[str] = Field(None, min_length=3, max_length=100)
 
 
+class AdminUserUpdate(UserUpdate):
+    """Схема для обновления пользователя администратором"""
+    is_active: Optional[bool] = None
+
+
 class UserLogin(BaseModel):
     """Схема для входа"""
     email: EmailStr
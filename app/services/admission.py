@@ -0,0 +1,38 @@
+"""
+Контроль допуска прокси-запросов при перегрузке
+
+Если воркер не успевает, новые запросы только удлиняют очереди и
+увеличивают задержку остальных. Запрос к /proxy или к forward-прокси
+отклоняется сразу (503 с Retry-After), если в воркере уже
+admission_max_in_flight прокси-запросов, задержка event loop выше
+admission_max_loop_lag_ms или в пуле соединений к upstream ждут больше
+admission_max_pool_queue запросов. Остальные маршруты (авторизация,
+админка, /health, /metrics) не ограничиваются.
+"""
+from typing import Optional
+
+from app import http_client
+from app.config import settings
+from app.services.loop_monitor import loop_monitor
+
+
+class AdmissionController:
+    """Решение о допуске прокси-запроса по состоянию воркера"""
+
+    def __init__(self):
+        self.in_flight = 0
+
+    def rejection_reason(self) -> Optional[str]:
+        """Причина отказа или None, если запрос можно принять"""
+        if 0 < settings.admission_max_in_flight <= self.in_flight:
+            return "in_flight"
+        if 0 < settings.admission_max_loop_lag_ms <= loop_monitor.lag * 1000:
+            return "loop_lag"
+        transport = http_client.upstream_transport
+        if transport is not None and 0 < settings.admission_max_pool_queue <= transport.waiting:
+            return "pool_queue"
+        return None
+
+
+# Контроль допуска воркера
+admission_controller = AdmissionController()
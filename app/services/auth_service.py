@@ -1,29 +1,69 @@
 """
 Сервис авторизации
 """
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException, status
 from app.models.user import User
 from app.models.session import Session as SessionModel
 from app.schemas.user import UserCreate, UserLogin
 from app.utils.security import (
-    verify_password, get_password_hash, create_access_token,
-    create_refresh_token, decode_token, generate_session_id
+    create_access_token, create_refresh_token, decode_token,
+    generate_session_id, token_digest
 )
-from app.redis_client import cache_token, cache_session, get_user_sessions
+from app.redis_client import (
+    cache_token, cache_session, update_cached_session, get_session_by_refresh_digest,
+    get_cached_user_sessions, mark_user_sessions_cached, revoke_token,
+    delete_session as delete_cached_session
+)
+from app.services.principal_cache import principal_cache
+from app.services.password_hasher import password_hasher
+from app.services.write_behind import write_behind
 from app.config import settings
 
 
+def _utc(value: datetime) -> datetime:
+    # Значения без часового пояса записаны как UTC
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def _session_cache_data(session: SessionModel) -> dict:
+    """Данные сессии для Redis (поля SessionResponse и владелец)"""
+    return {
+        "id": session.id,
+        "user_id": session.user_id,
+        "session_id": session.session_id,
+        "refresh_token_hash": session.refresh_token_hash,
+        "ip_address": session.ip_address,
+        "user_agent": session.user_agent,
+        "created_at": _utc(session.created_at).isoformat(),
+        "expires_at": _utc(session.expires_at).isoformat(),
+        "last_activity": _utc(session.last_activity).isoformat(),
+    }
+
+
+def _expires_in(data: dict, now: datetime) -> int:
+    return int((datetime.fromisoformat(data["expires_at"]) - now).total_seconds())
+
+
+async def _cache_session(data: dict, now: datetime, only_if_missing: bool = False):
+    await cache_session(
+        data["session_id"], data["user_id"], data, _expires_in(data, now),
+        data["refresh_token_hash"], only_if_missing
+    )
+
+
 class AuthService:
     """Сервис для работы с авторизацией"""
     
     @staticmethod
-    def register_user(db: Session, user_data: UserCreate) -> User:
+    async def register_user(db: AsyncSession, user_data: UserCreate) -> User:
         """Регистрация нового пользователя"""
         # Проверяем, существует ли пользователь с таким email
-        existing_user = db.query(User).filter(User.email == user_data.email).first()
+        existing_user = await db.scalar(select(User).where(User.email == user_data.email))
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -31,7 +71,7 @@ class AuthService:
             )
         
         # Проверяем, существует ли пользователь с таким username
-        existing_username = db.query(User).filter(User.username == user_data.username).first()
+        existing_username = await db.scalar(select(User).where(User.username == user_data.username))
         if existing_username:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -39,7 +79,7 @@ class AuthService:
             )
         
         # Создаем нового пользователя
-        hashed_password = get_password_hash(user_data.password)
+        hashed_password = await password_hasher.hash(user_data.password)
         new_user = User(
             email=user_data.email,
             username=user_data.username,
@@ -49,16 +89,16 @@ class AuthService:
         )
         
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         
         return new_user
     
     @staticmethod
-    def authenticate_user(db: Session, user_data: UserLogin, ip_address: Optional[str] = None, user_agent: Optional[str] = None) -> tuple[User, str, str]:
+    async def authenticate_user(db: AsyncSession, user_data: UserLogin, ip_address: Optional[str] = None, user_agent: Optional[str] = None) -> tuple[User, str, str]:
         """Аутентификация пользователя"""
         # Находим пользователя по email
-        user = db.query(User).filter(User.email == user_data.email).first()
+        user = await db.scalar(select(User).where(User.email == user_data.email))
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -66,7 +106,7 @@ class AuthService:
             )
         
         # Проверяем пароль
-        if not verify_password(user_data.password, user.hashed_password):
+        if not await password_hasher.verify(user_data.password, user.hashed_password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Неверный email или пароль"
@@ -79,49 +119,50 @@ class AuthService:
                 detail="Пользователь неактивен"
             )
         
-        # Обновляем время последнего входа
-        user.last_login = datetime.utcnow()
-        db.commit()
-        
         # Создаем токены
+        session_id = generate_session_id()
         access_token_data = {"sub": str(user.id), "email": user.email}
         access_token = create_access_token(access_token_data)
-        refresh_token = create_refresh_token(access_token_data)
+        # sid делает refresh токен уникальным, даже если вход выполнен дважды в одну секунду
+        refresh_token = create_refresh_token({**access_token_data, "sid": session_id})
         
         # Кэшируем токен
-        cache_token(access_token, user.id, settings.access_token_expire_minutes)
-        
-        # Создаем сессию
-        session_id = generate_session_id()
-        expires_at = datetime.utcnow() + timedelta(days=settings.refresh_token_expire_days)
+        await cache_token(access_token, user.id, settings.access_token_expire_minutes)
         
+        # Создаем сессию (единственный commit при входе); в БД хранится только хэш refresh токена
+        now = datetime.now(timezone.utc)
         session = SessionModel(
             user_id=user.id,
             session_id=session_id,
-            refresh_token=refresh_token,
+            refresh_token_hash=token_digest(refresh_token),
             ip_address=ip_address,
             user_agent=user_agent,
-            expires_at=expires_at
+            created_at=now,
+            last_activity=now,
+            expires_at=now + timedelta(days=settings.refresh_token_expire_days)
         )
         db.add(session)
-        db.commit()
+        await db.commit()
+        
+        # Время последнего входа записывается отложенной пакетной записью
+        write_behind.touch_user_login(user.id, now)
         
         # Кэшируем сессию в Redis
-        cache_session(
-            session_id,
-            user.id,
-            {
-                "refresh_token": refresh_token,
-                "ip_address": ip_address,
-                "user_agent": user_agent
-            },
-            settings.refresh_token_expire_days
-        )
+        await _cache_session(_session_cache_data(session), now)
         
         return user, access_token, refresh_token
     
     @staticmethod
-    def refresh_access_token(db: Session, refresh_token: str) -> tuple[str, str]:
+    async def logout(access_token: str):
+        """Выход: отозвать access токен во всех воркерах"""
+        payload = decode_token(access_token)
+        expires_in = int(payload["exp"] - time.time()) if payload else 0
+        digest = token_digest(access_token)
+        await revoke_token(access_token, digest, expires_in)
+        await principal_cache.invalidate_token(digest)
+    
+    @staticmethod
+    async def refresh_access_token(db: AsyncSession, refresh_token: str) -> tuple[str, str]:
         """Обновление access токена"""
         # Декодируем refresh токен
         payload = decode_token(refresh_token)
@@ -132,21 +173,28 @@ class AuthService:
             )
         
         user_id = int(payload.get("sub"))
-        user = db.query(User).filter(User.id == user_id).first()
+        user = await db.get(User, user_id)
         if not user or not user.is_active:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Пользователь не найден или неактивен"
             )
         
-        # Проверяем, существует ли сессия с таким refresh токеном
-        session = db.query(SessionModel).filter(
-            SessionModel.refresh_token == refresh_token,
-            SessionModel.user_id == user_id,
-            SessionModel.expires_at > datetime.utcnow()
-        ).first()
+        # Проверяем, существует ли сессия с таким refresh токеном: сначала в Redis, затем по индексу хэша
+        digest = token_digest(refresh_token)
+        now = datetime.now(timezone.utc)
+        session = await get_session_by_refresh_digest(digest)
+        if session is None:
+            db_session = await db.scalar(select(SessionModel).where(
+                SessionModel.refresh_token_hash == digest,
+                SessionModel.user_id == user_id,
+                SessionModel.expires_at > now
+            ))
+            if db_session is not None:
+                session = _session_cache_data(db_session)
+                await _cache_session(session, now)
         
-        if not session:
+        if not session or session["user_id"] != user_id or _expires_in(session, now) <= 0:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Сессия не найдена или истекла"
@@ -157,43 +205,56 @@ class AuthService:
         new_access_token = create_access_token(access_token_data)
         
         # Кэшируем новый токен
-        cache_token(new_access_token, user.id, settings.access_token_expire_minutes)
+        await cache_token(new_access_token, user.id, settings.access_token_expire_minutes)
         
-        # Обновляем время последней активности
-        session.last_activity = datetime.utcnow()
-        db.commit()
+        # Обновляем время последней активности (в БД - отложенной пакетной записью)
+        session["last_activity"] = now.isoformat()
+        await update_cached_session(session["session_id"], session)
+        write_behind.touch_session(session["id"], now)
         
         return new_access_token, refresh_token
     
     @staticmethod
-    def get_user_by_id(db: Session, user_id: int) -> Optional[User]:
+    async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[User]:
         """Получить пользователя по ID"""
-        return db.query(User).filter(User.id == user_id).first()
+        return await db.get(User, user_id)
     
     @staticmethod
-    def get_user_sessions(db: Session, user_id: int) -> list[SessionModel]:
-        """Получить все сессии пользователя"""
-        return db.query(SessionModel).filter(
-            SessionModel.user_id == user_id,
-            SessionModel.expires_at > datetime.utcnow()
-        ).all()
+    async def get_user_sessions(db: AsyncSession, user_id: int) -> list[dict]:
+        """Получить все сессии пользователя (из Redis, при отсутствии кэша - из БД)"""
+        now = datetime.now(timezone.utc)
+        cached = await get_cached_user_sessions(user_id)
+        # Записи старого формата (без id) не содержат всех полей ответа
+        if cached is not None and all("id" in data for data in cached):
+            sessions = [data for data in cached if _expires_in(data, now) > 0]
+        else:
+            result = await db.scalars(select(SessionModel).where(
+                SessionModel.user_id == user_id,
+                SessionModel.expires_at > now
+            ))
+            sessions = [_session_cache_data(session) for session in result]
+            for data in sessions:
+                # last_activity в Redis может быть новее еще не записанного в БД
+                await _cache_session(data, now, only_if_missing=True)
+            # Новые сессии добавляются в кэш при входе, поэтому он остается полным
+            await mark_user_sessions_cached(user_id, settings.refresh_token_expire_days * 24 * 60 * 60)
+        return sorted(sessions, key=lambda data: data["created_at"])
     
     @staticmethod
-    def delete_session(db: Session, session_id: str, user_id: int) -> bool:
+    async def delete_session(db: AsyncSession, session_id: str, user_id: int) -> bool:
         """Удалить сессию"""
-        session = db.query(SessionModel).filter(
+        session = await db.scalar(select(SessionModel).where(
             SessionModel.session_id == session_id,
             SessionModel.user_id == user_id
-        ).first()
+        ))
         
         if not session:
             return False
         
-        db.delete(session)
-        db.commit()
+        await db.delete(session)
+        await db.commit()
         
         # Удаляем из Redis
-        from app.redis_client import delete_session
-        delete_session(session_id, user_id)
+        await delete_cached_session(session_id, user_id, session.refresh_token_hash)
         
         return True
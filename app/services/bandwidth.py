@@ -0,0 +1,160 @@
+"""
+Ограничение скорости передачи данных пользователя (token bucket)
+
+Лимит задается тарифом или индивидуально и хранится в Redis, поэтому
+администратор меняет его без перезапуска. Bucket пользователя общий для
+всех воркеров: воркер берет из него токены небольшими порциями и расходует
+их локально, чтобы не обращаться к Redis на каждый чанк.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from app.config import settings
+from app.metrics import BANDWIDTH_THROTTLE_SECONDS
+from app.redis_client import get_bandwidth_config, take_bandwidth_tokens
+
+logger = logging.getLogger(__name__)
+
+# Направления передачи: от клиента к upstream и обратно
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+# Порция токенов, которую воркер берет из Redis: трафик за 50 мс, но не меньше 16KB
+_LEASE_SECONDS = 0.05
+_MIN_LEASE_BYTES = 16 * 1024
+# Максимальная пауза, чтобы изменение лимита применялось быстро
+_MAX_SLEEP = 1.0
+_MAX_BUCKETS = 10000
+
+
+class BandwidthLimit:
+    """Скорость (байт/с) и допустимый всплеск (байт)"""
+
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, rate: int, burst: int = 0):
+        self.rate = rate
+        # По умолчанию всплеск равен секунде трафика
+        self.burst = burst if burst > 0 else rate
+
+    def to_dict(self) -> dict:
+        return {"rate": self.rate, "burst": self.burst}
+
+
+def resolve_limit(user_data: Optional[dict], plans: dict) -> Optional[BandwidthLimit]:
+    """Лимит пользователя: индивидуальный, затем тариф, затем тариф по умолчанию"""
+    if user_data and user_data.get("rate") is not None:
+        limit = user_data
+    else:
+        plan = (user_data or {}).get("plan") or settings.bandwidth_default_plan
+        limit = plans.get(plan)
+        if limit is None:
+            limit = {"rate": settings.bandwidth_default_rate, "burst": settings.bandwidth_default_burst}
+    if not limit.get("rate"):
+        return None
+    return BandwidthLimit(int(limit["rate"]), int(limit.get("burst") or 0))
+
+
+class _Bucket:
+    """Токены одного пользователя и направления, полученные воркером"""
+
+    __slots__ = ("tokens", "updated", "lock")
+
+    def __init__(self):
+        self.tokens = 0.0
+        # Время последнего пополнения при локальном учете (без Redis)
+        self.updated: Optional[float] = None
+        self.lock = asyncio.Lock()
+
+
+class BandwidthShaper:
+    """Ограничитель скорости воркера"""
+
+    def __init__(self):
+        self._limits: dict[int, tuple[float, Optional[BandwidthLimit]]] = {}
+        self._buckets: dict[tuple[int, str], _Bucket] = {}
+
+    async def get_limit(self, user_id: int) -> Optional[BandwidthLimit]:
+        """Текущий лимит пользователя (настройки из Redis кэшируются на bandwidth_config_ttl)"""
+        now = time.monotonic()
+        cached = self._limits.get(user_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        try:
+            user_data, plans = await get_bandwidth_config(user_id)
+        except Exception as e:
+            logger.warning(f"Bandwidth config Redis error: {e}")
+            user_data, plans = None, {}
+        limit = resolve_limit(user_data, plans)
+        if len(self._limits) >= _MAX_BUCKETS:
+            self._limits.clear()
+        self._limits[user_id] = (now + settings.bandwidth_config_ttl, limit)
+        return limit
+
+    def _bucket(self, user_id: int, direction: str) -> _Bucket:
+        key = (user_id, direction)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= _MAX_BUCKETS:
+                # Неиспользуемые bucket пересоздаются без потери чего-либо, кроме мелкого остатка токенов
+                for stale in [k for k, b in self._buckets.items() if not b.lock.locked()]:
+                    del self._buckets[stale]
+            bucket = self._buckets[key] = _Bucket()
+        return bucket
+
+    @staticmethod
+    async def _take(user_id: int, direction: str, bucket: _Bucket, limit: BandwidthLimit, requested: int) -> tuple[int, float]:
+        try:
+            return await take_bandwidth_tokens(user_id, direction, limit.rate, limit.burst, requested)
+        except Exception as e:
+            # Без Redis скорость ограничивается в пределах воркера
+            logger.warning(f"Bandwidth Redis error: {e}")
+            now = time.monotonic()
+            if bucket.updated is None:
+                available = limit.burst
+            else:
+                available = min(limit.burst, (now - bucket.updated) * limit.rate)
+            bucket.updated = now
+            granted = min(requested, int(available))
+            return granted, (requested - granted) / limit.rate
+
+    async def consume(self, user_id: int, direction: str, size: int):
+        """Дождаться разрешения передать size байт"""
+        limit = await self.get_limit(user_id)
+        if limit is None or size <= 0:
+            return
+        bucket = self._bucket(user_id, direction)
+        # Потоки одного пользователя получают токены по очереди
+        async with bucket.lock:
+            waited = 0.0
+            while size > 0:
+                if bucket.tokens >= 1:
+                    taken = min(size, int(bucket.tokens))
+                    bucket.tokens -= taken
+                    size -= taken
+                    continue
+                lease = max(_MIN_LEASE_BYTES, int(limit.rate * _LEASE_SECONDS))
+                granted, wait = await self._take(user_id, direction, bucket, limit, min(max(size, lease), limit.burst))
+                bucket.tokens += granted
+                if not granted:
+                    delay = min(max(wait, 0.001), _MAX_SLEEP)
+                    waited += delay
+                    await asyncio.sleep(delay)
+                    limit = await self.get_limit(user_id)
+                    if limit is None:
+                        break
+            if waited:
+                BANDWIDTH_THROTTLE_SECONDS.labels(direction=direction).inc(waited)
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Сбросить кэш лимитов (после изменения настроек в этом воркере)"""
+        if user_id is None:
+            self._limits.clear()
+        else:
+            self._limits.pop(user_id, None)
+
+
+# Ограничитель воркера
+bandwidth_shaper = BandwidthShaper()
@@ -0,0 +1,241 @@
+"""
+Объединение одинаковых одновременных запросов к upstream (single-flight)
+
+Одновременные идентичные GET/HEAD запросы выполняются одним запросом к
+upstream, тело ответа раздается всем ожидающим по мере получения.
+"""
+import asyncio
+import hashlib
+import itertools
+import logging
+import time
+from typing import Optional
+
+import httpx
+
+from app.config import settings
+from app.metrics import COALESCED_REQUESTS
+from app.services.http_cache import http_cache, response_headers_for_cache
+from app.utils.content_encoding import iter_body
+
+logger = logging.getLogger(__name__)
+
+# Заголовки запроса, от которых ответ зависит чаще всего (типичные значения Vary)
+KEY_HEADERS = ("accept", "accept-encoding", "accept-language", "cookie")
+
+
+class Flight:
+    """Один запрос к upstream, разделяемый несколькими клиентами"""
+
+    def __init__(self, coalescer: "RequestCoalescer", key: str, request: httpx.Request):
+        self._coalescer = coalescer
+        self.key = key
+        self.request = request
+        self.response: Optional[httpx.Response] = None
+        self.error: Optional[BaseException] = None
+        self.shareable = False
+        self.headers_ready = asyncio.Event()
+        self.request_time = 0.0
+        self.response_time = 0.0
+
+        # Буфер чанков, еще не прочитанных самым медленным получателем
+        self._chunks: list[bytes] = []
+        self._offset = 0
+        self._buffered = 0
+        self._done = False
+        # Получатель -> номер следующего чанка
+        self._positions: dict[int, int] = {}
+        self._ids = itertools.count()
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def joinable(self) -> bool:
+        """Можно ли присоединиться: тело еще не начали отбрасывать"""
+        if self.headers_ready.is_set() and (self.error or not self.shareable):
+            return False
+        return self._offset == 0 and not self._done
+
+    def join(self) -> int:
+        consumer = next(self._ids)
+        self._positions[consumer] = self._offset
+        return consumer
+
+    async def leave(self, consumer: int):
+        async with self._changed:
+            self._positions.pop(consumer, None)
+            self._trim()
+            self._changed.notify_all()
+
+    def matches(self, request: httpx.Request) -> bool:
+        """Совпадают ли заголовки из Vary ответа у запроса и у лидера"""
+        vary_names = http_cache.vary_names(self.response)
+        return (
+            http_cache.request_vary(vary_names, request.headers)
+            == http_cache.request_vary(vary_names, self.request.headers)
+        )
+
+    def start(self, client: httpx.AsyncClient):
+        self._task = asyncio.create_task(self._pump(client))
+
+    def _trim(self):
+        """Отбросить чанки, прочитанные всеми получателями"""
+        if not self._positions:
+            return
+        lowest = min(self._positions.values())
+        drop = lowest - self._offset
+        if drop <= 0:
+            return
+        for chunk in self._chunks[:drop]:
+            self._buffered -= len(chunk)
+        del self._chunks[:drop]
+        self._offset = lowest
+        # Новые получатели уже не смогут прочитать тело с начала
+        self._coalescer.forget(self)
+
+    async def _pump(self, client: httpx.AsyncClient):
+        """Читать ответ upstream в общий буфер"""
+        response = None
+        captured = None
+        try:
+            self.request_time = time.time()
+            response = await client.send(self.request, stream=True)
+            self.response_time = time.time()
+            self.response = response
+            self.shareable = http_cache.is_shareable(self.request, response)
+            storable = http_cache.is_storable(self.request, response)
+            self.headers_ready.set()
+            if not self.shareable:
+                self._coalescer.forget(self)
+            if storable:
+                captured = bytearray()
+
+            async for chunk in iter_body(response, chunk_size=settings.proxy_stream_chunk_size):
+                async with self._changed:
+                    # Ждем самого медленного получателя, если буфер заполнен
+                    while self._positions and self._buffered >= settings.proxy_coalesce_window_bytes:
+                        await self._changed.wait()
+                    if not self._positions:
+                        # Все получатели отключились
+                        return
+                    self._chunks.append(chunk)
+                    self._buffered += len(chunk)
+                    self._changed.notify_all()
+                if captured is not None:
+                    if len(captured) + len(chunk) > settings.proxy_cache_max_object_bytes:
+                        captured = None
+                    else:
+                        captured.extend(chunk)
+
+            if captured is not None:
+                await http_cache.put(http_cache.make_entry(
+                    self.request,
+                    response,
+                    response_headers_for_cache(response),
+                    bytes(captured),
+                    self.request_time,
+                    self.response_time
+                ))
+        except Exception as e:
+            # После заголовков ошибка передается получателям, когда они дочитают буфер
+            self.error = e
+            if self.headers_ready.is_set():
+                logger.warning(f"Upstream stream error: {e}")
+            else:
+                self.headers_ready.set()
+        finally:
+            self._coalescer.forget(self)
+            async with self._changed:
+                self._done = True
+                self._changed.notify_all()
+            if response is not None:
+                await response.aclose()
+
+    async def iterate(self, consumer: int):
+        """Тело ответа для одного получателя"""
+        while True:
+            async with self._changed:
+                while (
+                    self._positions[consumer] >= self._offset + len(self._chunks)
+                    and not self._done
+                ):
+                    await self._changed.wait()
+                position = self._positions[consumer]
+                if position >= self._offset + len(self._chunks):
+                    if self.error is not None:
+                        # Тело усечено: соединение клиента будет оборвано
+                        raise self.error
+                    return
+                chunk = self._chunks[position - self._offset]
+                self._positions[consumer] = position + 1
+                self._trim()
+                self._changed.notify_all()
+            yield chunk
+
+
+class RequestCoalescer:
+    """Реестр запросов к upstream, выполняющихся в данный момент"""
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return settings.proxy_coalesce_enabled
+
+    @staticmethod
+    def key(request: httpx.Request) -> str:
+        parts = [request.method, str(request.url)]
+        parts += [f"{name}:{', '.join(request.headers.get_list(name))}" for name in KEY_HEADERS]
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def forget(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    @staticmethod
+    async def _wait_headers(flight: Flight, consumer: int):
+        try:
+            await flight.headers_ready.wait()
+        except BaseException:
+            # Клиент отключился, не дождавшись ответа
+            await flight.leave(consumer)
+            raise
+
+    async def join(self, client: httpx.AsyncClient, request: httpx.Request) -> tuple[Optional[Flight], int]:
+        """
+        Выполнить запрос или присоединиться к уже выполняющемуся.
+
+        Возвращает (None, 0), если ответ лидера нельзя разделить с этим
+        запросом, и тогда запрос выполняется отдельно.
+        """
+        key = self.key(request)
+        flight = self._flights.get(key)
+        if flight is not None and flight.joinable:
+            consumer = flight.join()
+            await self._wait_headers(flight, consumer)
+            if flight.error is not None:
+                await flight.leave(consumer)
+                COALESCED_REQUESTS.labels(role="follower").inc()
+                raise flight.error
+            if not flight.shareable or not flight.matches(request):
+                await flight.leave(consumer)
+                COALESCED_REQUESTS.labels(role="fallback").inc()
+                return None, 0
+            COALESCED_REQUESTS.labels(role="follower").inc()
+            return flight, consumer
+
+        flight = Flight(self, key, request)
+        self._flights[key] = flight
+        consumer = flight.join()
+        flight.start(client)
+        COALESCED_REQUESTS.labels(role="leader").inc()
+        await self._wait_headers(flight, consumer)
+        if flight.error is not None:
+            await flight.leave(consumer)
+            raise flight.error
+        return flight, consumer
+
+
+# Реестр воркера
+request_coalescer = RequestCoalescer()
@@ -0,0 +1,205 @@
+"""
+Ограничение одновременных соединений пользователя (proxy_max_connections_per_user)
+
+Слоты общие для всех воркеров: каждая аренда хранится в Redis со сроком,
+который воркер продлевает, пока соединение открыто. Запросы сверх лимита
+ждут свободного слота в очереди воркера в порядке поступления.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+from app.config import settings
+from app.metrics import USER_SLOT_REQUESTS, USER_SLOT_WAIT_SECONDS, USER_SLOTS_HELD, USER_SLOTS_QUEUED
+from app.redis_client import (
+    acquire_connection_slot, refresh_connection_slots,
+    release_connection_slot, count_connection_slots
+)
+
+logger = logging.getLogger(__name__)
+
+# Как часто первый в очереди проверяет слоты, освобожденные другими воркерами
+_POLL_INTERVAL = 0.1
+
+
+class ConnectionLimitExceeded(Exception):
+    """Слот не получен: очередь пользователя заполнена или истекло время ожидания"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SlotLease:
+    """Занятый слот соединения; release() можно вызывать повторно"""
+
+    def __init__(self, slots: Optional["ConnectionSlots"], user_id: int, lease_id: str, local: bool):
+        self._slots = slots
+        self.user_id = user_id
+        self.lease_id = lease_id
+        # Слот учтен только в воркере, потому что Redis был недоступен
+        self.local = local
+        self._released = False
+
+    async def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._slots is not None:
+            await self._slots._release(self)
+
+
+class ConnectionSlots:
+    """Слоты соединений пользователей и очереди ожидания воркера"""
+
+    def __init__(self):
+        self._leases: dict[str, SlotLease] = {}
+        self._queues: dict[int, deque] = {}
+        # Слоты, учтенные локально при недоступности Redis
+        self._local_counts: dict[int, int] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.proxy_max_connections_per_user > 0
+
+    async def _try_acquire(self, user_id: int, lease_id: str) -> Optional[SlotLease]:
+        limit = settings.proxy_max_connections_per_user
+        try:
+            acquired = await acquire_connection_slot(user_id, lease_id, limit, settings.proxy_user_slot_ttl)
+            local = False
+        except Exception as e:
+            # Без Redis лимит соблюдается хотя бы в пределах воркера
+            logger.warning(f"Connection slots Redis error: {e}")
+            acquired = self._local_counts.get(user_id, 0) < limit
+            local = True
+            if acquired:
+                self._local_counts[user_id] = self._local_counts.get(user_id, 0) + 1
+        if not acquired:
+            return None
+        lease = SlotLease(self, user_id, lease_id, local)
+        self._leases[lease_id] = lease
+        USER_SLOTS_HELD.inc()
+        return lease
+
+    async def _release(self, lease: SlotLease):
+        # Учет воркера обновляется до первого await: при обрыве соединения
+        # клиентом освобождение может быть отменено
+        self._leases.pop(lease.lease_id, None)
+        USER_SLOTS_HELD.dec()
+        if lease.local:
+            self._local_counts[lease.user_id] -= 1
+            if self._local_counts[lease.user_id] <= 0:
+                del self._local_counts[lease.user_id]
+        self._wake(lease.user_id)
+        if not lease.local:
+            # Отмена вызывающей задачи не прерывает удаление аренды из Redis
+            await asyncio.shield(self._release_remote(lease))
+
+    @staticmethod
+    async def _release_remote(lease: SlotLease):
+        try:
+            await release_connection_slot(lease.user_id, lease.lease_id)
+        except Exception as e:
+            # Аренда истечет сама через proxy_user_slot_ttl
+            logger.warning(f"Connection slots Redis error: {e}")
+
+    def _wake(self, user_id: int):
+        queue = self._queues.get(user_id)
+        if queue:
+            queue[0].set()
+
+    async def acquire(self, user_id: int) -> SlotLease:
+        """Занять слот пользователя, при необходимости дождавшись очереди"""
+        lease_id = uuid.uuid4().hex
+        if not self.enabled:
+            return SlotLease(None, user_id, lease_id, local=True)
+        queue = self._queues.get(user_id)
+        if not queue:
+            lease = await self._try_acquire(user_id, lease_id)
+            if lease is not None:
+                USER_SLOT_REQUESTS.labels(result="acquired").inc()
+                return lease
+
+        queue = self._queues.setdefault(user_id, deque())
+        if len(queue) >= settings.proxy_user_queue_size:
+            USER_SLOT_REQUESTS.labels(result="rejected").inc()
+            raise ConnectionLimitExceeded("Слишком много одновременных соединений", retry_after=1)
+
+        waiter = asyncio.Event()
+        queue.append(waiter)
+        USER_SLOTS_QUEUED.inc()
+        started = time.monotonic()
+        deadline = started + settings.proxy_user_queue_timeout
+        try:
+            while True:
+                # Слот пробует занять только первый в очереди, остальные ждут своей очереди
+                if queue[0] is waiter:
+                    lease = await self._try_acquire(user_id, lease_id)
+                    if lease is not None:
+                        USER_SLOT_REQUESTS.labels(result="queued").inc()
+                        USER_SLOT_WAIT_SECONDS.observe(time.monotonic() - started)
+                        return lease
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    USER_SLOT_REQUESTS.labels(result="timeout").inc()
+                    raise ConnectionLimitExceeded(
+                        "Превышено время ожидания свободного соединения",
+                        retry_after=max(1, int(settings.proxy_user_queue_timeout))
+                    )
+                waiter.clear()
+                try:
+                    await asyncio.wait_for(waiter.wait(), timeout=min(_POLL_INTERVAL, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            USER_SLOTS_QUEUED.dec()
+            queue.remove(waiter)
+            if not queue:
+                self._queues.pop(user_id, None)
+            else:
+                self._wake(user_id)
+
+    async def occupancy(self, user_id: int) -> dict:
+        """Занятые слоты пользователя во всех воркерах и очередь этого воркера"""
+        try:
+            active = await count_connection_slots(user_id)
+        except Exception as e:
+            logger.warning(f"Connection slots Redis error: {e}")
+            active = None
+        return {
+            "user_id": user_id,
+            "limit": settings.proxy_max_connections_per_user,
+            "active": active,
+            "worker_active": sum(1 for lease in self._leases.values() if lease.user_id == user_id),
+            "worker_queued": len(self._queues.get(user_id, ())),
+        }
+
+    async def _heartbeat(self):
+        """Продлевать аренды, пока соединения открыты"""
+        while True:
+            await asyncio.sleep(settings.proxy_user_slot_ttl / 3)
+            leases = [(l.user_id, l.lease_id) for l in self._leases.values() if not l.local]
+            if not leases:
+                continue
+            try:
+                await refresh_connection_slots(leases, settings.proxy_user_slot_ttl)
+            except Exception as e:
+                logger.warning(f"Connection slots heartbeat failed: {e}")
+
+    def start(self):
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+
+
+# Слоты воркера
+connection_slots = ConnectionSlots()
@@ -0,0 +1,565 @@
+"""
+Общий HTTP-кэш ответов upstream (RFC 9111)
+
+Кэшируются ответы на GET-запросы, HEAD обслуживается из записей GET.
+Хранилище двухуровневое: ограниченный LRU в памяти воркера и
+опциональный общий для всех воркеров уровень в Redis.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+from fastapi import Response
+
+from app.config import settings
+from app.metrics import CACHE_REVALIDATIONS, CACHE_MEMORY_BYTES
+from app.redis_client import (
+    get_cached_http_entry, cache_http_entry,
+    get_cached_http_vary, invalidate_http_entries
+)
+from app.utils.content_encoding import iter_body
+
+logger = logging.getLogger(__name__)
+
+# Статусы, которые можно кэшировать эвристически (RFC 9110, 15.1)
+HEURISTICALLY_CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+# Верхняя граница эвристического срока свежести
+HEURISTIC_MAX_LIFETIME = 86400
+
+# Заголовки, которые не обновляются ответом 304 (RFC 9111, 3.2)
+_NOT_UPDATED_BY_304 = {"content-length", "content-encoding", "content-type", "content-range"}
+
+# Заголовки, передаваемые в ответе 304 клиенту (RFC 9110, 15.4.5)
+_NOT_MODIFIED_HEADERS = {"cache-control", "content-location", "date", "etag", "expires", "vary"}
+
+
+def parse_cache_control(value: Optional[str]) -> dict:
+    """Разобрать заголовок Cache-Control в словарь директив"""
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, arg = part.partition("=")
+        name = name.strip().lower()
+        arg = arg.strip().strip('"')
+        directives[name] = arg if arg else True
+    return directives
+
+
+def parse_seconds(value) -> Optional[int]:
+    """Значение директивы в секундах (delta-seconds)"""
+    if value is True or value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return None
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    """Разобрать HTTP-дату в timestamp"""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def request_cache_control(headers: httpx.Headers) -> dict:
+    """Директивы Cache-Control запроса с учетом Pragma: no-cache"""
+    cc = parse_cache_control(", ".join(headers.get_list("cache-control")))
+    if not cc and "no-cache" in headers.get("pragma", "").lower():
+        cc["no-cache"] = True
+    return cc
+
+
+class CacheEntry:
+    """Сохраненный ответ"""
+
+    __slots__ = (
+        "url", "status", "headers", "body", "request_time", "response_time", "vary", "_cc"
+    )
+
+    def __init__(
+        self,
+        url: str,
+        status: int,
+        headers: list,
+        body: bytes,
+        request_time: float,
+        response_time: float,
+        vary: dict
+    ):
+        self.url = url
+        self.status = status
+        # Список пар (имя в нижнем регистре, значение)
+        self.headers = headers
+        self.body = body
+        self.request_time = request_time
+        self.response_time = response_time
+        self.vary = vary
+        self._cc = None
+
+    def header(self, name: str) -> Optional[str]:
+        """Значение заголовка (повторяющиеся объединяются через запятую)"""
+        values = [v for k, v in self.headers if k == name]
+        return ", ".join(values) if values else None
+
+    @property
+    def cache_control(self) -> dict:
+        if self._cc is None:
+            self._cc = parse_cache_control(self.header("cache-control"))
+        return self._cc
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+    def has_validators(self) -> bool:
+        return self.header("etag") is not None or self.header("last-modified") is not None
+
+    def freshness_lifetime(self) -> float:
+        """Срок свежести ответа для общего кэша (RFC 9111, 4.2.1)"""
+        cc = self.cache_control
+        for directive in ("s-maxage", "max-age"):
+            seconds = parse_seconds(cc.get(directive))
+            if seconds is not None:
+                return seconds
+        date = parse_http_date(self.header("date")) or self.response_time
+        expires = self.header("expires")
+        if expires is not None:
+            expires_at = parse_http_date(expires)
+            # Некорректный Expires означает "уже истек"
+            return max(0.0, expires_at - date) if expires_at else 0.0
+        # Эвристика: 10% от времени с последнего изменения (RFC 9111, 4.2.2)
+        last_modified = parse_http_date(self.header("last-modified"))
+        if last_modified and self.status in HEURISTICALLY_CACHEABLE_STATUSES:
+            return min(HEURISTIC_MAX_LIFETIME, max(0.0, (date - last_modified) * 0.1))
+        return 0.0
+
+    def current_age(self, now: float) -> float:
+        """Текущий возраст ответа (RFC 9111, 4.2.3)"""
+        date = parse_http_date(self.header("date")) or self.response_time
+        age_value = parse_seconds(self.header("age")) or 0
+        apparent_age = max(0.0, self.response_time - date)
+        response_delay = self.response_time - self.request_time
+        corrected_initial_age = max(apparent_age, age_value + response_delay)
+        return corrected_initial_age + (now - self.response_time)
+
+    def stale_window(self, directive: str) -> int:
+        """Окно stale-while-revalidate / stale-if-error в секундах"""
+        return parse_seconds(self.cache_control.get(directive)) or 0
+
+    def may_serve_stale(self) -> bool:
+        """Можно ли отдавать ответ устаревшим"""
+        cc = self.cache_control
+        return not any(
+            d in cc for d in ("must-revalidate", "proxy-revalidate", "no-cache", "s-maxage")
+        )
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "url": self.url,
+            "status": self.status,
+            "headers": self.headers,
+            "body": base64.b64encode(self.body).decode("ascii"),
+            "request_time": self.request_time,
+            "response_time": self.response_time,
+            "vary": self.vary,
+        })
+
+    @classmethod
+    def from_json(cls, data: str) -> "CacheEntry":
+        raw = json.loads(data)
+        return cls(
+            url=raw["url"],
+            status=raw["status"],
+            headers=[tuple(h) for h in raw["headers"]],
+            body=base64.b64decode(raw["body"]),
+            request_time=raw["request_time"],
+            response_time=raw["response_time"],
+            vary=raw["vary"],
+        )
+
+
+class HttpCache:
+    """Общий кэш HTTP-ответов с LRU в памяти и опциональным уровнем в Redis"""
+
+    def __init__(self):
+        # Ключ -> CacheEntry либо список заголовков Vary для URL
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_bytes = 0
+        # Фоновые перепроверки, по одной на вариант ответа
+        self._revalidating: set = set()
+
+    @property
+    def enabled(self) -> bool:
+        return settings.proxy_cache_enabled
+
+    # Ключи
+
+    @staticmethod
+    def _url_key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def vary_names(response: httpx.Response) -> list:
+        """Имена заголовков из Vary ответа"""
+        return sorted({
+            name.strip().lower()
+            for name in response.headers.get("vary", "").split(",")
+            if name.strip()
+        })
+
+    @staticmethod
+    def request_vary(vary_names: list, headers: httpx.Headers) -> dict:
+        return {name: ", ".join(headers.get_list(name)) for name in vary_names}
+
+    @staticmethod
+    def _variant_key(url: str, vary: dict) -> str:
+        parts = [url] + [f"{name}:{vary[name]}" for name in sorted(vary)]
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    # Память
+
+    def _memory_get(self, key: str):
+        item = self._memory.get(key)
+        if item is not None:
+            self._memory.move_to_end(key)
+        return item
+
+    def _memory_put(self, key: str, value, size: int):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= self._item_size(old)
+        self._memory[key] = value
+        self._memory_bytes += size
+        while self._memory_bytes > settings.proxy_cache_max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= self._item_size(evicted)
+        CACHE_MEMORY_BYTES.set(self._memory_bytes)
+
+    def _memory_delete(self, key: str):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= self._item_size(old)
+            CACHE_MEMORY_BYTES.set(self._memory_bytes)
+
+    @staticmethod
+    def _item_size(item) -> int:
+        if isinstance(item, CacheEntry):
+            return item.size
+        return sum(len(name) for name in item)
+
+    # Правила кэширования
+
+    def is_request_cacheable(self, request: httpx.Request, has_body: bool) -> bool:
+        """Может ли запрос быть обслужен из кэша"""
+        if not self.enabled or has_body:
+            return False
+        if request.method not in ("GET", "HEAD"):
+            return False
+        if "range" in request.headers:
+            return False
+        return "no-store" not in request_cache_control(request.headers)
+
+    def is_shareable(self, request: httpx.Request, response: httpx.Response) -> bool:
+        """Может ли ответ быть отдан другим пользователям (RFC 9111, 3)"""
+        if response.status_code not in HEURISTICALLY_CACHEABLE_STATUSES:
+            return False
+        if "no-store" in request_cache_control(request.headers):
+            return False
+        cc = parse_cache_control(", ".join(response.headers.get_list("cache-control")))
+        if "no-store" in cc or "private" in cc:
+            return False
+        # Ответы с cookie не раздаем другим пользователям
+        if "set-cookie" in response.headers:
+            return False
+        vary = response.headers.get("vary", "")
+        if "*" in vary:
+            return False
+        # Запрос с авторизацией можно сохранить только при явном разрешении (RFC 9111, 3.5)
+        if "authorization" in request.headers:
+            if not ("public" in cc or "s-maxage" in cc or "must-revalidate" in cc):
+                return False
+        return (
+            "max-age" in cc
+            or "s-maxage" in cc
+            or "public" in cc
+            or "expires" in response.headers
+            or "last-modified" in response.headers
+            or "etag" in response.headers
+        )
+
+    def is_storable(self, request: httpx.Request, response: httpx.Response) -> bool:
+        """Можно ли сохранить ответ в общем кэше"""
+        if request.method != "GET" or not self.is_shareable(request, response):
+            return False
+        content_length = response.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) > settings.proxy_cache_max_object_bytes:
+                return False
+        return True
+
+    def is_fresh(self, entry: CacheEntry, request: httpx.Request, now: float) -> bool:
+        """Можно ли отдать запись без перепроверки"""
+        request_cc = request_cache_control(request.headers)
+        if "no-cache" in request_cc or "no-cache" in entry.cache_control:
+            return False
+        age = entry.current_age(now)
+        lifetime = entry.freshness_lifetime()
+        max_age = parse_seconds(request_cc.get("max-age"))
+        if max_age is not None and age > max_age:
+            return False
+        min_fresh = parse_seconds(request_cc.get("min-fresh")) or 0
+        return lifetime - age > min_fresh
+
+    def can_serve_while_revalidate(self, entry: CacheEntry, request: httpx.Request, now: float) -> bool:
+        """Можно ли отдать устаревшую запись, перепроверяя ее в фоне (RFC 5861)"""
+        if not entry.may_serve_stale() or "no-cache" in request_cache_control(request.headers):
+            return False
+        staleness = entry.current_age(now) - entry.freshness_lifetime()
+        return staleness <= entry.stale_window("stale-while-revalidate")
+
+    def can_serve_on_error(self, entry: CacheEntry, now: float) -> bool:
+        """Можно ли отдать устаревшую запись при ошибке upstream (RFC 5861)"""
+        if not entry.may_serve_stale():
+            return False
+        staleness = entry.current_age(now) - entry.freshness_lifetime()
+        return staleness <= entry.stale_window("stale-if-error")
+
+    @staticmethod
+    def conditional_headers(entry: CacheEntry) -> dict:
+        """Заголовки условного запроса для перепроверки записи"""
+        headers = {}
+        etag = entry.header("etag")
+        if etag:
+            headers["If-None-Match"] = etag
+        last_modified = entry.header("last-modified")
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    @staticmethod
+    def has_client_conditionals(headers) -> bool:
+        return "if-none-match" in headers or "if-modified-since" in headers
+
+    @staticmethod
+    def client_not_modified(entry: CacheEntry, headers) -> bool:
+        """Выполняются ли условия клиента для ответа 304 (RFC 9110, 13.2.2)"""
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            etag = entry.header("etag")
+            if not etag:
+                return False
+            if if_none_match.strip() == "*":
+                return True
+            # Слабое сравнение
+            def weak(tag: str) -> str:
+                return tag.strip().removeprefix("W/")
+            return weak(etag) in {weak(tag) for tag in if_none_match.split(",")}
+        since = parse_http_date(headers.get("if-modified-since"))
+        last_modified = parse_http_date(entry.header("last-modified"))
+        return since is not None and last_modified is not None and last_modified <= since
+
+    # Хранилище
+
+    async def get(self, request: httpx.Request) -> Optional[CacheEntry]:
+        """Найти запись для запроса"""
+        url = str(request.url)
+        url_key = self._url_key(url)
+
+        vary_names = self._memory_get("vary:" + url_key)
+        if vary_names is None and settings.proxy_cache_redis_enabled:
+            vary_names = await self._redis_call(get_cached_http_vary, url_key)
+        if vary_names is None:
+            return None
+
+        variant_key = self._variant_key(url, self.request_vary(vary_names, request.headers))
+        entry = self._memory_get(variant_key)
+        if entry is None and settings.proxy_cache_redis_enabled:
+            data = await self._redis_call(get_cached_http_entry, variant_key)
+            if data:
+                entry = CacheEntry.from_json(data)
+                # Поднимаем запись из Redis в память воркера
+                self._memory_put("vary:" + url_key, list(vary_names), self._item_size(vary_names))
+                self._memory_put(variant_key, entry, entry.size)
+        return entry
+
+    async def put(self, entry: CacheEntry):
+        """Сохранить запись"""
+        if len(entry.body) > settings.proxy_cache_max_object_bytes:
+            return
+        url_key = self._url_key(entry.url)
+        vary_names = sorted(entry.vary)
+        variant_key = self._variant_key(entry.url, entry.vary)
+        self._memory_put("vary:" + url_key, vary_names, self._item_size(vary_names))
+        self._memory_put(variant_key, entry, entry.size)
+
+        if settings.proxy_cache_redis_enabled:
+            # Устаревшие записи с валидаторами храним дольше для условных запросов
+            ttl = entry.freshness_lifetime() + max(
+                entry.stale_window("stale-while-revalidate"),
+                entry.stale_window("stale-if-error")
+            )
+            if entry.has_validators():
+                ttl += settings.proxy_cache_stale_retention
+            ttl = int(ttl)
+            if ttl > 0:
+                await self._redis_call(cache_http_entry, url_key, variant_key, vary_names, entry.to_json(), ttl)
+
+    async def invalidate(self, url: str):
+        """Удалить все варианты ответа для URL (RFC 9111, 4.4)"""
+        url_key = self._url_key(url)
+        vary_names = self._memory_get("vary:" + url_key)
+        self._memory_delete("vary:" + url_key)
+        if vary_names is not None:
+            # Варианты с другими значениями Vary вытеснит LRU
+            for key in [k for k, v in self._memory.items() if isinstance(v, CacheEntry) and v.url == url]:
+                self._memory_delete(key)
+        if settings.proxy_cache_redis_enabled:
+            await self._redis_call(invalidate_http_entries, url_key)
+
+    @staticmethod
+    async def _redis_call(func, *args):
+        """Уровень Redis необязателен: его ошибки не должны ломать запрос"""
+        try:
+            return await func(*args)
+        except Exception as e:
+            logger.warning(f"HTTP cache Redis error: {e}")
+            return None
+
+    def make_entry(
+        self,
+        request: httpx.Request,
+        response: httpx.Response,
+        headers: list,
+        body: bytes,
+        request_time: float,
+        response_time: float
+    ) -> CacheEntry:
+        """Создать запись по ответу upstream"""
+        vary_names = self.vary_names(response)
+        return CacheEntry(
+            url=str(request.url),
+            status=response.status_code,
+            headers=headers,
+            body=body,
+            request_time=request_time,
+            response_time=response_time,
+            vary=self.request_vary(vary_names, request.headers),
+        )
+
+    @staticmethod
+    def freshen(entry: CacheEntry, response: httpx.Response, request_time: float, response_time: float) -> CacheEntry:
+        """Обновить запись по ответу 304 (RFC 9111, 4.3.4)"""
+        updated = {name for name in response.headers.keys() if name not in _NOT_UPDATED_BY_304}
+        headers = [(k, v) for k, v in entry.headers if k not in updated]
+        headers.extend(
+            (k, v) for k, v in response.headers.multi_items() if k in updated
+        )
+        return CacheEntry(
+            url=entry.url,
+            status=entry.status,
+            headers=headers,
+            body=entry.body,
+            request_time=request_time,
+            response_time=response_time,
+            vary=entry.vary,
+        )
+
+    def to_response(self, entry: CacheEntry, method: str, client_headers, now: float, cache_status: str) -> Response:
+        """Ответ клиенту из записи кэша"""
+        if self.client_not_modified(entry, client_headers):
+            headers = [(k, v) for k, v in entry.headers if k in _NOT_MODIFIED_HEADERS]
+            status_code = 304
+            body = b""
+        else:
+            headers = [(k, v) for k, v in entry.headers if k not in ("age", "content-length")]
+            status_code = entry.status
+            body = b"" if method == "HEAD" else entry.body
+            if status_code >= 200 and status_code != 204:
+                headers.append(("content-length", str(len(entry.body))))
+        headers.append(("age", str(int(entry.current_age(now)))))
+        headers.append(("x-cache", cache_status))
+
+        response = Response(content=body, status_code=status_code)
+        response.raw_headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+        return response
+
+    # Перепроверка
+
+    def revalidate_in_background(self, client: httpx.AsyncClient, request: httpx.Request, entry: CacheEntry):
+        """Запустить фоновую перепроверку устаревшей записи"""
+        key = self._variant_key(entry.url, entry.vary)
+        if key in self._revalidating:
+            return
+        self._revalidating.add(key)
+
+        headers = {k: v for k, v in request.headers.items() if k not in ("if-none-match", "if-modified-since")}
+        headers.update(self.conditional_headers(entry))
+        revalidation_request = client.build_request("GET", request.url, headers=headers)
+
+        task = asyncio.create_task(self._revalidate(client, revalidation_request, entry))
+        task.add_done_callback(lambda _: self._revalidating.discard(key))
+
+    async def _revalidate(self, client: httpx.AsyncClient, request: httpx.Request, entry: CacheEntry):
+        request_time = time.time()
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            CACHE_REVALIDATIONS.labels(result="error").inc()
+            logger.warning(f"Background revalidation failed for {entry.url}: {e}")
+            return
+
+        try:
+            response_time = time.time()
+            if response.status_code == 304:
+                CACHE_REVALIDATIONS.labels(result="not_modified").inc()
+                await self.put(self.freshen(entry, response, request_time, response_time))
+                return
+
+            CACHE_REVALIDATIONS.labels(result="modified").inc()
+            if not self.is_storable(request, response):
+                await self.invalidate(entry.url)
+                return
+
+            body = bytearray()
+            async for chunk in iter_body(response):
+                body.extend(chunk)
+                if len(body) > settings.proxy_cache_max_object_bytes:
+                    await self.invalidate(entry.url)
+                    return
+            headers = response_headers_for_cache(response)
+            await self.put(
+                self.make_entry(request, response, headers, bytes(body), request_time, response_time)
+            )
+        except httpx.HTTPError as e:
+            logger.warning(f"Background revalidation failed for {entry.url}: {e}")
+        finally:
+            await response.aclose()
+
+
+def response_headers_for_cache(response: httpx.Response) -> list:
+    """Заголовки ответа в том виде, в котором они передаются клиенту"""
+    from app.services.proxy_service import ProxyService
+    return [
+        (k.decode("latin-1"), v.decode("latin-1"))
+        for k, v in ProxyService.build_response_headers(response)
+    ]
+
+
+# Кэш воркера
+http_cache = HttpCache()
@@ -0,0 +1,103 @@
+"""
+Контроль задержки event loop воркера
+
+Любой синхронный вызов в async-коде (драйвер, bcrypt, тяжелый JSON)
+останавливает все запросы воркера. Фоновая задача каждые
+event_loop_monitor_interval секунд измеряет, насколько позже срока она
+проснулась, и пишет задержку в метрики. Отдельный поток следит за
+отметками этой задачи: если loop не отвечает дольше
+event_loop_lag_threshold_ms, он снимает стек потока loop, то есть место
+блокирующего вызова, и пишет его в журнал не чаще раза в
+event_loop_stack_log_interval секунд.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from app.config import settings
+from app.metrics import EVENT_LOOP_BLOCKS, EVENT_LOOP_LAG, EVENT_LOOP_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Глубина сохраняемого стека
+_STACK_LIMIT = 30
+
+
+class LoopMonitor:
+    """Измерение задержки event loop и поиск блокирующих вызовов"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        # Последняя измеренная задержка, с
+        self.lag = 0.0
+        # Последняя отметка задачи в event loop (monotonic)
+        self._heartbeat = 0.0
+        self._last_stack_log = 0.0
+
+    async def _run(self):
+        interval = settings.event_loop_monitor_interval
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self.lag = lag = max(0.0, now - expected)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            EVENT_LOOP_LAG.set(lag)
+
+    def _watch(self):
+        threshold = settings.event_loop_lag_threshold_ms / 1000
+        # Остановка, о которой уже сообщено (по отметке, на которой loop остановился)
+        reported = None
+        while not self._stopping.wait(threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - settings.event_loop_monitor_interval
+            if stalled < threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            EVENT_LOOP_BLOCKS.inc()
+            now = time.monotonic()
+            if now - self._last_stack_log < settings.event_loop_stack_log_interval:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self._last_stack_log = now
+            # Одной строкой, начиная с блокирующего вызова
+            stack = " <- ".join(
+                f"{entry.filename}:{entry.lineno} in {entry.name}"
+                for entry in reversed(traceback.extract_stack(frame, limit=_STACK_LIMIT))
+            )
+            logger.warning(f"Event loop blocked for more than {stalled * 1000:.0f}ms at {stack}")
+
+    def start(self):
+        if self._task is not None or settings.event_loop_monitor_interval <= 0:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        if settings.event_loop_lag_threshold_ms > 0:
+            self._stopping.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog is not None:
+            self._stopping.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+
+# Монитор воркера
+loop_monitor = LoopMonitor()
@@ -0,0 +1,84 @@
+"""
+Хэширование и проверка паролей в пуле процессов
+
+bcrypt занимает процессор на сотни миллисекунд; в event loop это
+останавливает все запросы воркера. Операции выполняются в отдельных
+процессах (password_hash_workers), а при очереди длиннее
+password_hash_queue_size запрос сразу получает 503.
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+from app.config import settings
+from app.metrics import PASSWORD_HASH_QUEUE, PASSWORD_HASH_REJECTED, PASSWORD_HASH_SECONDS
+from app.utils.security import get_password_hash, verify_password
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHasher:
+    """Пул процессов воркера для bcrypt"""
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: дочерний процесс не наследует event loop и соединения воркера
+            self._executor = ProcessPoolExecutor(
+                max_workers=settings.password_hash_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def _run(self, operation: str, func, *args):
+        if self._pending >= settings.password_hash_queue_size:
+            PASSWORD_HASH_REJECTED.inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Сервер перегружен, повторите попытку позже",
+                headers={"Retry-After": "1"}
+            )
+        self._pending += 1
+        PASSWORD_HASH_QUEUE.set(self._pending)
+        started = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            executor = self._get_executor()
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            except BrokenProcessPool:
+                # Процесс пула завершился аварийно: пересоздаем пул и повторяем один раз
+                if self._executor is executor:
+                    logger.warning("Password hash pool is broken, restarting")
+                    self._executor = None
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._pending -= 1
+            PASSWORD_HASH_QUEUE.set(self._pending)
+            PASSWORD_HASH_SECONDS.labels(operation=operation).observe(time.monotonic() - started)
+
+    async def hash(self, password: str) -> str:
+        """Получить хэш пароля"""
+        return await self._run("hash", get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """Проверить пароль"""
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Пул воркера
+password_hasher = PasswordHasher()
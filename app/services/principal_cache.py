@@ -0,0 +1,151 @@
+"""
+Кэш аутентифицированных пользователей воркера
+
+Проверка токена обращается к Redis и PostgreSQL, хотя прокси-запросам нужны
+только id и флаги пользователя. Они кэшируются по хэшу токена на
+auth_principal_cache_ttl секунд (не дольше срока токена). Когда пользователя
+блокируют, удаляют, он меняет пароль или выходит из системы, записи
+сбрасываются во всех воркерах через Redis pub/sub.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.config import settings
+from app.metrics import PRINCIPAL_CACHE_REQUESTS
+from app.redis_client import AUTH_INVALIDATION_CHANNEL, get_redis, publish_auth_invalidation
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повторной подпиской после ошибки Redis
+_RESUBSCRIBE_DELAY = 1.0
+
+
+class Principal:
+    """Аутентифицированный пользователь: id и флаги без обращения к БД"""
+
+    __slots__ = ("id", "is_active", "is_admin")
+
+    def __init__(self, id: int, is_active: bool, is_admin: bool):
+        self.id = id
+        self.is_active = is_active
+        self.is_admin = is_admin
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(user.id, user.is_active, user.is_admin)
+
+
+class PrincipalCache:
+    """LRU кэш digest токена -> Principal с ограниченным сроком записей"""
+
+    def __init__(self):
+        self._entries: OrderedDict[str, tuple[float, Principal]] = OrderedDict()
+        # Увеличивается при каждом сбросе: результат проверки, начатой до сброса, не кэшируется
+        self._generation = 0
+        # Без подписки сброс из других воркеров может быть пропущен, поэтому кэш не используется
+        self._subscribed = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._subscribed and settings.auth_principal_cache_ttl > 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, digest: str) -> Optional[Principal]:
+        """Пользователь по хэшу токена, если запись не устарела"""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(digest)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[digest]
+            PRINCIPAL_CACHE_REQUESTS.labels(result="miss").inc()
+            return None
+        self._entries.move_to_end(digest)
+        PRINCIPAL_CACHE_REQUESTS.labels(result="hit").inc()
+        return entry[1]
+
+    def put(self, digest: str, principal: Principal, token_expires_at: float, generation: int):
+        """Запомнить пользователя до истечения TTL или срока токена (unix time)"""
+        if not self.enabled or generation != self._generation:
+            return
+        ttl = min(settings.auth_principal_cache_ttl, token_expires_at - time.time())
+        if ttl <= 0:
+            return
+        self._entries[digest] = (time.monotonic() + ttl, principal)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > settings.auth_principal_cache_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    def _apply(self, message: dict):
+        self._generation += 1
+        if "token" in message:
+            self._entries.pop(message["token"], None)
+        if "user_id" in message:
+            user_id = int(message["user_id"])
+            for digest in [d for d, (_, p) in self._entries.items() if p.id == user_id]:
+                del self._entries[digest]
+
+    async def _publish(self, message: dict):
+        # Сбрасываем запись в этом воркере сразу, не дожидаясь сообщения из Redis
+        self._apply(message)
+        try:
+            await publish_auth_invalidation(message)
+        except Exception as e:
+            # Остальные воркеры забудут пользователя по истечении TTL
+            logger.warning(f"Principal cache invalidation publish failed: {e}")
+
+    async def invalidate_user(self, user_id: int):
+        """Сбросить все токены пользователя во всех воркерах"""
+        await self._publish({"user_id": user_id})
+
+    async def invalidate_token(self, digest: str):
+        """Сбросить токен во всех воркерах"""
+        await self._publish({"token": digest})
+
+    async def _listen(self):
+        while True:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(AUTH_INVALIDATION_CHANNEL)
+                # Пока подписки не было, сообщения о сбросе могли быть пропущены
+                self.clear()
+                self._subscribed = True
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._apply(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Principal cache subscription failed: {e}")
+            finally:
+                self._subscribed = False
+                self._entries.clear()
+                await pubsub.aclose()
+            await asyncio.sleep(_RESUBSCRIBE_DELAY)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+# Кэш воркера
+principal_cache = PrincipalCache()
@@ -2,85 +2,329 @@
 Сервис проксирования запросов
 """
 import httpx
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 from fastapi import Request, Response
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from app.config import settings
-from app.redis_client import increment_user_stats
+from app.http_client import get_http_client
+from app.services.http_cache import http_cache, request_cache_control, response_headers_for_cache
+from app.services.coalescer import Flight, request_coalescer
+from app.services.connection_slots import ConnectionLimitExceeded, SlotLease, connection_slots
+from app.services.bandwidth import UPLOAD, DOWNLOAD, bandwidth_shaper
+from app.services.stats_aggregator import stats_aggregator
+from app.metrics import CACHE_REQUESTS, WEBSOCKET_BYTES, WEBSOCKET_SESSIONS, WEBSOCKET_SESSIONS_ACTIVE
+from app.utils.request_timing import current_request_timing, observe_stage
+from app.utils.content_encoding import accepts_encoding, iter_body, passes_through
 import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Hop-by-hop заголовки, которые не передаются через прокси (RFC 9110, 7.6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade",
+}
+
+
+class RequestBodyTooLarge(Exception):
+    """Тело запроса превышает max_request_size_mb"""
+    pass
+
+
+class _RequestBodyStream:
+    """Потоковая передача тела запроса клиента в upstream с контролем размера"""
+    
+    def __init__(self, request: Request, max_bytes: int, user_id: int):
+        self.request = request
+        self.max_bytes = max_bytes
+        self.user_id = user_id
+        self.bytes_sent = 0
+    
+    async def __aiter__(self):
+        # При первом чтении uvicorn отвечает клиенту "100 Continue", если тот его ждет
+        async for chunk in self.request.stream():
+            if not chunk:
+                continue
+            self.bytes_sent += len(chunk)
+            if self.bytes_sent > self.max_bytes:
+                raise RequestBodyTooLarge()
+            await bandwidth_shaper.consume(self.user_id, UPLOAD, len(chunk))
+            yield chunk
+
+
+def request_has_body(request: Request) -> bool:
+    """Есть ли у запроса тело"""
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        return content_length.strip() != "0"
+    return "transfer-encoding" in request.headers
+
+
+class _ResponseRelay:
+    """Потоковая передача тела ответа upstream клиенту"""
+    
+    def __init__(
+        self,
+        upstream_response: httpx.Response,
+        user_id: int,
+        upload: Optional[_RequestBodyStream],
+        slot: SlotLease,
+        on_complete: Optional[Callable[[bytes], Awaitable[None]]] = None
+    ):
+        self.upstream_response = upstream_response
+        self.user_id = user_id
+        self.upload = upload
+        self.slot = slot
+        self.bytes_received = 0
+        self._closed = False
+        self._started: Optional[float] = None
+        # Копия тела для сохранения в кэш, если ответ укладывается в лимит
+        self.on_complete = on_complete
+        self._captured = bytearray() if on_complete else None
+    
+    async def __aiter__(self):
+        self._started = time.perf_counter()
+        try:
+            # Читаем upstream по одному чанку: следующий чанк запрашивается только
+            # после того, как предыдущий отправлен клиенту
+            async for chunk in iter_body(
+                self.upstream_response,
+                chunk_size=settings.proxy_stream_chunk_size
+            ):
+                self.bytes_received += len(chunk)
+                await bandwidth_shaper.consume(self.user_id, DOWNLOAD, len(chunk))
+                if self._captured is not None:
+                    if len(self._captured) + len(chunk) > settings.proxy_cache_max_object_bytes:
+                        self._captured = None
+                    else:
+                        self._captured.extend(chunk)
+                yield chunk
+            if self._captured is not None:
+                await self.on_complete(bytes(self._captured))
+        except httpx.HTTPError as e:
+            # Ошибка передается ASGI-серверу: он обрывает соединение, и клиент
+            # не принимает усеченное тело за полный ответ
+            logger.warning(f"Upstream stream error: {e}")
+            raise
+        finally:
+            await self.close()
+    
+    async def close(self):
+        """Закрыть ответ upstream и учесть переданные байты"""
+        if self._closed:
+            return
+        self._closed = True
+        # Трафик учитывается до первого await, в том числе у прерванных загрузок
+        bytes_sent = self.upload.bytes_sent if self.upload else 0
+        stats_aggregator.record(self.user_id, bytes_sent, self.bytes_received)
+        if self._started is not None:
+            observe_stage("transfer", time.perf_counter() - self._started)
+        # При обрыве соединения клиентом close() вызывается в отмененной задаче
+        await asyncio.shield(self._release())
+    
+    async def _release(self):
+        try:
+            await self.upstream_response.aclose()
+        finally:
+            await self.slot.release()
+
+
+class _FlightRelay:
+    """Передача клиенту тела ответа из общего запроса к upstream"""
+    
+    def __init__(self, flight: Flight, consumer: int, user_id: int, slot: SlotLease):
+        self.flight = flight
+        self.consumer = consumer
+        self.user_id = user_id
+        self.slot = slot
+        self.bytes_received = 0
+        self._closed = False
+        self._started: Optional[float] = None
+    
+    async def __aiter__(self):
+        self._started = time.perf_counter()
+        try:
+            async for chunk in self.flight.iterate(self.consumer):
+                self.bytes_received += len(chunk)
+                await bandwidth_shaper.consume(self.user_id, DOWNLOAD, len(chunk))
+                yield chunk
+        finally:
+            await self.close()
+    
+    async def close(self):
+        """Отключиться от общего запроса и учесть переданные байты"""
+        if self._closed:
+            return
+        self._closed = True
+        # Трафик учитывается до первого await, в том числе у прерванных загрузок
+        stats_aggregator.record(self.user_id, 0, self.bytes_received)
+        if self._started is not None:
+            observe_stage("transfer", time.perf_counter() - self._started)
+        # При обрыве соединения клиентом close() вызывается в отмененной задаче
+        await asyncio.shield(self._release())
+    
+    async def _release(self):
+        try:
+            await self.flight.leave(self.consumer)
+        finally:
+            await self.slot.release()
 
 
 class ProxyService:
     """Сервис для проксирования HTTP/HTTPS запросов"""
     
     @staticmethod
-    async def proxy_request(
-        request: Request,
-        target_url: str,
-        user_id: int
-    ) -> Response:
-        """Проксировать HTTP запрос"""
+    def build_upstream_headers(request: Request) -> dict:
+        """Заголовки запроса к upstream"""
         # Получаем заголовки от клиента
         headers = dict(request.headers)
         
-        # Удаляем заголовки, которые не должны передаваться
+        # Удаляем заголовки, которые не должны передаваться.
+        # Content-Length сохраняется: тело передается потоком той же длины
         headers.pop("host", None)
-        headers.pop("content-length", None)
-        headers.pop("connection", None)
-        headers.pop("transfer-encoding", None)
+        # 100-continue обрабатывается на стороне клиента, upstream получает тело сразу
+        headers.pop("expect", None)
+        for name in HOP_BY_HOP_HEADERS:
+            headers.pop(name, None)
+        
+        # Без Accept-Encoding клиента upstream отвечает без сжатия, чтобы
+        # не распаковывать тело на прокси
+        if settings.proxy_enable_compression and "accept-encoding" not in headers:
+            headers["Accept-Encoding"] = "identity"
         
         # Устанавливаем User-Agent для iOS
         headers["User-Agent"] = settings.ios_user_agent
+        return headers
+    
+    @staticmethod
+    def build_response_headers(upstream_response: httpx.Response) -> list[tuple[bytes, bytes]]:
+        """Заголовки ответа клиенту (с сохранением повторяющихся, например Set-Cookie)"""
+        # Если тело передается декодированным, исходные content-encoding и длина неактуальны
+        encoded = "content-encoding" in upstream_response.headers and not passes_through(upstream_response)
+        raw_headers = []
+        for name, value in upstream_response.headers.multi_items():
+            if name in HOP_BY_HOP_HEADERS:
+                continue
+            if encoded and name in ("content-encoding", "content-length"):
+                continue
+            raw_headers.append((name.encode("latin-1"), value.encode("latin-1")))
+        return raw_headers
+    
+    @staticmethod
+    async def proxy_request(
+        request: Request,
+        target_url: str,
+        user_id: int
+    ) -> Response:
+        """Проксировать HTTP запрос с потоковой передачей ответа"""
+        headers = ProxyService.build_upstream_headers(request)
         
-        # Получаем тело запроса
-        body = await request.body()
+        # Тело запроса передается в upstream потоком, без буферизации
+        upload = None
+        if request_has_body(request):
+            upload = _RequestBodyStream(request, settings.max_request_size_mb * 1024 * 1024, user_id)
         
-        # Создаем клиент для проксирования
-        async with httpx.AsyncClient(
-            timeout=httpx.Timeout(
-                connect=settings.proxy_connect_timeout,
-                read=settings.proxy_read_timeout
-            ),
-            follow_redirects=True,
-            verify=False  # Для HTTPS проксирования
-        ) as client:
-            try:
-                # Выполняем запрос
-                response = await client.request(
-                    method=request.method,
-                    url=target_url,
-                    headers=headers,
-                    content=body if body else None,
-                    params=dict(request.query_params)
+        # Используем общий клиент с пулом соединений
+        client = get_http_client()
+        try:
+            upstream_request = client.build_request(
+                method=request.method,
+                url=target_url,
+                headers=headers,
+                content=upload,
+                params=dict(request.query_params)
+            )
+        except Exception as e:
+            return Response(
+                content=f"Proxy error: {str(e)}",
+                status_code=500,
+                media_type="text/plain"
+            )
+        
+        timings = current_request_timing()
+        if timings is not None:
+            timings.upstream = upstream_request.url.host
+        
+        # Проверяем HTTP-кэш
+        cacheable = http_cache.is_request_cacheable(upstream_request, upload is not None)
+        entry = None
+        revalidating = False
+        if cacheable:
+            entry = await http_cache.get(upstream_request)
+            if entry is not None and not accepts_encoding(
+                request.headers.get("accept-encoding"), entry.header("content-encoding")
+            ):
+                # Запись сохранена в кодировании, которое клиент не принимает
+                entry = None
+            now = time.time()
+            if entry is not None:
+                if http_cache.is_fresh(entry, upstream_request, now):
+                    CACHE_REQUESTS.labels(result="hit").inc()
+                    return await ProxyService._cached_response(entry, request, user_id, now, "HIT")
+                if http_cache.can_serve_while_revalidate(entry, upstream_request, now):
+                    CACHE_REQUESTS.labels(result="stale").inc()
+                    http_cache.revalidate_in_background(client, upstream_request, entry)
+                    return await ProxyService._cached_response(entry, request, user_id, now, "STALE")
+                if entry.has_validators() and not http_cache.has_client_conditionals(request.headers):
+                    # Перепроверяем запись условным запросом
+                    upstream_request.headers.update(http_cache.conditional_headers(entry))
+                    revalidating = True
+            elif "only-if-cached" in request_cache_control(upstream_request.headers):
+                return Response(
+                    content="Not cached",
+                    status_code=504,
+                    media_type="text/plain"
                 )
-                
-                # Собираем статистику
-                bytes_sent = len(body) if body else 0
-                bytes_received = len(response.content) if response.content else 0
-                increment_user_stats(user_id, bytes_sent, bytes_received)
-                
-                # Формируем ответ
-                response_headers = dict(response.headers)
-                # Удаляем заголовки, которые не должны передаваться клиенту
-                response_headers.pop("content-encoding", None)
-                response_headers.pop("transfer-encoding", None)
-                response_headers.pop("connection", None)
-                response_headers.pop("keep-alive", None)
-                
+            if not revalidating:
+                CACHE_REQUESTS.labels(result="miss").inc()
+        
+        # Слот соединения пользователя нужен только для запроса к upstream
+        try:
+            slot = await connection_slots.acquire(user_id)
+        except ConnectionLimitExceeded as e:
+            return Response(
+                content=str(e),
+                status_code=429,
+                headers={"Retry-After": str(e.retry_after)},
+                media_type="text/plain"
+            )
+        
+        # Потоковый ответ освобождает слот сам, после передачи тела
+        streaming = False
+        try:
+            # Одинаковые одновременные запросы выполняются одним запросом к upstream
+            coalesce = cacheable and not revalidating and request_coalescer.enabled
+            flight = None
+            
+            request_time = time.time()
+            try:
+                if coalesce:
+                    flight, consumer = await request_coalescer.join(client, upstream_request)
+                if flight is None:
+                    # Получаем только статус и заголовки, тело читается по мере отправки клиенту
+                    upstream_response = await client.send(upstream_request, stream=True)
+            except RequestBodyTooLarge:
                 return Response(
-                    content=response.content,
-                    status_code=response.status_code,
-                    headers=response_headers,
-                    media_type=response.headers.get("content-type")
+                    content=f"Размер запроса превышает {settings.max_request_size_mb}MB",
+                    status_code=413,
+                    media_type="text/plain"
                 )
-                
             except httpx.TimeoutException:
+                if entry is not None and http_cache.can_serve_on_error(entry, time.time()):
+                    CACHE_REQUESTS.labels(result="stale").inc()
+                    return await ProxyService._cached_response(entry, request, user_id, time.time(), "STALE")
                 return Response(
                     content="Request timeout",
                     status_code=504,
                     media_type="text/plain"
                 )
             except httpx.ConnectError:
+                if entry is not None and http_cache.can_serve_on_error(entry, time.time()):
+                    CACHE_REQUESTS.labels(result="stale").inc()
+                    return await ProxyService._cached_response(entry, request, user_id, time.time(), "STALE")
                 return Response(
                     content="Connection error",
                     status_code=502,
@@ -92,55 +336,77 @@ class ProxyService:
                     status_code=500,
                     media_type="text/plain"
                 )
+            response_time = time.time()
+            
+            if flight is not None:
+                relay = _FlightRelay(flight, consumer, user_id, slot)
+                response = StreamingResponse(
+                    relay,
+                    status_code=flight.response.status_code,
+                    background=BackgroundTask(relay.close)
+                )
+                response.raw_headers = ProxyService.build_response_headers(flight.response)
+                response.raw_headers.append((b"x-cache", b"MISS"))
+                streaming = True
+                return response
+            
+            if revalidating:
+                if upstream_response.status_code == 304:
+                    CACHE_REQUESTS.labels(result="revalidated").inc()
+                    await upstream_response.aclose()
+                    entry = http_cache.freshen(entry, upstream_response, request_time, response_time)
+                    await http_cache.put(entry)
+                    return await ProxyService._cached_response(entry, request, user_id, response_time, "REVALIDATED")
+                if upstream_response.status_code >= 500 and http_cache.can_serve_on_error(entry, response_time):
+                    CACHE_REQUESTS.labels(result="stale").inc()
+                    await upstream_response.aclose()
+                    return await ProxyService._cached_response(entry, request, user_id, response_time, "STALE")
+                CACHE_REQUESTS.labels(result="miss").inc()
+            
+            async def store_in_cache(body: bytes):
+                await http_cache.put(http_cache.make_entry(
+                    upstream_request,
+                    upstream_response,
+                    response_headers_for_cache(upstream_response),
+                    body,
+                    request_time,
+                    response_time
+                ))
+            
+            # Тело сохраняется в кэш после передачи клиенту, если ответ можно хранить
+            on_complete = None
+            if cacheable and http_cache.is_storable(upstream_request, upstream_response):
+                on_complete = store_in_cache
+            elif revalidating:
+                # Новый ответ нельзя сохранить, старая запись больше не актуальна
+                await http_cache.invalidate(str(upstream_request.url))
+            elif upstream_request.method not in ("GET", "HEAD", "OPTIONS") and upstream_response.status_code < 400:
+                # Небезопасный метод делает закэшированные ответы неактуальными
+                await http_cache.invalidate(str(upstream_request.url))
+            
+            relay = _ResponseRelay(upstream_response, user_id, upload, slot, on_complete)
+            response = StreamingResponse(
+                relay,
+                status_code=upstream_response.status_code,
+                # Закрываем upstream и при обрыве соединения клиентом
+                background=BackgroundTask(relay.close)
+            )
+            response.raw_headers = ProxyService.build_response_headers(upstream_response)
+            if cacheable:
+                response.raw_headers.append((b"x-cache", b"MISS"))
+            streaming = True
+            return response
+        finally:
+            if not streaming:
+                await slot.release()
     
     @staticmethod
-    async def proxy_streaming(
-        request: Request,
-        target_url: str,
-        user_id: int
-    ) -> StreamingResponse:
-        """Проксировать запрос с потоковой передачей (для больших файлов)"""
-        headers = dict(request.headers)
-        headers.pop("host", None)
-        headers.pop("content-length", None)
-        headers.pop("connection", None)
-        headers["User-Agent"] = settings.ios_user_agent
-        
-        async def generate():
-            bytes_sent = 0
-            bytes_received = 0
-            
-            async with httpx.AsyncClient(
-                timeout=httpx.Timeout(
-                    connect=settings.proxy_connect_timeout,
-                    read=settings.proxy_read_timeout
-                ),
-                follow_redirects=True,
-                verify=False
-            ) as client:
-                # Получаем тело запроса
-                body = await request.body() if request.method in ["POST", "PUT", "PATCH"] else None
-                bytes_sent = len(body) if body else 0
-                
-                async with client.stream(
-                    method=request.method,
-                    url=target_url,
-                    headers=headers,
-                    content=body,
-                    params=dict(request.query_params)
-                ) as response:
-                    async for chunk in response.aiter_bytes():
-                        bytes_received += len(chunk)
-                        yield chunk
-                
-                # Обновляем статистику
-                increment_user_stats(user_id, bytes_sent, bytes_received)
-        
-        return StreamingResponse(
-            generate(),
-            status_code=200,
-            headers={"Content-Type": "application/octet-stream"}
-        )
+    async def _cached_response(entry, request: Request, user_id: int, now: float, cache_status: str) -> Response:
+        """Ответ из кэша с учетом статистики и лимита скорости пользователя"""
+        response = http_cache.to_response(entry, request.method, request.headers, now, cache_status)
+        await bandwidth_shaper.consume(user_id, DOWNLOAD, len(response.body))
+        stats_aggregator.record(user_id, 0, len(response.body))
+        return response
     
     @staticmethod
     async def proxy_websocket(
@@ -156,6 +422,8 @@ class ProxyService:
             
             # Подключаемся к целевому WebSocket серверу
             async with websockets.connect(target_url) as target_ws:
+                WEBSOCKET_SESSIONS.inc()
+                WEBSOCKET_SESSIONS_ACTIVE.inc()
                 # Создаем задачи для двунаправленной передачи
                 async def forward_to_target():
                     bytes_sent = 0
@@ -163,11 +431,13 @@ class ProxyService:
                         while True:
                             data = await websocket.receive_bytes()
                             bytes_sent += len(data)
+                            await bandwidth_shaper.consume(user_id, UPLOAD, len(data))
                             await target_ws.send(data)
                     except Exception:
                         pass
                     finally:
-                        increment_user_stats(user_id, bytes_sent, 0)
+                        stats_aggregator.record(user_id, bytes_sent, 0)
+                        WEBSOCKET_BYTES.labels(direction="upload").inc(bytes_sent)
                 
                 async def forward_to_client():
                     bytes_received = 0
@@ -175,17 +445,22 @@ class ProxyService:
                         while True:
                             data = await target_ws.recv()
                             bytes_received += len(data)
+                            await bandwidth_shaper.consume(user_id, DOWNLOAD, len(data))
                             await websocket.send_bytes(data)
                     except Exception:
                         pass
                     finally:
-                        increment_user_stats(user_id, 0, bytes_received)
+                        stats_aggregator.record(user_id, 0, bytes_received)
+                        WEBSOCKET_BYTES.labels(direction="download").inc(bytes_received)
                 
                 # Запускаем обе задачи параллельно
-                await asyncio.gather(
-                    forward_to_target(),
-                    forward_to_client()
-                )
+                try:
+                    await asyncio.gather(
+                        forward_to_target(),
+                        forward_to_client()
+                    )
+                finally:
+                    WEBSOCKET_SESSIONS_ACTIVE.dec()
         except ImportError:
             # Если websockets не установлен, закрываем соединение
             await websocket.close(code=1011, reason="WebSocket proxy not available")
@@ -0,0 +1,157 @@
+"""
+Удаление истекших сессий
+
+Истекшие сессии отфильтровываются запросами, но остаются в таблице и
+индексах. Раз в session_reaper_interval секунд один из воркеров удаляет их
+пакетами по session_reaper_batch_size строк (короткие транзакции не
+блокируют таблицу) и чистит соответствующие ключи Redis.
+
+Если таблица sessions секционирована по expires_at (миграция
+003_partition_sessions), заранее создаются месячные секции на срок жизни
+новых сессий, а секции, все сессии которых истекли, удаляются целиком.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import delete, select, text
+
+from app.config import settings
+from app.database import SessionLocal, engine
+from app.metrics import SESSIONS_REAPED
+from app.models.session import Session as SessionModel
+from app.redis_client import acquire_lease, delete_sessions
+
+logger = logging.getLogger(__name__)
+
+# Имена месячных секций: sessions_pYYYYMM
+_PARTITION_PREFIX = "sessions_p"
+# Пауза между пакетами удаления
+_BATCH_PAUSE = 0.1
+
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(value: datetime) -> datetime:
+    return value.replace(year=value.year + value.month // 12, month=value.month % 12 + 1)
+
+
+class SessionReaper:
+    """Периодическая очистка таблицы sessions"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def _delete_batch(self, now: datetime) -> int:
+        table = SessionModel.__table__
+        expired = select(table.c.id).where(table.c.expires_at <= now).limit(settings.session_reaper_batch_size)
+        statement = (
+            delete(table)
+            .where(table.c.id.in_(expired))
+            .returning(table.c.session_id, table.c.user_id, table.c.refresh_token_hash)
+        )
+        async with SessionLocal() as db:
+            rows = (await db.execute(statement)).all()
+            await db.commit()
+        if rows:
+            try:
+                await delete_sessions([tuple(row) for row in rows])
+            except Exception as e:
+                # Ключи сессий истекут сами, в наборах пользователей они удаляются при чтении
+                logger.warning(f"Session reaper Redis cleanup failed: {e}")
+        return len(rows)
+
+    async def reap(self) -> int:
+        """Удалить истекшие сессии пакетами; возвращает число удаленных"""
+        now = datetime.now(timezone.utc)
+        total = 0
+        while True:
+            deleted = await self._delete_batch(now)
+            total += deleted
+            SESSIONS_REAPED.inc(deleted)
+            if deleted < settings.session_reaper_batch_size:
+                return total
+            await asyncio.sleep(_BATCH_PAUSE)
+
+    async def maintain_partitions(self):
+        """Создать будущие и удалить истекшие секции (только для секционированной таблицы)"""
+        if engine.dialect.name != "postgresql":
+            return
+        async with engine.connect() as conn:
+            partitioned = await conn.scalar(text(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'sessions'::regclass)"
+            ))
+            if not partitioned:
+                return
+            names = set(await conn.scalars(text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'sessions'::regclass"
+            )))
+
+        now = datetime.now(timezone.utc)
+        statements = []
+        # Секции до месяца, в котором истекут сессии, созданные сейчас
+        month = _month_start(now)
+        horizon = now + timedelta(days=settings.refresh_token_expire_days, seconds=settings.session_reaper_interval)
+        while month <= horizon:
+            name = f"{_PARTITION_PREFIX}{month:%Y%m}"
+            if name not in names:
+                statements.append(
+                    f"CREATE TABLE {name} PARTITION OF sessions "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+                )
+            month = _next_month(month)
+        # Все сессии секции истекли: их ключи в Redis уже удалены по TTL
+        for name in sorted(names):
+            suffix = name[len(_PARTITION_PREFIX):]
+            if not name.startswith(_PARTITION_PREFIX) or len(suffix) != 6 or not suffix.isdigit():
+                continue
+            start = datetime(int(suffix[:4]), int(suffix[4:]), 1, tzinfo=timezone.utc)
+            if _next_month(start) <= now:
+                statements.append(f"DROP TABLE {name}")
+
+        for statement in statements:
+            try:
+                async with engine.begin() as conn:
+                    await conn.execute(text(statement))
+                logger.info(f"Session partitions: {statement}")
+            except Exception as e:
+                logger.warning(f"Session partition maintenance failed ({statement}): {e}")
+
+    async def _acquire(self) -> bool:
+        try:
+            return await acquire_lease("session_reaper", max(1, settings.session_reaper_interval // 2))
+        except Exception as e:
+            # Удаление идемпотентно: без Redis очистку выполняет каждый воркер
+            logger.warning(f"Session reaper lease failed: {e}")
+            return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.session_reaper_interval)
+            try:
+                if not await self._acquire():
+                    continue
+                await self.maintain_partitions()
+                deleted = await self.reap()
+                if deleted:
+                    logger.info(f"Session reaper deleted {deleted} expired sessions")
+            except Exception as e:
+                logger.warning(f"Session reaper failed: {e}")
+
+    def start(self):
+        if self._task is None and settings.session_reaper_interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+# Очистка сессий воркера
+session_reaper = SessionReaper()
@@ -0,0 +1,81 @@
+"""
+Накопление статистики трафика пользователей в памяти воркера
+
+Запросы только складывают счетчики в памяти; в Redis они записываются
+одним pipeline раз в stats_flush_interval секунд, при накоплении
+stats_flush_max_users пользователей и при остановке приложения.
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from app.config import settings
+from app.metrics import STATS_FLUSHES, STATS_PENDING_USERS
+from app.redis_client import increment_user_stats_batch
+
+logger = logging.getLogger(__name__)
+
+
+class StatsAggregator:
+    """Счетчики трафика пользователей, ожидающие записи в Redis"""
+
+    def __init__(self):
+        # user_id -> [bytes_sent, bytes_received, requests]
+        self._pending: dict[int, list] = {}
+        self._flush_needed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, user_id: int, bytes_sent: int, bytes_received: int, requests: int = 1):
+        """Учесть трафик запроса (без обращения к сети)"""
+        counters = self._pending.get(user_id)
+        if counters is None:
+            counters = self._pending[user_id] = [0, 0, 0]
+            STATS_PENDING_USERS.set(len(self._pending))
+            if len(self._pending) >= settings.stats_flush_max_users and self._flush_needed is not None:
+                self._flush_needed.set()
+        counters[0] += bytes_sent
+        counters[1] += bytes_received
+        counters[2] += requests
+
+    async def flush(self):
+        """Записать накопленные счетчики в Redis"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        STATS_PENDING_USERS.set(0)
+        try:
+            await increment_user_stats_batch(batch)
+            STATS_FLUSHES.labels(result="ok").inc()
+        except Exception as e:
+            STATS_FLUSHES.labels(result="error").inc()
+            logger.warning(f"Stats flush failed for {len(batch)} users: {e}")
+            # Возвращаем счетчики, чтобы записать их при следующей попытке
+            for user_id, (bytes_sent, bytes_received, requests) in batch.items():
+                self.record(user_id, bytes_sent, bytes_received, requests)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=settings.stats_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._flush_needed = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись и записать остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._flush_needed = None
+        await self.flush()
+
+
+# Счетчики воркера
+stats_aggregator = StatsAggregator()
@@ -0,0 +1,130 @@
+"""
+Отложенная запись отметок времени в PostgreSQL
+
+Обновление last_login при входе и last_activity при каждом refresh - это
+отдельные маленькие UPDATE и commit, которые при массовых входах нагружают
+БД сильнее остальных запросов. Отметки накапливаются в памяти воркера (для
+пользователя и сессии хранится только последняя) и записываются пакетными
+UPDATE раз в write_behind_interval секунд, при накоплении
+write_behind_max_pending отметок и при остановке приложения. При аварийном
+завершении воркера теряются только отметки за последний интервал.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import bindparam, update
+
+from app.config import settings
+from app.database import SessionLocal
+from app.metrics import WRITE_BEHIND_FLUSHES, WRITE_BEHIND_PENDING
+from app.models.session import Session as SessionModel
+from app.models.user import User
+
+logger = logging.getLogger(__name__)
+
+
+def _touch(pending: dict, key: int, when: datetime) -> bool:
+    """Запомнить отметку, если она новее; True - если добавлен новый ключ"""
+    current = pending.get(key)
+    if current is None or current < when:
+        pending[key] = when
+    return current is None
+
+
+class WriteBehind:
+    """Отметки времени, ожидающие записи в БД"""
+
+    def __init__(self):
+        # id пользователя -> last_login
+        self._user_login: dict[int, datetime] = {}
+        # id сессии -> last_activity
+        self._session_activity: dict[int, datetime] = {}
+        self._flush_needed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._user_login) + len(self._session_activity)
+
+    def _added(self):
+        WRITE_BEHIND_PENDING.set(self.pending)
+        if self.pending >= settings.write_behind_max_pending and self._flush_needed is not None:
+            self._flush_needed.set()
+
+    def touch_user_login(self, user_id: int, when: datetime):
+        """Запомнить время последнего входа пользователя"""
+        if _touch(self._user_login, user_id, when):
+            self._added()
+
+    def touch_session(self, session_pk: int, when: datetime):
+        """Запомнить время последней активности сессии"""
+        if _touch(self._session_activity, session_pk, when):
+            self._added()
+
+    async def flush(self):
+        """Записать накопленные отметки в БД одной транзакцией"""
+        if not self.pending:
+            return
+        logins, self._user_login = self._user_login, {}
+        activity, self._session_activity = self._session_activity, {}
+        WRITE_BEHIND_PENDING.set(0)
+        users = User.__table__
+        sessions = SessionModel.__table__
+        try:
+            async with SessionLocal() as db:
+                if logins:
+                    await db.execute(
+                        update(users)
+                        .where(users.c.id == bindparam("b_id"))
+                        .values(last_login=bindparam("b_when")),
+                        [{"b_id": user_id, "b_when": when} for user_id, when in logins.items()]
+                    )
+                if activity:
+                    await db.execute(
+                        update(sessions)
+                        .where(sessions.c.id == bindparam("b_id"))
+                        .values(last_activity=bindparam("b_when")),
+                        [{"b_id": session_pk, "b_when": when} for session_pk, when in activity.items()]
+                    )
+                await db.commit()
+            WRITE_BEHIND_FLUSHES.labels(result="ok").inc()
+        except Exception as e:
+            WRITE_BEHIND_FLUSHES.labels(result="error").inc()
+            logger.warning(
+                f"Write-behind flush failed for {len(logins)} users and {len(activity)} sessions: {e}"
+            )
+            # Возвращаем отметки, не затирая более новые
+            for user_id, when in logins.items():
+                _touch(self._user_login, user_id, when)
+            for session_pk, when in activity.items():
+                _touch(self._session_activity, session_pk, when)
+            WRITE_BEHIND_PENDING.set(self.pending)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=settings.write_behind_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._flush_needed = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись и записать остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._flush_needed = None
+        await self.flush()
+
+
+# Буфер воркера
+write_behind = WriteBehind()
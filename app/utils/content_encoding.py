@@ -0,0 +1,70 @@
+"""
+Утилиты для передачи сжатого тела ответа без перекодирования
+"""
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from app.config import settings
+
+
+def parse_content_codings(value: Optional[str]) -> list[str]:
+    """Список кодирований из Content-Encoding в порядке применения"""
+    if not value:
+        return []
+    return [c.strip().lower() for c in value.split(",") if c.strip() and c.strip().lower() != "identity"]
+
+
+def accepts_encoding(accept_encoding: Optional[str], content_encoding: Optional[str]) -> bool:
+    """Допускает ли Accept-Encoding клиента кодирование ответа (RFC 9110, 12.5.3)"""
+    codings = parse_content_codings(content_encoding)
+    if not codings:
+        return True
+    if not accept_encoding:
+        return False
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value.strip())
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+
+    for coding in codings:
+        # x-gzip равнозначен gzip (RFC 9110, 8.4.1.3)
+        aliases = (coding, "gzip") if coding == "x-gzip" else (coding,)
+        weight = next((weights[a] for a in aliases if a in weights), weights.get("*", 0.0))
+        if weight <= 0:
+            return False
+    return True
+
+
+def passes_through(response: httpx.Response) -> bool:
+    """
+    Передать тело ответа клиенту в исходном кодировании.
+
+    Заголовки запроса к upstream повторяют Accept-Encoding клиента, поэтому
+    допустимость кодирования проверяется по запросу, на который получен ответ.
+    """
+    if not settings.proxy_enable_compression:
+        return False
+    content_encoding = response.headers.get("content-encoding")
+    if not parse_content_codings(content_encoding):
+        return False
+    return accepts_encoding(response.request.headers.get("accept-encoding"), content_encoding)
+
+
+def iter_body(response: httpx.Response, chunk_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """Тело ответа upstream: исходные байты при передаче без перекодирования, иначе декодированные"""
+    if passes_through(response):
+        return response.aiter_raw(chunk_size=chunk_size)
+    return response.aiter_bytes(chunk_size=chunk_size)
@@ -1,20 +1,161 @@
 """
 Rate limiting утилиты
+
+Лимит запросов в минуту общий для всех воркеров: счетчики скользящего окна
+хранятся в Redis и изменяются атомарным Lua-скриптом. Чтобы не обращаться
+к Redis на каждый запрос, воркер берет разрешения пачкой (доля
+rate_limit_local_share от лимита) и расходует их локально до конца окна;
+после отказа клиент получает 429 локально до Retry-After. Если Redis
+недоступен, лимит считается в каждом воркере отдельно.
 """
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-from fastapi import Request
+import ipaddress
+import logging
+import time
+from functools import lru_cache
+
+from fastapi import HTTPException, Request, status
+
 from app.config import settings
+from app.metrics import RATE_LIMIT_REQUESTS
+from app.redis_client import take_rate_limit
+
+logger = logging.getLogger(__name__)
+
+# Окно лимита (секунды)
+_WINDOW = 60
+# Ключи воркера, после которых удаляются устаревшие
+_MAX_LOCAL_KEYS = 10000
+
+
+@lru_cache(maxsize=1)
+def _trusted_networks() -> tuple:
+    return tuple(ipaddress.ip_network(value, strict=False) for value in settings.trusted_proxies)
 
-# Создаем лимитер
-limiter = Limiter(key_func=get_remote_address)
+
+def _is_trusted(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in _trusted_networks())
+
+
+def get_client_ip(request: Request) -> str:
+    """IP клиента с учетом X-Real-IP / X-Forwarded-For от доверенного прокси (nginx)"""
+    host = request.client.host if request.client else "unknown"
+    if not _is_trusted(host):
+        return host
+    real_ip = request.headers.get("x-real-ip")
+    if real_ip:
+        return real_ip.strip()
+    # Последний адрес цепочки, добавленный не доверенным прокси
+    forwarded = [value.strip() for value in request.headers.get("x-forwarded-for", "").split(",") if value.strip()]
+    for value in reversed(forwarded):
+        if not _is_trusted(value):
+            return value
+    return forwarded[0] if forwarded else host
 
 
 def get_user_id_from_request(request: Request) -> str:
     """Получить user_id из запроса для rate limiting по пользователю"""
     # Если есть текущий пользователь в request.state, используем его
     if hasattr(request.state, "user_id"):
-        return str(request.state.user_id)
+        return f"user:{request.state.user_id}"
     # Иначе используем IP адрес
-    return get_remote_address(request)
+    return f"ip:{get_client_ip(request)}"
+
+
+class _LocalState:
+    """Состояние ключа в воркере"""
+
+    __slots__ = ("permits", "permits_until", "blocked_until", "fallback_count", "fallback_until")
+
+    def __init__(self):
+        # Разрешения, взятые из Redis, и конец окна, в котором они действуют (monotonic)
+        self.permits = 0
+        self.permits_until = 0.0
+        # После отказа Redis запросы отклоняются локально до этого момента
+        self.blocked_until = 0.0
+        # Счетчик воркера на случай недоступности Redis
+        self.fallback_count = 0
+        self.fallback_until = 0.0
+
+
+class RateLimiter:
+    """Лимит запросов в минуту по ключу, общий для всех воркеров"""
+
+    def __init__(self):
+        self._local: dict[str, _LocalState] = {}
+
+    def _state(self, key: str, now: float) -> _LocalState:
+        state = self._local.get(key)
+        if state is None:
+            if len(self._local) >= _MAX_LOCAL_KEYS:
+                self._local = {
+                    k: s for k, s in self._local.items()
+                    if max(s.permits_until, s.blocked_until, s.fallback_until) > now
+                }
+            state = self._local[key] = _LocalState()
+        return state
+
+    @staticmethod
+    def _reject(retry_after: float):
+        RATE_LIMIT_REQUESTS.labels(result="rejected").inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Превышен лимит запросов, повторите попытку позже",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+
+    async def hit(self, key: str, limit: int):
+        """Учесть запрос; при превышении лимита - HTTPException 429"""
+        now = time.monotonic()
+        state = self._state(key, now)
+        if state.blocked_until > now:
+            self._reject(state.blocked_until - now)
+        if state.permits > 0 and state.permits_until > now:
+            state.permits -= 1
+            RATE_LIMIT_REQUESTS.labels(result="local").inc()
+            return
+
+        batch = max(1, int(limit * settings.rate_limit_local_share))
+        try:
+            granted, seconds = await take_rate_limit(key, limit, _WINDOW, batch)
+        except Exception as e:
+            logger.warning(f"Rate limit check failed, counting locally: {e}")
+            if state.fallback_until <= now:
+                state.fallback_count = 0
+                state.fallback_until = now + _WINDOW
+            if state.fallback_count >= limit:
+                self._reject(state.fallback_until - now)
+            state.fallback_count += 1
+            RATE_LIMIT_REQUESTS.labels(result="fallback").inc()
+            return
+
+        if not granted:
+            state.permits = 0
+            state.blocked_until = now + seconds
+            self._reject(seconds)
+        # Неизрасходованные до конца окна разрешения пропадают
+        state.permits = granted - 1
+        state.permits_until = now + seconds
+        RATE_LIMIT_REQUESTS.labels(result="redis").inc()
+
+
+# Лимитер воркера
+limiter = RateLimiter()
+
+
+class RateLimit:
+    """Зависимость FastAPI: не больше limit запросов в минуту на пользователя или IP"""
+
+    def __init__(self, scope: str, limit_setting: str):
+        self.scope = scope
+        # Имя настройки: лимит читается при каждом запросе
+        self.limit_setting = limit_setting
+
+    async def __call__(self, request: Request):
+        limit = getattr(settings, self.limit_setting)
+        if limit <= 0:
+            return
+        await limiter.hit(f"{self.scope}:{get_user_id_from_request(request)}", limit)
@@ -0,0 +1,59 @@
+"""
+Разбивка времени обработки прокси-запроса по этапам
+
+Этапы (auth, dns, connect, tls, ttfb, transfer) всегда попадают в
+гистограмму proxy_stage_seconds. Если для запроса включен сбор разбивки
+(Server-Timing или журнал медленных запросов), они дополнительно
+записываются в RequestTimings текущего запроса; без него запись стоит
+одного чтения contextvar.
+"""
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from app.metrics import PROXY_STAGE_SECONDS
+
+
+class RequestTimings:
+    """Длительности этапов одного запроса (секунды; повторные этапы суммируются)"""
+
+    __slots__ = ("started", "stages", "upstream")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.upstream: Optional[str] = None
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing (миллисекунды)"""
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def start_request_timing() -> RequestTimings:
+    """Начать сбор разбивки для текущего запроса"""
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def current_request_timing() -> Optional[RequestTimings]:
+    return _current.get()
+
+
+def observe_stage(stage: str, seconds: float):
+    """Учесть длительность этапа в метриках и в разбивке текущего запроса"""
+    PROXY_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(stage, seconds)
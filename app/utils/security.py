@@ -1,6 +1,7 @@
 """
 Утилиты для безопасности: хэширование паролей, JWT токены
 """
+import hashlib
 from datetime import datetime, timedelta
 from typing import Optional, Dict
 from jose import JWTError, jwt
@@ -52,6 +53,11 @@ def decode_token(token: str) -> Optional[Dict]:
         return None
 
 
+def token_digest(token: str) -> str:
+    """Хэш токена для ключей кэша (сам токен в ключах не хранится)"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
 def generate_session_id() -> str:
     """Генерировать уникальный ID сессии"""
     import secrets
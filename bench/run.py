@@ -0,0 +1,347 @@
+"""
+Нагрузочное тестирование прокси без стенда
+
+Запускает локальный upstream (bench/upstream.py) и приложение
+(bench/server.py) в отдельных процессах, регистрирует пользователей и
+прогоняет сценарии параллельными клиентами:
+
+    login      - POST /api/login
+    proxy_get  - GET /proxy/... (тело --payload-bytes)
+    proxy_post - POST /proxy/... (echo тела --payload-bytes)
+    download   - потоковая загрузка --download-bytes через /proxy
+    websocket  - WebSocket echo через /proxy/ws (--ws-messages сообщений за сессию)
+
+Для каждого сценария в JSON выводятся RPS, задержки p50/p99, прирост RSS
+приложения на соединение и процессорное время приложения на запрос
+(вместе с дочерними процессами, например пулом bcrypt).
+
+    python -m bench.run --concurrency 50 --duration 10 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+import httpx
+import websockets
+
+ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ("login", "proxy_get", "proxy_post", "download", "websocket")
+PASSWORD = "Bench12345"
+# Интервал замера RSS во время сценария
+_SAMPLE_INTERVAL = 0.1
+
+
+def _proc_children(pid: int) -> list[int]:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def process_usage(pid: int) -> tuple[float, int]:
+    """Процессорное время (с) и RSS (байт) процесса вместе с потомками (Linux /proc)"""
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu = 0.0
+    rss = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime, stime и RSS в страницах (поля 14, 15, 24 в нумерации proc(5))
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page
+        pending.extend(_proc_children(current))
+    return cpu, rss
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Bench:
+    """Сценарии нагрузки против запущенного приложения"""
+
+    def __init__(self, args: argparse.Namespace, server_pid: int):
+        self.args = args
+        self.server_pid = server_pid
+        self.base_url = f"http://127.0.0.1:{args.server_port}"
+        self.upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+        self.tokens: list[str] = []
+        self.client: Optional[httpx.AsyncClient] = None
+        self._counter = 0
+
+    def _user(self, i: int) -> str:
+        return f"bench{i}@example.com"
+
+    async def setup(self):
+        """Зарегистрировать пользователей и получить токены"""
+        for i in range(self.args.users):
+            await self.client.post(f"{self.base_url}/api/register", json={
+                "email": self._user(i), "username": f"bench{i}", "password": PASSWORD
+            })
+            response = await self.client.post(f"{self.base_url}/api/login", json={
+                "email": self._user(i), "password": PASSWORD
+            })
+            response.raise_for_status()
+            self.tokens.append(response.json()["access_token"])
+
+    def _headers(self, client_id: int) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[client_id % len(self.tokens)]}"}
+
+    def _proxy_url(self, path: str) -> str:
+        # Уникальный параметр исключает кэш и объединение одинаковых запросов
+        self._counter += 1
+        separator = "&" if "?" in path else "?"
+        return f"{self.base_url}/proxy/{self.upstream_url}{path}{separator}n={self._counter}"
+
+    async def login(self, client_id: int, latencies: list) -> int:
+        started = time.perf_counter()
+        response = await self.client.post(f"{self.base_url}/api/login", json={
+            "email": self._user(client_id % self.args.users), "password": PASSWORD
+        })
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        return len(response.content)
+
+    async def proxy_get(self, client_id: int, latencies: list) -> int:
+        started = time.perf_counter()
+        response = await self.client.get(self._proxy_url("/payload"), headers=self._headers(client_id))
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        return len(response.content)
+
+    async def proxy_post(self, client_id: int, latencies: list) -> int:
+        body = b"x" * self.args.payload_bytes
+        started = time.perf_counter()
+        response = await self.client.post(self._proxy_url("/echo"), content=body, headers=self._headers(client_id))
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        return len(response.content)
+
+    async def download(self, client_id: int, latencies: list) -> int:
+        url = self._proxy_url(f"/payload?size={self.args.download_bytes}&chunk={self.args.chunk_bytes}")
+        received = 0
+        started = time.perf_counter()
+        async with self.client.stream("GET", url, headers=self._headers(client_id)) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                received += len(chunk)
+        latencies.append(time.perf_counter() - started)
+        return received
+
+    async def websocket(self, client_id: int, latencies: list) -> int:
+        token = self.tokens[client_id % len(self.tokens)]
+        target = f"ws://127.0.0.1:{self.args.upstream_port}/ws"
+        url = f"ws://127.0.0.1:{self.args.server_port}/proxy/ws/{target}?token={token}"
+        message = b"x" * self.args.ws_message_bytes
+        async with websockets.connect(url, max_size=None) as ws:
+            for _ in range(self.args.ws_messages):
+                started = time.perf_counter()
+                await ws.send(message)
+                await ws.recv()
+                latencies.append(time.perf_counter() - started)
+        return len(message) * self.args.ws_messages * 2
+
+    async def run_scenario(self, name: str) -> dict:
+        """Прогнать сценарий --duration секунд с --concurrency клиентами"""
+        action: Callable[[int, list], Awaitable[int]] = getattr(self, name)
+        concurrency = self.args.concurrency
+        latencies: list[float] = []
+        errors = 0
+        transferred = 0
+        deadline = time.perf_counter() + self.args.duration
+
+        async def client(client_id: int):
+            nonlocal errors, transferred
+            while time.perf_counter() < deadline:
+                try:
+                    transferred += await action(client_id, latencies)
+                except Exception:
+                    errors += 1
+                    await asyncio.sleep(0.01)
+
+        cpu_before, rss_before = process_usage(self.server_pid)
+        rss_peak = rss_before
+        started = time.perf_counter()
+        clients = asyncio.gather(*(client(i) for i in range(concurrency)))
+        while not clients.done():
+            await asyncio.wait([clients], timeout=_SAMPLE_INTERVAL)
+            rss_peak = max(rss_peak, process_usage(self.server_pid)[1])
+        await clients
+        elapsed = time.perf_counter() - started
+        cpu_after, _ = process_usage(self.server_pid)
+
+        requests = len(latencies)
+        result = {
+            "requests": requests,
+            "errors": errors,
+            "duration_s": round(elapsed, 3),
+            "rps": round(requests / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 0.5) * 1000, 2),
+                "p99": round(percentile(latencies, 0.99) * 1000, 2),
+                "mean": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+                "max": round(max(latencies, default=0.0) * 1000, 2),
+            },
+            "throughput_mb_s": round(transferred / elapsed / 1024 / 1024, 2) if elapsed else 0.0,
+            "server_cpu_ms_per_request": round((cpu_after - cpu_before) / requests * 1000, 3) if requests else None,
+            "server_rss_mb": round(rss_before / 1024 / 1024, 1),
+            "server_rss_per_connection_kb": round((rss_peak - rss_before) / concurrency / 1024, 1),
+        }
+        if name == "websocket":
+            # Задержка и RPS - по сообщениям, а не по сессиям
+            result["unit"] = "message"
+        return result
+
+
+def _wait_for(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode}: {process.args}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start in {timeout}s")
+
+
+def _start(module: str, args: list[str], env: dict) -> subprocess.Popen:
+    # Отдельная группа процессов: при остановке завершаются и дочерние (пул bcrypt)
+    return subprocess.Popen([sys.executable, "-m", module, *args], cwd=ROOT, env=env, start_new_session=True)
+
+
+def _stop(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+async def _run(args: argparse.Namespace, server_pid: int) -> dict:
+    bench = Bench(args, server_pid)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        bench.client = client
+        await bench.setup()
+        return {name: await bench.run_scenario(name) for name in args.scenarios}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование прокси")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Сценарии через запятую ({', '.join(SCENARIOS)})")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10, help="Длительность сценария, с")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--latency-ms", type=int, default=20, help="Задержка ответа upstream")
+    parser.add_argument("--payload-bytes", type=int, default=16384)
+    parser.add_argument("--chunk-bytes", type=int, default=16384)
+    parser.add_argument("--download-bytes", type=int, default=10 * 1024 * 1024)
+    parser.add_argument("--ws-messages", type=int, default=20)
+    parser.add_argument("--ws-message-bytes", type=int, default=1024)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=1, help="Воркеры приложения (>1 - с --redis-url и --database-url)")
+    parser.add_argument("--redis-url", default=None, help="Без параметра - fakeredis в процессе приложения")
+    parser.add_argument("--database-url", default=None, help="Без параметра - SQLite во временном файле")
+    parser.add_argument("--server-port", type=int, default=18180)
+    parser.add_argument("--upstream-port", type=int, default=18181)
+    parser.add_argument("--output", default=None, help="Файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_args()
+    env = {
+        **os.environ,
+        "JWT_SECRET_KEY": os.environ.get("JWT_SECRET_KEY", "bench-secret"),
+        "LOG_LEVEL": "warning",
+        # Лимиты частоты запросов исказили бы результат
+        "RATE_LIMIT_PER_MINUTE": "0",
+        "PROXY_RATE_LIMIT_PER_MINUTE": "0",
+        "PROXY_MAX_CONNECTIONS_PER_USER": str(max(100, args.concurrency)),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        upstream = _start("bench.upstream", [
+            "--port", str(args.upstream_port),
+            "--latency-ms", str(args.latency_ms),
+            "--payload-bytes", str(args.payload_bytes),
+            "--chunk-bytes", str(args.chunk_bytes),
+        ], env)
+        server_args = [
+            "--port", str(args.server_port),
+            "--workers", str(args.workers),
+            "--sqlite-path", str(Path(tmp) / "bench.db"),
+        ]
+        if args.redis_url:
+            server_args += ["--redis-url", args.redis_url]
+        if args.database_url:
+            server_args += ["--database-url", args.database_url]
+        server = _start("bench.server", server_args, env)
+        try:
+            _wait_for(f"http://127.0.0.1:{args.upstream_port}/payload?size=0&latency_ms=0", upstream)
+            _wait_for(f"http://127.0.0.1:{args.server_port}/", server)
+            scenarios = asyncio.run(_run(args, server.pid))
+        finally:
+            for process in (server, upstream):
+                _stop(process)
+
+    report = {
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "redis_url", "database_url")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "redis": "external" if args.redis_url else "fakeredis",
+            "database": "external" if args.database_url else "sqlite",
+        },
+        "scenarios": scenarios,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Запуск приложения для нагрузочного тестирования
+
+Без --redis-url Redis заменяется fakeredis в процессе приложения, без
+--database-url используется SQLite (aiosqlite) во временном файле. С
+заменами приложение работает в одном воркере; несколько воркеров
+(--workers) требуют настоящих Redis и PostgreSQL.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def _use_sqlite(path: str):
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{path}"
+    # Пул по умолчанию для aiosqlite не принимает pool_size/max_overflow из app.database
+    import sqlalchemy.ext.asyncio as sqlalchemy_asyncio
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    create_async_engine = sqlalchemy_asyncio.create_async_engine
+    sqlalchemy_asyncio.create_async_engine = lambda url, **kwargs: create_async_engine(
+        url, poolclass=AsyncAdaptedQueuePool, **kwargs
+    )
+
+
+def _use_fakeredis():
+    import fakeredis
+    from app import redis_client
+
+    redis_client.redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Приложение для bench/run.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18180)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--sqlite-path", default="/tmp/proxy_bench.db")
+    args = parser.parse_args()
+
+    if (args.redis_url is None or args.database_url is None) and args.workers > 1:
+        parser.error("--workers > 1 требует --redis-url и --database-url")
+
+    # С fakeredis адрес не используется, но обязателен в настройках
+    os.environ["REDIS_URL"] = args.redis_url or "redis://localhost:6379/0"
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        _use_sqlite(args.sqlite_path)
+
+    import uvicorn
+
+    if args.workers > 1:
+        uvicorn.run("app.main:app", host=args.host, port=args.port, workers=args.workers, log_level="warning")
+        return
+
+    if args.redis_url is None:
+        _use_fakeredis()
+    from app.main import app
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Локальный upstream для нагрузочного тестирования
+
+GET /payload - тело заданного размера, передаваемое чанками
+POST /echo - возвращает тело запроса
+GET /ws - WebSocket echo
+
+Задержка ответа, размер тела и чанка задаются параметрами запуска и
+переопределяются query-параметрами latency_ms, size, chunk.
+"""
+import argparse
+import asyncio
+
+from aiohttp import WSMsgType, web
+
+
+def _int_param(request: web.Request, name: str, default: int) -> int:
+    try:
+        return int(request.query.get(name, default))
+    except ValueError:
+        return default
+
+
+def create_app(latency_ms: int, payload_bytes: int, chunk_bytes: int) -> web.Application:
+    """Приложение aiohttp с эндпоинтами upstream"""
+
+    async def delay(request: web.Request):
+        latency = _int_param(request, "latency_ms", latency_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    async def payload(request: web.Request) -> web.StreamResponse:
+        await delay(request)
+        size = _int_param(request, "size", payload_bytes)
+        chunk = max(1, _int_param(request, "chunk", chunk_bytes))
+        response = web.StreamResponse(headers={"Cache-Control": "no-store", "Content-Type": "application/octet-stream"})
+        response.content_length = size
+        await response.prepare(request)
+        block = b"x" * chunk
+        sent = 0
+        while sent < size:
+            part = min(chunk, size - sent)
+            await response.write(block if part == chunk else block[:part])
+            sent += part
+        await response.write_eof()
+        return response
+
+    async def echo(request: web.Request) -> web.Response:
+        body = await request.read()
+        await delay(request)
+        return web.Response(body=body, headers={"Cache-Control": "no-store"})
+
+    async def websocket_echo(request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            if message.type == WSMsgType.BINARY:
+                await ws.send_bytes(message.data)
+            elif message.type == WSMsgType.TEXT:
+                await ws.send_str(message.data)
+        return ws
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_get("/payload", payload)
+    app.router.add_post("/echo", echo)
+    app.router.add_get("/ws", websocket_echo)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный upstream для bench/run.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18181)
+    parser.add_argument("--latency-ms", type=int, default=0)
+    parser.add_argument("--payload-bytes", type=int, default=16384)
+    parser.add_argument("--chunk-bytes", type=int, default=16384)
+    args = parser.parse_args()
+    web.run_app(
+        create_app(args.latency_ms, args.payload_bytes, args.chunk_bytes),
+        host=args.host, port=args.port, access_log=None, print=None
+    )
+
+
+if __name__ == "__main__":
+    main()
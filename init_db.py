@@ -1,26 +1,27 @@
 """
 Скрипт для инициализации базы данных
 """
+import asyncio
 import sys
-from sqlalchemy import create_engine, text
-from app.database import Base, engine
+from sqlalchemy import select
+from app.database import Base, engine, SessionLocal
 from app.models import User, Session
 from app.utils.security import get_password_hash
 from app.config import settings
 
-def init_database():
+async def init_database():
     """Инициализация базы данных"""
     print("Creating database tables...")
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
     print("Database tables created successfully!")
     
     # Создаем администратора по умолчанию (если нужно)
-    from app.database import SessionLocal
     db = SessionLocal()
     
     try:
         # Проверяем, есть ли уже администратор
-        admin = db.query(User).filter(User.email == "admin@example.com").first()
+        admin = await db.scalar(select(User).where(User.email == "admin@example.com"))
         if not admin:
             print("Creating default admin user...")
             admin = User(
@@ -32,7 +33,7 @@ def init_database():
                 is_verified=True
             )
             db.add(admin)
-            db.commit()
+            await db.commit()
             print("Default admin user created!")
             print("Email: admin@example.com")
             print("Password: admin123")
@@ -41,15 +42,16 @@ def init_database():
             print("Admin user already exists.")
     except Exception as e:
         print(f"Error creating admin user: {e}")
-        db.rollback()
+        await db.rollback()
     finally:
-        db.close()
+        await db.close()
+        await engine.dispose()
     
     print("Database initialization completed!")
 
 if __name__ == "__main__":
     try:
-        init_database()
+        asyncio.run(init_database())
     except Exception as e:
         print(f"Error initializing database: {e}")
         sys.exit(1)
@@ -0,0 +1,185 @@
+"""
+Объединение одинаковых одновременных запросов к upstream (single-flight)
+"""
+import asyncio
+
+import httpx
+
+from app.config import settings
+from app.services.coalescer import Flight, RequestCoalescer
+from tests.upstream import chunk, start_upstream
+
+SHAREABLE_HEAD = b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n\r\n"
+
+
+async def _read(flight: Flight, consumer: int) -> bytes:
+    try:
+        return b"".join([data async for data in flight.iterate(consumer)])
+    finally:
+        await flight.leave(consumer)
+
+
+async def _join_both(coalescer: RequestCoalescer, client: httpx.AsyncClient, url: str):
+    leader = await coalescer.join(client, client.build_request("GET", url))
+    follower = await coalescer.join(client, client.build_request("GET", url))
+    return leader, follower
+
+
+async def _follower_joins_in_flight():
+    hits = 0
+    release = asyncio.Event()
+
+    async def handler(reader, writer):
+        nonlocal hits
+        hits += 1
+        writer.write(SHAREABLE_HEAD)
+        await writer.drain()
+        await release.wait()
+        writer.write(chunk(b"hello") + b"0\r\n\r\n")
+        await writer.drain()
+
+    server, url = await start_upstream(handler)
+    async with httpx.AsyncClient() as client:
+        (leader, leader_id), (follower, follower_id) = await _join_both(RequestCoalescer(), client, url)
+        release.set()
+        bodies = await asyncio.gather(_read(leader, leader_id), _read(follower, follower_id))
+    server.close()
+    return leader, follower, bodies, hits
+
+
+def test_follower_joins_flight_in_progress(redis):
+    leader, follower, bodies, hits = asyncio.run(_follower_joins_in_flight())
+
+    assert follower is leader
+    assert bodies == [b"hello", b"hello"]
+    assert hits == 1
+
+
+async def _slow_consumer(body: bytes):
+    async def handler(reader, writer):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+        )
+        await writer.drain()
+
+    server, url = await start_upstream(handler)
+    async with httpx.AsyncClient() as client:
+        (flight, slow_id), (_, fast_id) = await _join_both(RequestCoalescer(), client, url)
+        fast = asyncio.create_task(_read(flight, fast_id))
+        await asyncio.sleep(0.2)
+        # Быстрый получатель ждет, пока медленный не прочитает буфер
+        stalled = not fast.done()
+        buffered = flight._buffered
+        slow_body = await _read(flight, slow_id)
+        fast_body = await fast
+    server.close()
+    return stalled, buffered, slow_body, fast_body
+
+
+def test_slow_consumer_limits_window(redis, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_stream_chunk_size", 1024)
+    monkeypatch.setattr(settings, "proxy_coalesce_window_bytes", 4096)
+    body = bytes(range(256)) * 256
+
+    stalled, buffered, slow_body, fast_body = asyncio.run(_slow_consumer(body))
+
+    assert stalled
+    assert buffered <= 4096
+    assert slow_body == fast_body == body
+
+
+async def _everyone_leaves():
+    async def handler(reader, writer):
+        writer.write(SHAREABLE_HEAD)
+        # Бесконечное тело: upstream закрывает только прокси
+        while True:
+            writer.write(chunk(b"x" * 1024))
+            await writer.drain()
+            await asyncio.sleep(0.01)
+
+    server, url = await start_upstream(handler)
+    coalescer = RequestCoalescer()
+    async with httpx.AsyncClient() as client:
+        (flight, leader_id), (_, follower_id) = await _join_both(coalescer, client, url)
+        for consumer in (leader_id, follower_id):
+            body = flight.iterate(consumer)
+            await body.__anext__()
+            await body.aclose()
+            await flight.leave(consumer)
+        await asyncio.wait_for(flight._task, timeout=5)
+        result = flight.response.is_closed, coalescer._flights.get(flight.key)
+    server.close()
+    return result
+
+
+def test_everyone_leaving_cancels_upstream(redis, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_stream_chunk_size", 1024)
+
+    response_closed, registered = asyncio.run(_everyone_leaves())
+
+    assert response_closed
+    assert registered is None
+
+
+async def _private_response():
+    release = asyncio.Event()
+
+    async def handler(reader, writer):
+        await release.wait()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nCache-Control: private, max-age=60\r\nContent-Length: 6\r\n\r\nsecret"
+        )
+        await writer.drain()
+
+    server, url = await start_upstream(handler)
+    coalescer = RequestCoalescer()
+    async with httpx.AsyncClient() as client:
+        # Второй запрос присоединяется, пока заголовки ответа еще не получены
+        leader = asyncio.create_task(coalescer.join(client, client.build_request("GET", url)))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(coalescer.join(client, client.build_request("GET", url)))
+        await asyncio.sleep(0.05)
+        joined = sum(len(flight._positions) for flight in coalescer._flights.values())
+        release.set()
+        (flight, leader_id), follower_result = await asyncio.gather(leader, follower)
+        body = await _read(flight, leader_id)
+    server.close()
+    return joined, follower_result, body
+
+
+def test_private_response_is_not_shared(redis):
+    joined, follower_result, body = asyncio.run(_private_response())
+
+    assert joined == 2
+    assert follower_result == (None, 0)
+    assert body == b"secret"
+
+
+async def _error_after_headers() -> list:
+    release = asyncio.Event()
+
+    async def handler(reader, writer):
+        writer.write(SHAREABLE_HEAD)
+        await writer.drain()
+        await release.wait()
+        # Часть тела, затем обрыв соединения
+        writer.write(chunk(b"x" * 1000))
+        await writer.drain()
+
+    server, url = await start_upstream(handler)
+    async with httpx.AsyncClient() as client:
+        (leader, leader_id), (follower, follower_id) = await _join_both(RequestCoalescer(), client, url)
+        assert follower is leader
+        release.set()
+        results = await asyncio.gather(
+            _read(leader, leader_id), _read(follower, follower_id), return_exceptions=True
+        )
+    server.close()
+    return results
+
+
+def test_upstream_error_mid_body_reaches_every_consumer(redis):
+    results = asyncio.run(_error_after_headers())
+
+    assert len(results) == 2
+    assert all(isinstance(result, httpx.HTTPError) for result in results)
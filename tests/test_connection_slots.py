@@ -0,0 +1,180 @@
+"""
+Слоты соединений пользователей: аренды в Redis, очередь воркера и отказ 429
+"""
+import asyncio
+
+import fakeredis
+import pytest
+from starlette.requests import Request
+
+from app import redis_client
+from app.config import settings
+from app.http_client import close_http_client
+from app.services.connection_slots import ConnectionLimitExceeded, ConnectionSlots, connection_slots
+from app.services.proxy_service import ProxyService
+
+USER_ID = 1
+KEY = f"conn_slots:{USER_ID}"
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(settings, "proxy_max_connections_per_user", 2)
+    monkeypatch.setattr(settings, "proxy_user_slot_ttl", 60.0)
+    monkeypatch.setattr(settings, "proxy_user_queue_size", 10)
+    monkeypatch.setattr(settings, "proxy_user_queue_timeout", 5.0)
+
+
+def test_acquire_beyond_limit_waits_for_release(redis, limits):
+    async def scenario():
+        slots = ConnectionSlots()
+        first = await slots.acquire(USER_ID)
+        second = await slots.acquire(USER_ID)
+        third = asyncio.create_task(slots.acquire(USER_ID))
+        await asyncio.sleep(0.2)
+        waiting = not third.done()
+        held_at_limit = await redis.zcard(KEY)
+        await first.release()
+        third_lease = await asyncio.wait_for(third, timeout=1)
+        held_after_handoff = await redis.zcard(KEY)
+        await second.release()
+        await third_lease.release()
+        return waiting, held_at_limit, held_after_handoff, await redis.zcard(KEY)
+
+    waiting, held_at_limit, held_after_handoff, held_at_end = asyncio.run(scenario())
+
+    assert waiting
+    assert held_at_limit == 2
+    assert held_after_handoff == 2
+    assert held_at_end == 0
+
+
+def test_queue_is_fifo(redis, limits, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_max_connections_per_user", 1)
+
+    async def scenario():
+        slots = ConnectionSlots()
+        order = []
+        held = await slots.acquire(USER_ID)
+
+        async def wait_for_slot(name: str):
+            lease = await slots.acquire(USER_ID)
+            order.append(name)
+            await asyncio.sleep(0.05)
+            await lease.release()
+
+        waiters = []
+        for name in ("first", "second", "third"):
+            waiters.append(asyncio.create_task(wait_for_slot(name)))
+            await asyncio.sleep(0.02)
+        await held.release()
+        await asyncio.wait_for(asyncio.gather(*waiters), timeout=3)
+        return order
+
+    assert asyncio.run(scenario()) == ["first", "second", "third"]
+
+
+def test_lease_expires_without_heartbeat(redis, limits, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_max_connections_per_user", 1)
+    monkeypatch.setattr(settings, "proxy_user_slot_ttl", 0.5)
+
+    async def scenario():
+        # Воркер, занявший слот, не продлевает аренду (например, завершился аварийно)
+        await ConnectionSlots().acquire(USER_ID)
+        lease = await asyncio.wait_for(ConnectionSlots().acquire(USER_ID), timeout=3)
+        return lease, await redis.zrange(KEY, 0, -1)
+
+    lease, leases = asyncio.run(scenario())
+
+    assert leases == [lease.lease_id]
+
+
+def test_heartbeat_keeps_lease(redis, limits, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_max_connections_per_user", 1)
+    monkeypatch.setattr(settings, "proxy_user_slot_ttl", 0.6)
+    monkeypatch.setattr(settings, "proxy_user_queue_timeout", 1.2)
+
+    async def scenario():
+        slots = ConnectionSlots()
+        slots.start()
+        try:
+            await slots.acquire(USER_ID)
+            with pytest.raises(ConnectionLimitExceeded):
+                await ConnectionSlots().acquire(USER_ID)
+        finally:
+            await slots.stop()
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_and_full_queue(redis, limits, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_max_connections_per_user", 1)
+    monkeypatch.setattr(settings, "proxy_user_queue_size", 1)
+    monkeypatch.setattr(settings, "proxy_user_queue_timeout", 0.3)
+
+    async def scenario():
+        slots = ConnectionSlots()
+        await slots.acquire(USER_ID)
+        queued = asyncio.create_task(slots.acquire(USER_ID))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ConnectionLimitExceeded) as rejected:
+            await slots.acquire(USER_ID)
+        with pytest.raises(ConnectionLimitExceeded) as timed_out:
+            await queued
+        return rejected.value, timed_out.value
+
+    rejected, timed_out = asyncio.run(scenario())
+
+    assert rejected.retry_after == 1
+    assert timed_out.retry_after == 1
+    assert "время ожидания" in str(timed_out)
+
+
+def test_local_fallback_when_redis_is_down(limits, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_max_connections_per_user", 1)
+    monkeypatch.setattr(settings, "proxy_user_queue_timeout", 0.3)
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(redis_client, "redis_client", fakeredis.FakeAsyncRedis(server=server))
+
+    async def scenario():
+        slots = ConnectionSlots()
+        lease = await slots.acquire(USER_ID)
+        # Без Redis лимит соблюдается в пределах воркера
+        with pytest.raises(ConnectionLimitExceeded):
+            await slots.acquire(USER_ID)
+        await lease.release()
+        again = await slots.acquire(USER_ID)
+        await again.release()
+        return lease, again, slots._local_counts
+
+    lease, again, local_counts = asyncio.run(scenario())
+
+    assert lease.local and again.local
+    assert local_counts == {}
+
+
+def test_proxy_request_gets_429_after_queue_timeout(redis, limits, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_max_connections_per_user", 1)
+    monkeypatch.setattr(settings, "proxy_user_queue_timeout", 0.3)
+
+    async def scenario():
+        held = await connection_slots.acquire(USER_ID)
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        scope = {
+            "type": "http", "method": "POST", "path": "/proxy", "query_string": b"",
+            "headers": [(b"content-length", b"0")],
+        }
+        try:
+            return await ProxyService.proxy_request(Request(scope, receive), "http://upstream.test/", USER_ID)
+        finally:
+            await held.release()
+            await close_http_client()
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
@@ -0,0 +1,192 @@
+"""
+Правила HTTP-кэша (RFC 9111) и хранение вариантов ответа по Vary
+"""
+import asyncio
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+from app.config import settings
+from app.services.http_cache import HEURISTIC_MAX_LIFETIME, CacheEntry, HttpCache
+
+URL = "http://upstream.test/resource"
+NOW = time.time()
+
+
+def _date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def _request(headers: dict = None, method: str = "GET") -> httpx.Request:
+    return httpx.Request(method, URL, headers=headers or {})
+
+
+def _response(headers: dict = None, status: int = 200) -> httpx.Response:
+    return httpx.Response(status, headers=headers or {})
+
+
+def _entry(headers: dict, status: int = 200, body: bytes = b"body") -> CacheEntry:
+    return CacheEntry(URL, status, [(k.lower(), v) for k, v in headers.items()], body, NOW, NOW, {})
+
+
+def test_shareable_needs_freshness_or_validator():
+    cache = HttpCache()
+
+    assert not cache.is_shareable(_request(), _response())
+    assert cache.is_shareable(_request(), _response({"Cache-Control": "max-age=60"}))
+    assert cache.is_shareable(_request(), _response({"ETag": '"v1"'}))
+    assert not cache.is_shareable(_request(), _response({"Cache-Control": "max-age=60"}, status=500))
+
+
+@pytest.mark.parametrize("headers", [
+    {"Cache-Control": "private, max-age=60"},
+    {"Cache-Control": "no-store, max-age=60"},
+    {"Cache-Control": "max-age=60", "Set-Cookie": "session=1"},
+    {"Cache-Control": "max-age=60", "Vary": "*"},
+])
+def test_not_shareable_responses(headers):
+    assert not HttpCache().is_shareable(_request(), _response(headers))
+
+
+def test_no_store_request_is_not_shareable():
+    response = _response({"Cache-Control": "max-age=60"})
+
+    assert not HttpCache().is_shareable(_request({"Cache-Control": "no-store"}), response)
+
+
+def test_authorization_requires_explicit_permission():
+    cache = HttpCache()
+    request = _request({"Authorization": "Bearer token"})
+
+    assert not cache.is_shareable(request, _response({"Cache-Control": "max-age=60"}))
+    assert cache.is_shareable(request, _response({"Cache-Control": "public, max-age=60"}))
+    assert cache.is_shareable(request, _response({"Cache-Control": "s-maxage=60"}))
+    assert cache.is_shareable(request, _response({"Cache-Control": "max-age=60, must-revalidate"}))
+
+
+def test_storable_only_get_within_size_limit():
+    cache = HttpCache()
+    headers = {"Cache-Control": "max-age=60"}
+    too_large = str(settings.proxy_cache_max_object_bytes + 1)
+
+    assert cache.is_storable(_request(), _response(headers))
+    assert not cache.is_storable(_request(method="HEAD"), _response(headers))
+    assert not cache.is_storable(_request(), _response({**headers, "Content-Length": too_large}))
+
+
+def test_fresh_within_max_age():
+    cache = HttpCache()
+    # Ответ получен с возрастом 10 секунд
+    entry = _entry({"Cache-Control": "max-age=60", "Date": _date(NOW - 10)})
+
+    assert cache.is_fresh(entry, _request(), NOW)
+    assert not cache.is_fresh(entry, _request(), NOW + 55)
+
+
+def test_request_directives_limit_freshness():
+    cache = HttpCache()
+    entry = _entry({"Cache-Control": "max-age=60", "Date": _date(NOW - 10)})
+
+    assert not cache.is_fresh(entry, _request({"Cache-Control": "no-cache"}), NOW)
+    assert not cache.is_fresh(entry, _request({"Pragma": "no-cache"}), NOW)
+    assert not cache.is_fresh(entry, _request({"Cache-Control": "max-age=5"}), NOW)
+    assert not cache.is_fresh(entry, _request({"Cache-Control": "min-fresh=55"}), NOW)
+    assert cache.is_fresh(entry, _request({"Cache-Control": "min-fresh=30"}), NOW)
+
+
+def test_response_no_cache_requires_revalidation():
+    entry = _entry({"Cache-Control": "no-cache, max-age=60", "Date": _date(NOW)})
+
+    assert not HttpCache().is_fresh(entry, _request(), NOW)
+
+
+def test_expires_lifetime():
+    assert _entry({"Date": _date(NOW), "Expires": _date(NOW + 30)}).freshness_lifetime() == 30
+    # Некорректный Expires означает, что ответ уже устарел
+    assert _entry({"Date": _date(NOW), "Expires": "0"}).freshness_lifetime() == 0
+
+
+def test_heuristic_lifetime_from_last_modified():
+    cache = HttpCache()
+    entry = _entry({"Date": _date(NOW), "Last-Modified": _date(NOW - 1000)})
+
+    assert entry.freshness_lifetime() == pytest.approx(100)
+    assert cache.is_fresh(entry, _request(), NOW + 50)
+    assert not cache.is_fresh(entry, _request(), NOW + 150)
+
+
+def test_heuristic_lifetime_is_capped_and_status_limited():
+    old = {"Date": _date(NOW), "Last-Modified": _date(NOW - 10 * 365 * 86400)}
+
+    assert _entry(old).freshness_lifetime() == HEURISTIC_MAX_LIFETIME
+    assert _entry(old, status=302).freshness_lifetime() == 0
+
+
+def test_freshen_merges_304_headers():
+    entry = _entry({
+        "Content-Type": "text/plain",
+        "ETag": '"v1"',
+        "Cache-Control": "max-age=60",
+        "X-Upstream": "1",
+    })
+    not_modified = _response({
+        "Content-Type": "application/json",
+        "ETag": '"v1"',
+        "Cache-Control": "max-age=120",
+    }, status=304)
+
+    freshened = HttpCache.freshen(entry, not_modified, NOW + 5, NOW + 6)
+
+    assert freshened.header("cache-control") == "max-age=120"
+    assert freshened.header("etag") == '"v1"'
+    # Content-Type не обновляется ответом 304
+    assert freshened.header("content-type") == "text/plain"
+    assert freshened.header("x-upstream") == "1"
+    assert freshened.body == entry.body
+    assert freshened.status == 200
+    assert freshened.response_time == NOW + 6
+
+
+async def _store_variant(cache: HttpCache):
+    request = _request({"Accept-Language": "ru"})
+    response = _response({"Cache-Control": "max-age=60", "Vary": "Accept-Language"})
+    headers = [("cache-control", "max-age=60"), ("vary", "Accept-Language")]
+    await cache.put(cache.make_entry(request, response, headers, b"privet", NOW, NOW))
+
+
+async def _lookup(cache: HttpCache) -> dict:
+    return {
+        language: await cache.get(_request({"Accept-Language": language} if language else None))
+        for language in ("ru", "en", None)
+    }
+
+
+def test_put_get_round_trip_with_vary():
+    cache = HttpCache()
+
+    async def round_trip():
+        await _store_variant(cache)
+        return await _lookup(cache)
+
+    found = asyncio.run(round_trip())
+
+    assert found["ru"].body == b"privet"
+    assert found["ru"].vary == {"accept-language": "ru"}
+    assert found["en"] is None
+    assert found[None] is None
+
+
+def test_redis_level_shared_between_workers(redis, monkeypatch):
+    monkeypatch.setattr(settings, "proxy_cache_redis_enabled", True)
+
+    async def round_trip():
+        await _store_variant(HttpCache())
+        # Кэш другого воркера с пустой памятью
+        return await _lookup(HttpCache())
+
+    found = asyncio.run(round_trip())
+
+    assert found["ru"].body == b"privet"
+    assert found["en"] is None
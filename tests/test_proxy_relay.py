@@ -0,0 +1,95 @@
+"""
+Передача ответа upstream клиенту: обрыв соединения клиентом и ошибка upstream
+"""
+import asyncio
+
+import httpx
+import pytest
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+from app.config import settings
+from app.http_client import close_http_client
+from app.services.connection_slots import connection_slots
+from app.services.proxy_service import ProxyService, _ResponseRelay
+from app.services.stats_aggregator import stats_aggregator
+from tests.upstream import aborted_body, start_upstream
+
+USER_ID = 1
+
+
+async def _upstream_body():
+    # Тело отдается медленно, чтобы клиент отключился посреди передачи
+    for _ in range(100):
+        yield b"x" * settings.proxy_stream_chunk_size
+        await asyncio.sleep(0.01)
+
+
+async def _abort_download(redis) -> tuple[_ResponseRelay, int]:
+    slot = await connection_slots.acquire(USER_ID)
+    upstream_response = httpx.Response(200, content=_upstream_body())
+    relay = _ResponseRelay(upstream_response, USER_ID, None, slot)
+    response = StreamingResponse(relay, background=BackgroundTask(relay.close))
+
+    async def receive():
+        await asyncio.sleep(0.05)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "method": "GET", "path": "/proxy", "headers": []}
+    await response(scope, receive, send)
+    return relay, await redis.zcard(f"conn_slots:{USER_ID}")
+
+
+def test_client_disconnect_releases_slot(redis):
+    relay, slots_held = asyncio.run(_abort_download(redis))
+
+    assert relay.bytes_received > 0
+    assert slots_held == 0
+
+
+def test_client_disconnect_records_traffic(redis):
+    stats_aggregator._pending.pop(USER_ID, None)
+    relay, _ = asyncio.run(_abort_download(redis))
+
+    assert relay.bytes_received > 0
+    assert stats_aggregator._pending[USER_ID][1] == relay.bytes_received
+
+
+async def _proxy_aborted_upstream() -> list[dict]:
+    server, upstream_url = await start_upstream(aborted_body)
+    sent = []
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # Клиент не отключается
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "method": "POST", "path": "/proxy", "query_string": b"",
+        "headers": [(b"content-length", b"0")],
+    }
+    try:
+        response = await ProxyService.proxy_request(Request(scope, receive), f"{upstream_url}/data", USER_ID)
+        assert response.status_code == 200
+        with pytest.raises(httpx.HTTPError):
+            await response(scope, receive, send)
+    finally:
+        await close_http_client()
+        server.close()
+    return sent
+
+
+def test_upstream_error_mid_body_aborts_response(redis):
+    sent = asyncio.run(_proxy_aborted_upstream())
+
+    # Ответ не завершен: ASGI-сервер оборвет соединение вместо последнего чанка
+    assert not [m for m in sent if m["type"] == "http.response.body" and not m.get("more_body", False)]
@@ -0,0 +1,34 @@
+"""
+Upstream для тестов на сыром TCP: ответ задается обработчиком соединения
+"""
+import asyncio
+from typing import Awaitable, Callable
+
+Handler = Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]
+
+
+async def start_upstream(handler: Handler) -> tuple[asyncio.AbstractServer, str]:
+    """Запустить сервер на свободном порту; возвращает сервер и его базовый URL"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await reader.readuntil(b"\r\n\r\n")
+        try:
+            await handler(reader, writer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, f"http://127.0.0.1:{port}"
+
+
+def chunk(data: bytes) -> bytes:
+    """Чанк тела в chunked-кодировании"""
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+async def aborted_body(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Отправить заголовки и часть chunked-тела, затем закрыть соединение"""
+    writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" + chunk(b"x" * 1000))
+    await writer.drain()